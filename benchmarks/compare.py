@@ -0,0 +1,37 @@
+"""
+Compare two result files written by benchmarks.run.
+
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import json
+
+
+def compare(baseline, current):
+    """Yield (benchmark, baseline seconds, current seconds, ratio) for shared benchmarks."""
+    for name, result in current['results'].items():
+        if name in baseline['results']:
+            before = baseline['results'][name]['median_seconds']
+            after = result['median_seconds']
+            yield name, before, after, after / before if before else float('inf')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    args = parser.parse_args(argv)
+
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.current, encoding='utf-8') as f:
+        current = json.load(f)
+
+    print(f"{'benchmark':<20} {baseline['commit'] or 'baseline':>12} "
+          f"{current['commit'] or 'current':>12} {'ratio':>7}")
+    for name, before, after, ratio in compare(baseline, current):
+        print(f"{name:<20} {before:>11.3f}s {after:>11.3f}s {ratio:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
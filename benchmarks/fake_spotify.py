@@ -0,0 +1,432 @@
+"""
+A local stand-in for the parts of the Spotify Web API SpotifyManager uses.
+
+Responses come from the synthetic catalogue in generate_history. Every
+request can be delayed, and every nth request can be answered with 429
+Too Many Requests, so concurrency and retries cost what they would
+against Spotify.
+"""
+import json
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from benchmarks.generate_history import (HISTORY_END, TRACK_COUNT, catalogue,
+                                         catalogue_index, spotify_id,
+                                         synthetic_timeline)
+
+USER_ID = "benchmark_user"
+SEARCH_QUERY = re.compile(r"track:(?P<track>.*) artist:(?P<artist>.*)")
+
+# Largest limit each endpoint accepts, as on Spotify
+MAX_LIMITS = {
+    'search': 50,
+    'user_playlists': 50,
+    'playlist_items': 100,
+    'recently_played': 50,
+    'top_items': 50,
+}
+MAX_ADD_ITEMS = 100  # Tracks one request may add, remove or replace
+
+
+class FakeSpotify:
+    """
+    Serve a fake Spotify Web API on localhost from a background thread.
+
+    :param latency: Seconds each request waits before it is answered
+    :param rate_limit_every: Answer every nth request with 429 (0 never)
+    :param retry_after: Retry-After seconds sent with a 429
+    :param playlist_count: Playlists in the user's library; every fifth
+        one is owned by another user
+    :param playlist_size: Tracks in each playlist
+    :param recent_plays: Plays the recently played endpoint knows about,
+        starting at HISTORY_END
+    :param top_item_count: Top tracks and artists available per time range
+    :param max_limits: Overrides for MAX_LIMITS
+    """
+
+    def __init__(self, latency=0.0, rate_limit_every=0, retry_after=0,
+                 playlist_count=100, playlist_size=500, recent_plays=1000,
+                 top_item_count=100, max_limits=None):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.top_item_count = top_item_count
+        self.max_limits = {**MAX_LIMITS, **(max_limits or {})}
+
+        self.tracks = catalogue()
+        self.track_names = {track['name']: index
+                            for index, track in enumerate(self.tracks)}
+
+        self.playlists = {}
+        for number in range(playlist_count):
+            start = number * playlist_size
+            self._add_playlist(
+                f"Playlist {number}",
+                USER_ID if number % 5 else "another_user",
+                [(start + offset) % TRACK_COUNT for offset in range(playlist_size)])
+
+        # (epoch milliseconds, track index), oldest first
+        self.recent_plays = [
+            (epoch_ms(played_at), index)
+            for index, played_at in synthetic_timeline(recent_plays, HISTORY_END, seed=1)]
+
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        """Base URL of the API, like https://api.spotify.com/v1/."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1/"
+
+    def start(self):
+        """Start serving on a free port and return self."""
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(self))
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="fake-spotify", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats.clear()
+
+    def client(self):
+        """
+        Return a spotipy client for this server.
+
+        It uses the same pooled, retrying session as the real client, with a
+        fixed token instead of OAuth.
+        """
+        from scripts.client import InstrumentedSpotify, create_session
+
+        sp = InstrumentedSpotify(auth="benchmark-token", requests_session=create_session())
+        sp.prefix = self.url
+        return sp
+
+    def _add_playlist(self, name, owner, track_indices):
+        playlist_id = spotify_id('p', len(self.playlists))
+        self.playlists[playlist_id] = {
+            'id': playlist_id,
+            'name': name,
+            'owner': owner,
+            'tracks': track_indices,
+            'version': 1,
+        }
+        return self.playlists[playlist_id]
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+            return self.stats['requests']
+
+    # Endpoints. Each takes the query parameters, merged with the JSON body
+    # of POST and PUT requests, and returns (status, response body).
+
+    def me(self, query):
+        return 200, {'id': USER_ID, 'display_name': "Benchmark User"}
+
+    def search(self, query):
+        limit = int(query.get('limit', 10))
+        match = SEARCH_QUERY.fullmatch(query.get('q', ''))
+        items = []
+        if match:
+            index = self.track_names.get(match['track'])
+            if (index is not None
+                    and self.tracks[index]['artists'][0]['name'] == match['artist']):
+                items.append(self.tracks[index])
+        return 200, {'tracks': _page(items, 0, limit, len(items), None)}
+
+    def user_playlists(self, query, user_id):
+        offset, limit = int(query.get('offset', 0)), int(query.get('limit', 50))
+        playlists = list(self.playlists.values())
+        items = [{
+            'id': playlist['id'],
+            'name': playlist['name'],
+            'owner': {'id': playlist['owner']},
+            'public': True,
+            'snapshot_id': _snapshot_id(playlist),
+            'tracks': {'total': len(playlist['tracks'])},
+        } for playlist in playlists[offset:offset + limit]]
+        return 200, _page(items, offset, limit, len(playlists),
+                          f"{self.url}users/{user_id}/playlists")
+
+    def playlist_items(self, query, playlist_id):
+        playlist = self.playlists.get(playlist_id)
+        if playlist is None:
+            return _error(404, "Not found.")
+        offset, limit = int(query.get('offset', 0)), int(query.get('limit', 100))
+        items = [{'track': self.tracks[index]}
+                 for index in playlist['tracks'][offset:offset + limit]]
+        return 200, _page(items, offset, limit, len(playlist['tracks']),
+                          f"{self.url}playlists/{playlist_id}/tracks")
+
+    def recently_played(self, query):
+        limit = int(query.get('limit', 20))
+        after = query.get('after')
+        with self._lock:
+            plays = list(self.recent_plays)
+
+        if after is not None:
+            newer = [play for play in plays if play[0] > int(after)]
+            selected = newer[:limit]
+            more = len(newer) > limit
+        else:
+            selected = plays[-limit:]
+            more = len(plays) > limit
+
+        items = [{
+            'track': self.tracks[index],
+            'played_at': _iso_timestamp(played_at),
+            'context': None,
+        } for played_at, index in reversed(selected)]
+        cursors = None
+        next_url = None
+        if selected:
+            cursors = {'after': str(selected[-1][0]), 'before': str(selected[0][0])}
+            if more:
+                cursor = {'after': cursors['after']} if after is not None \
+                    else {'before': cursors['before']}
+                next_url = (f"{self.url}me/player/recently-played?"
+                            f"{urlencode({**cursor, 'limit': limit})}")
+        return 200, {'items': items, 'limit': limit, 'cursors': cursors,
+                     'next': next_url, 'href': f"{self.url}me/player/recently-played"}
+
+    def top_items(self, query, item_type):
+        offset, limit = int(query.get('offset', 0)), int(query.get('limit', 20))
+        # Each time range ranks a differently shifted slice of the catalogue
+        shift = ('short_term', 'medium_term', 'long_term').index(
+            query.get('time_range', 'medium_term')) * 37
+        ranks = range(offset, min(offset + limit, self.top_item_count))
+        if item_type == 'tracks':
+            items = [self.tracks[(rank + shift) % TRACK_COUNT] for rank in ranks]
+        else:
+            items = [{
+                **self.tracks[(rank + shift) % TRACK_COUNT]['artists'][0],
+                'genres': ["synthetic"],
+                'popularity': 100 - rank % 100,
+            } for rank in ranks]
+        return 200, _page(items, offset, limit, self.top_item_count,
+                          f"{self.url}me/top/{item_type}")
+
+    def create_playlist(self, query, user_id):
+        with self._lock:
+            playlist = self._add_playlist(query.get('name', ''), user_id, [])
+        return 201, {'id': playlist['id'], 'name': playlist['name'],
+                     'owner': {'id': user_id},
+                     'snapshot_id': _snapshot_id(playlist)}
+
+    def add_items(self, query, playlist_id):
+        playlist = self.playlists.get(playlist_id)
+        if playlist is None:
+            return _error(404, "Not found.")
+        uris = query.get('uris', [])
+        if len(uris) > MAX_ADD_ITEMS:
+            return _error(400, "You can add a maximum of 100 tracks per request.")
+
+        indices = [catalogue_index(uri.rsplit(':', 1)[-1]) for uri in uris]
+        with self._lock:
+            position = query.get('position')
+            if position is None:
+                playlist['tracks'].extend(indices)
+            else:
+                position = int(position)
+                playlist['tracks'][position:position] = indices
+            playlist['version'] += 1
+        return 201, {'snapshot_id': _snapshot_id(playlist)}
+
+    def playlist(self, query, playlist_id):
+        playlist = self.playlists.get(playlist_id)
+        if playlist is None:
+            return _error(404, "Not found.")
+        return 200, {'id': playlist_id, 'name': playlist['name'],
+                     'owner': {'id': playlist['owner']},
+                     'snapshot_id': _snapshot_id(playlist)}
+
+    def remove_items(self, query, playlist_id):
+        playlist = self.playlists.get(playlist_id)
+        if playlist is None:
+            return _error(404, "Not found.")
+        tracks = query.get('tracks', [])
+        if len(tracks) > MAX_ADD_ITEMS:
+            return _error(400, "You can remove a maximum of 100 tracks per request.")
+
+        removed = {catalogue_index(track['uri'].rsplit(':', 1)[-1]) for track in tracks}
+        with self._lock:
+            playlist['tracks'] = [index for index in playlist['tracks']
+                                  if index not in removed]
+            playlist['version'] += 1
+        return 200, {'snapshot_id': _snapshot_id(playlist)}
+
+    def update_items(self, query, playlist_id):
+        """Replace the tracks when uris are given, otherwise reorder a range."""
+        playlist = self.playlists.get(playlist_id)
+        if playlist is None:
+            return _error(404, "Not found.")
+
+        with self._lock:
+            if 'uris' in query:
+                if len(query['uris']) > MAX_ADD_ITEMS:
+                    return _error(400, "You can add a maximum of 100 tracks per request.")
+                playlist['tracks'] = [catalogue_index(uri.rsplit(':', 1)[-1])
+                                      for uri in query['uris']]
+            else:
+                start = int(query['range_start'])
+                length = int(query.get('range_length', 1))
+                insert_before = int(query['insert_before'])
+                moved = playlist['tracks'][start:start + length]
+                del playlist['tracks'][start:start + length]
+                if insert_before > start:
+                    insert_before -= length
+                playlist['tracks'][insert_before:insert_before] = moved
+            playlist['version'] += 1
+        return 200, {'snapshot_id': _snapshot_id(playlist)}
+
+    def change_details(self, query, playlist_id):
+        if playlist_id not in self.playlists:
+            return _error(404, "Not found.")
+        return 200, None
+
+    def unfollow(self, query, playlist_id):
+        with self._lock:
+            self.playlists.pop(playlist_id, None)
+        return 200, None
+
+
+# (method, path pattern, FakeSpotify method, stats key)
+ROUTES = [
+    ('GET', r"me", 'me', 'me'),
+    ('GET', r"search", 'search', 'search'),
+    ('GET', r"users/(?P<user_id>[^/]+)/playlists", 'user_playlists', 'user_playlists'),
+    ('GET', r"playlists/(?P<playlist_id>[^/]+)/tracks", 'playlist_items', 'playlist_items'),
+    ('GET', r"me/player/recently-played", 'recently_played', 'recently_played'),
+    ('GET', r"me/top/(?P<item_type>tracks|artists)", 'top_items', 'top_items'),
+    ('POST', r"users/(?P<user_id>[^/]+)/playlists", 'create_playlist', 'create_playlist'),
+    ('GET', r"playlists/(?P<playlist_id>[^/]+)", 'playlist', 'playlist'),
+    ('POST', r"playlists/(?P<playlist_id>[^/]+)/tracks", 'add_items', 'add_items'),
+    ('DELETE', r"playlists/(?P<playlist_id>[^/]+)/tracks", 'remove_items', 'remove_items'),
+    ('PUT', r"playlists/(?P<playlist_id>[^/]+)/tracks", 'update_items', 'update_items'),
+    ('PUT', r"playlists/(?P<playlist_id>[^/]+)", 'change_details', 'change_details'),
+    ('DELETE', r"playlists/(?P<playlist_id>[^/]+)/followers", 'unfollow', 'unfollow'),
+]
+ROUTES = [(method, re.compile(f"/v1/{pattern}/?"), handler, key)
+          for method, pattern, handler, key in ROUTES]
+
+
+def _page(items, offset, limit, total, href):
+    next_url = None
+    if href and offset + limit < total:
+        next_url = f"{href}?{urlencode({'offset': offset + limit, 'limit': limit})}"
+    return {'items': items, 'offset': offset, 'limit': limit, 'total': total,
+            'next': next_url, 'href': href}
+
+
+def _snapshot_id(playlist):
+    return f"{playlist['id']}-{playlist['version']}"
+
+
+def epoch_ms(played_at):
+    """Return a naive UTC datetime as epoch milliseconds, like Spotify's cursors."""
+    return int(played_at.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def _iso_timestamp(milliseconds):
+    played_at = datetime.fromtimestamp(milliseconds / 1000, timezone.utc)
+    return played_at.strftime("%Y-%m-%dT%H:%M:%S.") + f"{milliseconds % 1000:03d}Z"
+
+
+def _error(status, message):
+    return status, {'error': {'status': status, 'message': message}}
+
+
+def _make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # Keep-alive, like api.spotify.com
+        # Headers and body are written separately, which Nagle's algorithm
+        # would hold back for a delayed ACK on every kept-alive response
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            self._dispatch('GET')
+
+        def do_POST(self):
+            self._dispatch('POST')
+
+        def do_PUT(self):
+            self._dispatch('PUT')
+
+        def do_DELETE(self):
+            self._dispatch('DELETE')
+
+        def _dispatch(self, method):
+            url = urlparse(self.path)
+            length = int(self.headers.get('Content-Length') or 0)
+            raw_body = self.rfile.read(length) if length else b''
+
+            if api.latency:
+                time.sleep(api.latency)
+
+            request_number = api._count('requests')
+            if api.rate_limit_every and request_number % api.rate_limit_every == 0:
+                api._count('rate_limited')
+                self._respond(*_error(429, "API rate limit exceeded"),
+                              headers={'Retry-After': str(api.retry_after)})
+                return
+
+            for route_method, pattern, handler, key in ROUTES:
+                match = pattern.fullmatch(url.path)
+                if route_method == method and match:
+                    break
+            else:
+                self._respond(*_error(404, "Service not found"))
+                return
+
+            api._count(key)
+            query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            limit = query.get('limit')
+            if key in api.max_limits and limit and int(limit) > api.max_limits[key]:
+                self._respond(*_error(400, "Invalid limit"))
+                return
+            if method != 'GET':
+                body = json.loads(raw_body) if raw_body else {}
+                # spotipy sends the tracks to add as a bare list of URIs
+                query.update(body if isinstance(body, dict) else {'uris': body})
+
+            try:
+                self._respond(*getattr(api, handler)(query, **match.groupdict()))
+            except Exception as e:
+                self._respond(*_error(500, f"{type(e).__name__}: {e}"))
+
+        def _respond(self, status, body, headers=None):
+            payload = json.dumps(body).encode() if body is not None else b''
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass  # Keep benchmark output readable
+
+    return Handler
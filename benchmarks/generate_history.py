@@ -0,0 +1,150 @@
+"""
+Synthetic play histories for the benchmarks.
+
+The same catalogue backs the fake Spotify server, so tracks searched for,
+downloaded or synced there match the tracks in a generated database.
+
+    python -m benchmarks.generate_history database/bench.db --plays 1000000
+"""
+import argparse
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+from scripts.database import DatabaseManager
+from scripts.records import PlayRecord, TrackRecord, to_epoch_ms
+
+TRACK_COUNT = 20000
+ARTIST_COUNT = 2000
+ALBUMS_PER_ARTIST = 4
+HISTORY_END = datetime(2026, 1, 1)
+MEAN_PLAY_GAP = timedelta(minutes=12)  # Average of the gaps synthetic_timeline draws
+BREAK_PROBABILITY = 1 / 25  # Chance that a play ends a listening session
+GENERATE_CHUNK_SIZE = 50000
+
+_tracks = []
+
+
+def spotify_id(kind, index):
+    """Return a 22 character id, e.g. 't000000000000000000042' for track 42."""
+    return f"{kind}{index:021d}"
+
+
+def catalogue_index(spotify_id):
+    """Return the catalogue index an id from spotify_id refers to."""
+    return int(spotify_id[1:])
+
+
+def synthetic_track(index):
+    """Return track number index of the catalogue as the Web API shows it."""
+    if index < len(_tracks):
+        return _tracks[index]
+
+    artist = index % ARTIST_COUNT
+    album = artist * ALBUMS_PER_ARTIST + index // ARTIST_COUNT % ALBUMS_PER_ARTIST
+    track_id = spotify_id('t', index)
+    return {
+        'id': track_id,
+        'uri': f"spotify:track:{track_id}",
+        'name': f"Song {index}",
+        'artists': [{'id': spotify_id('a', artist), 'name': f"Artist {artist}"}],
+        'album': {'id': spotify_id('b', album), 'name': f"Album {album}",
+                  'release_date': f"{1970 + album % 55}-01-01"},
+        'duration_ms': 120000 + index * 7919 % 240000,
+        'explicit': index % 7 == 0,
+        'popularity': index * 31 % 101,
+    }
+
+
+def catalogue():
+    """Return the whole track catalogue, built once."""
+    if not _tracks:
+        _tracks.extend(synthetic_track(index) for index in range(TRACK_COUNT))
+    return _tracks
+
+
+def synthetic_timeline(count, start, seed=0):
+    """
+    Yield (track index, played_at) for count plays from start on.
+
+    Popular tracks are played far more often than the rest, and every
+    few dozen plays a break ends the listening session.
+    """
+    tracks = catalogue()
+    rng = random.Random(seed)
+    played_at = start
+    for _ in range(count):
+        index = int(TRACK_COUNT * rng.random() ** 3)
+        # Spotify timestamps always have milliseconds
+        yield index, played_at.replace(microsecond=rng.randrange(1, 1000) * 1000)
+
+        gap = tracks[index]['duration_ms'] // 1000 + rng.randrange(20)
+        if rng.random() < BREAK_PROBABILITY:
+            gap += rng.randrange(35 * 60, 8 * 3600)
+        played_at += timedelta(seconds=gap)
+
+
+def synthetic_plays(count, start=None, seed=0):
+    """
+    Yield count PlayRecords, the plays of a track sharing one TrackRecord.
+
+    :param start: Time of the first play; by default the history ends
+        around HISTORY_END
+    """
+    start = start or HISTORY_END - count * MEAN_PLAY_GAP
+    tracks = [TrackRecord.from_api(track) for track in catalogue()]
+    for index, played_at in synthetic_timeline(count, start, seed):
+        yield PlayRecord(tracks[index], to_epoch_ms(played_at))
+
+
+def generate_history(database_path, plays, seed=0):
+    """
+    Create a spotify_plays.db with plays synthetic plays.
+
+    An existing file is left as it is, so a large history only has to be
+    generated once. The database is built under a temporary name and
+    moved into place when complete.
+
+    :return: Path of the database
+    """
+    if os.path.exists(database_path):
+        return database_path
+
+    partial_path = database_path + ".partial"
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(partial_path + suffix):
+            os.remove(partial_path + suffix)
+
+    database_manager = DatabaseManager(
+        partial_path,
+        backup_path=os.path.join(os.path.dirname(database_path) or ".", "csv_backups"))
+    try:
+        database_manager.insert_plays(synthetic_plays(plays, seed=seed),
+                                      chunk_size=GENERATE_CHUNK_SIZE)
+    finally:
+        database_manager.close()
+
+    os.replace(partial_path, database_path)
+    return database_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic play history database")
+    parser.add_argument('database', help="Database file to create")
+    parser.add_argument('--plays', type=int, default=100000,
+                        help="Number of plays, e.g. 10000 to 10000000")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if os.path.exists(args.database):
+        print(f"{args.database} already exists.")
+        return
+
+    start = time.perf_counter()
+    generate_history(args.database, args.plays, args.seed)
+    print(f"Generated {args.plays} plays in {time.perf_counter() - start:.1f} s.")
+
+
+if __name__ == "__main__":
+    main()
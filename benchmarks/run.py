@@ -0,0 +1,491 @@
+"""
+Time the main SpotifyManager and DatabaseManager operations.
+
+Spotify is replaced by the local server in fake_spotify and the play
+history by a synthetic database, so runs are repeatable and can be
+compared across commits:
+
+    python -m benchmarks.run --plays 1000000 --output before.json
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from itertools import islice
+
+from benchmarks.fake_spotify import FakeSpotify, epoch_ms
+from benchmarks.generate_history import (HISTORY_END, TRACK_COUNT, catalogue,
+                                         generate_history, synthetic_plays)
+from scripts.backend import IMPORT_CHUNK_SIZE, SpotifyManager, sync_accounts
+from scripts.database import DatabaseManager
+from scripts.records import from_epoch_ms, read_play_csv
+
+DATA_DIR = os.path.join(tempfile.gettempdir(), "spotify_benchmarks")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+# Columns of the plays.csv backup that import_play_history reads
+PLAY_CSV_COLUMNS = ['id', 'track_id', 'track_name', 'artist', 'album', 'year',
+                    'duration_ms', 'explicit', 'popularity', 'played_at', 'session_id']
+MISSING_SONG_SHARE = 10  # Every nth line of a playlist file is not on Spotify
+VARIANT_SHARE = 5        # Every nth line names its song differently from Spotify
+SONG_VARIANTS = ("{} (feat. Guest)", "{} - Remastered 2011", "{}!")
+# A popular track, a rare one, an artist, a prefix matching every track and no match
+SEARCH_QUERIES = ("Song 0", "Song 19999", "Artist 12", "So", "Nothing")
+
+
+class Context:
+    """Settings, the fake server and scratch files shared by the benchmarks."""
+
+    def __init__(self, args, server):
+        self.args = args
+        self.server = server
+        self.history_path = generate_history(
+            os.path.join(args.data_dir, f"history_{args.plays}.db"), args.plays)
+        self.scratch = tempfile.mkdtemp(prefix="run_", dir=args.data_dir)
+        self.databases = 0
+
+    def scratch_path(self, name):
+        return os.path.join(self.scratch, name)
+
+    def database(self, copy_history=False):
+        """Return a DatabaseManager on a new database, or on a copy of the history."""
+        self.databases += 1
+        database_path = self.scratch_path(f"plays_{self.databases}.db")
+        if copy_history:
+            shutil.copyfile(self.history_path, database_path)
+        return DatabaseManager(database_path,
+                               backup_path=self.scratch_path(f"backups_{self.databases}"))
+
+    def manager(self, database_manager=None):
+        """
+        Return a SpotifyManager that talks to the fake server.
+
+        The startup backup is waited for, so it does not run during the timing.
+        """
+        manager = SpotifyManager(database_manager=database_manager or self.database())
+        manager.backup_thread.join()
+        manager.sp = self.server.client()
+        return manager
+
+    def cleanup(self):
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+
+
+def play_csv_file(context):
+    """Return a plays.csv file of --import-rows synthetic plays, written once."""
+    rows = min(context.args.plays, context.args.import_rows)
+    file_path = os.path.join(context.args.data_dir, f"plays_{rows}.csv")
+    if not os.path.exists(file_path):
+        with open(file_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, delimiter=';')
+            writer.writerow(PLAY_CSV_COLUMNS)
+            for number, play in enumerate(synthetic_plays(rows), 1):
+                track = play.track
+                writer.writerow([number, track.spotify_id, track.name, track.artist, track.album,
+                                 track.year, track.duration_ms, track.explicit,
+                                 track.popularity, from_epoch_ms(play.played_at), ''])
+    return file_path
+
+
+def bench_import_history(context):
+    """Import a plays.csv file into an empty database."""
+    file_path = play_csv_file(context)
+    manager = context.manager()
+    with Timer() as timer, contextlib.redirect_stdout(io.StringIO()):
+        read, stored = manager.import_play_history(file_path)
+    return timer, {'rows': read, 'rows_per_second': read / timer.seconds}
+
+
+def bench_import_memory(context):
+    """
+    Memory of the plays parsed by an import: the bytes and allocated blocks
+    each play of the second chunk holds while the chunk waits to be stored,
+    and the peak of a whole import. Timed with tracemalloc on, so only
+    compare the time with itself.
+    """
+    file_path = play_csv_file(context)
+    with open(file_path, newline='', encoding='utf-8') as f:
+        plays = read_play_csv(csv.reader(f, delimiter=';'))
+        tracemalloc.start()
+        try:
+            list(islice(plays, IMPORT_CHUNK_SIZE))
+            before = tracemalloc.take_snapshot()
+            chunk = list(islice(plays, IMPORT_CHUNK_SIZE))
+            statistics_diff = tracemalloc.take_snapshot().compare_to(before, 'filename')
+        finally:
+            tracemalloc.stop()
+    held_bytes = sum(stat.size_diff for stat in statistics_diff)
+    held_blocks = sum(stat.count_diff for stat in statistics_diff)
+    del chunk
+
+    manager = context.manager()
+    tracemalloc.start()
+    try:
+        with Timer() as timer, contextlib.redirect_stdout(io.StringIO()):
+            read, _ = manager.import_play_history(file_path)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return timer, {'rows': read,
+                   'bytes_per_play': held_bytes / IMPORT_CHUNK_SIZE,
+                   'blocks_per_play': held_blocks / IMPORT_CHUNK_SIZE,
+                   'import_peak_bytes': peak}
+
+
+def bench_user_playlists(context):
+    """Page through the user's playlists."""
+    manager = context.manager()
+    with Timer() as timer:
+        playlists = manager.fetch_user_playlists(refresh=True)
+    return timer, {'playlists': len(playlists)}
+
+
+def bench_download_playlist(context):
+    """Write every track of one playlist to a CSV file."""
+    manager = context.manager()
+    playlist = manager.fetch_user_playlists()[0]
+    context.server.reset_stats()
+    try:
+        with Timer() as timer:
+            tracks = manager.save_playlist_to_file(playlist)
+    finally:
+        # save_playlist_to_file writes next to the scripts directory
+        os.remove(os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), f"{playlist['name']}.csv"))
+    return timer, {'tracks': tracks}
+
+
+def write_song_file(context, size):
+    """
+    Write a playlist file of size songs and return its path.
+
+    Every MISSING_SONG_SHARE-th song is not on Spotify, and every
+    VARIANT_SHARE-th one is written the way exact searches miss.
+    """
+    file_path = context.scratch_path("songs.csv")
+    tracks = catalogue()
+    with open(file_path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f, delimiter=';')
+        for number in range(size):
+            track = tracks[number * 7 % TRACK_COUNT]
+            song = track['name'] if number % MISSING_SONG_SHARE else f"Unknown {number}"
+            if number % VARIANT_SHARE == 1:
+                song = SONG_VARIANTS[number // VARIANT_SHARE % len(SONG_VARIANTS)].format(song)
+            writer.writerow([song, track['artists'][0]['name']])
+    return file_path
+
+
+def import_songs(context, manager):
+    """Import the song file with manager and return (timer, details)."""
+    size = context.args.import_songs
+    file_path = write_song_file(context, size)
+    context.server.reset_stats()
+    with Timer() as timer:
+        success, message = manager.import_playlist_from_file(
+            file_path, ';', "Benchmark import", "")
+    if not success:
+        raise RuntimeError(message)
+    matched = max(len(playlist['tracks']) for playlist in context.server.playlists.values()
+                  if playlist['name'] == "Benchmark import")
+    return timer, {'songs': size, 'matched': matched}
+
+
+def bench_import_playlist(context):
+    """Create a playlist from a song file, searching every song."""
+    return import_songs(context, context.manager())
+
+
+def bench_import_playlist_known(context):
+    """Create a playlist from a song file whose songs are mostly in the play history."""
+    manager = context.manager(context.database(copy_history=True))
+    manager.get_track_index()  # Built once per session, like the cache it is
+    return import_songs(context, manager)
+
+
+def bench_sync_playlist(context):
+    """Sync a file with two changed lines into a playlist synced from it before."""
+    manager = context.manager()
+    playlist = manager.fetch_user_playlists()[0]
+    tracks = catalogue()
+    indexes = list(context.server.playlists[playlist['id']]['tracks'])
+    file_path = context.scratch_path("playlist.csv")
+
+    def write_file():
+        with open(file_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, delimiter=';')
+            for index in indexes:
+                writer.writerow([tracks[index]['name'], tracks[index]['artists'][0]['name']])
+
+    write_file()
+    success, message = manager.sync_playlist_from_file(file_path, ';', playlist)
+    indexes[len(indexes) // 2] = (indexes[0] + TRACK_COUNT // 2) % TRACK_COUNT
+    indexes.insert(1, (indexes[0] + TRACK_COUNT // 3) % TRACK_COUNT)
+    write_file()
+
+    context.server.reset_stats()
+    with Timer() as timer:
+        success, message = manager.sync_playlist_from_file(file_path, ';', playlist)
+    if not success:
+        raise RuntimeError(message)
+    return timer, {'tracks': len(indexes)}
+
+
+def bench_export_playlists(context):
+    """Export every playlist again after a few of them changed."""
+    manager = context.manager()
+    directory = context.scratch_path("playlists")
+    with Timer() as first:
+        manager.export_all_playlists(directory)
+    changed = list(context.server.playlists.values())[:context.args.changed_playlists]
+    for playlist in changed:
+        playlist['tracks'].append(0)
+        playlist['version'] += 1
+
+    context.server.reset_stats()
+    with Timer() as timer:
+        written, downloaded = manager.export_all_playlists(directory)
+    shutil.rmtree(directory)
+    return timer, {'playlists': written, 'downloaded': downloaded,
+                   'first_export_seconds': first.seconds}
+
+
+def bench_top_items(context):
+    """Collect every top items ranking twice; the second run finds them unchanged."""
+    manager = context.manager(context.database())
+    with Timer() as first:
+        items, new_rankings = manager.collect_top_items()
+    context.server.reset_stats()
+    with Timer() as timer:
+        _, unchanged_new_rankings = manager.collect_top_items()
+    return timer, {'items': items, 'new_rankings': new_rankings,
+                   'unchanged_new_rankings': unchanged_new_rankings,
+                   'first_collect_seconds': first.seconds}
+
+
+def bench_sync(context):
+    """Store every play the fake server has after the history ends."""
+    manager = context.manager(context.database(copy_history=True))
+    manager.database_manager.set_metadata(
+        manager._sync_cursor_key(), epoch_ms(HISTORY_END) - 1)
+    context.server.reset_stats()
+    with Timer() as timer:
+        stored = manager.sync_recent_plays()
+    return timer, {'stored': stored}
+
+
+def bench_sync_accounts(context):
+    """Sync the recent plays of many accounts into one database with sync_accounts."""
+    database_manager = context.database(copy_history=True)
+    managers = []
+    for number in range(context.args.accounts):
+        manager = context.manager(database_manager)
+        manager.user_id = f"account{number}"
+        database_manager.add_account(manager.user_id)
+        database_manager.set_metadata(manager._sync_cursor_key(), epoch_ms(HISTORY_END) - 1)
+        managers.append(manager)
+    with Timer() as timer:
+        results = sync_accounts(managers)
+    failed = [error for error in results.values() if isinstance(error, Exception)]
+    if failed:
+        raise failed[0]
+    return timer, {'accounts': len(managers), 'stored': sum(results.values())}
+
+
+def bench_backup_full(context):
+    """Snapshot and compress the whole history."""
+    database_manager = context.database(copy_history=True)
+    with Timer() as timer:
+        database_manager.backup_full()
+    database_manager.close()
+    return timer, {'plays': context.args.plays}
+
+
+def bench_backup_incremental(context):
+    """Back up the plays added since a full snapshot."""
+    new_plays = context.args.new_plays
+    database_manager = context.database(copy_history=True)
+    database_manager.backup_full()
+    database_manager.insert_plays(synthetic_plays(new_plays, HISTORY_END, seed=2))
+    with Timer() as timer:
+        database_manager.backup_incremental()
+    database_manager.close()
+    return timer, {'plays': new_plays}
+
+
+def bench_recent_plays(context):
+    """Page back through the play history with get_recent_plays."""
+    pages = context.args.pages
+    database_manager = DatabaseManager(context.history_path,
+                                       backup_path=context.scratch_path("backups"))
+    database_manager.conn  # Open and check the database before timing
+    page_seconds = []
+    before = None
+    with Timer() as timer:
+        for _ in range(pages):
+            start = time.perf_counter()
+            plays = database_manager.get_recent_plays(limit=50, before=before)
+            page_seconds.append(time.perf_counter() - start)
+            if not plays:
+                break
+            before = plays[-1][3]
+    database_manager.close()
+    return timer, {'pages': len(page_seconds),
+                   'first_page_seconds': page_seconds[0],
+                   'median_page_seconds': statistics.median(page_seconds)}
+
+
+def bench_search_history(context):
+    """Search the play history for tracks, artists and albums."""
+    database_manager = DatabaseManager(context.history_path,
+                                       backup_path=context.scratch_path("backups"))
+    database_manager.conn  # Open and check the database before timing
+    query_seconds = {}
+    with Timer() as timer:
+        for query in SEARCH_QUERIES:
+            start = time.perf_counter()
+            database_manager.search_tracks(query)
+            database_manager.search_history(query)
+            query_seconds[query] = time.perf_counter() - start
+    database_manager.close()
+    return timer, {'query_seconds': query_seconds}
+
+
+BENCHMARKS = {
+    'import_history': bench_import_history,
+    'import_memory': bench_import_memory,
+    'user_playlists': bench_user_playlists,
+    'download_playlist': bench_download_playlist,
+    'import_playlist': bench_import_playlist,
+    'import_playlist_known': bench_import_playlist_known,
+    'sync_playlist': bench_sync_playlist,
+    'export_playlists': bench_export_playlists,
+    'top_items': bench_top_items,
+    'sync': bench_sync,
+    'sync_accounts': bench_sync_accounts,
+    'backup_full': bench_backup_full,
+    'backup_incremental': bench_backup_incremental,
+    'recent_plays': bench_recent_plays,
+    'search_history': bench_search_history,
+}
+
+
+def run_benchmark(context, benchmark, repeat):
+    """Run a benchmark repeat times and summarize its timings."""
+    runs = []
+    details = {}
+    for _ in range(repeat):
+        context.server.reset_stats()
+        timer, details = benchmark(context)
+        runs.append(timer.seconds)
+    requests = dict(context.server.stats)
+    if requests:
+        details['requests'] = requests
+    return {
+        'median_seconds': statistics.median(runs),
+        'min_seconds': min(runs),
+        'runs': runs,
+        **details,
+    }
+
+
+def git_revision():
+    """Return (commit, whether the work tree has changes), or (None, None)."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Spotify Manager against a fake Spotify API")
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, help="Benchmarks to run")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--plays', type=int, default=100000,
+                        help="Size of the synthetic play history")
+    parser.add_argument('--data-dir', default=DATA_DIR,
+                        help="Where generated histories are kept between runs")
+    parser.add_argument('--output', help="Result file; by default one per commit in benchmarks/results")
+    server_options = parser.add_argument_group("fake Spotify API")
+    server_options.add_argument('--latency', type=float, default=0.02,
+                                help="Seconds added to every request")
+    server_options.add_argument('--rate-limit-every', type=int, default=0,
+                                help="Answer every nth request with 429")
+    server_options.add_argument('--playlists', type=int, default=100)
+    server_options.add_argument('--playlist-size', type=int, default=2000)
+    workload = parser.add_argument_group("workload")
+    workload.add_argument('--import-rows', type=int, default=100000,
+                          help="Rows of the imported plays.csv, at most --plays")
+    workload.add_argument('--import-songs', type=int, default=100,
+                          help="Lines of the playlist file to import")
+    workload.add_argument('--new-plays', type=int, default=1000,
+                          help="Plays waiting to be synced or backed up incrementally")
+    workload.add_argument('--changed-playlists', type=int, default=5,
+                          help="Playlists changed between two exports of all playlists")
+    workload.add_argument('--accounts', type=int, default=50,
+                          help="Accounts synced at once by sync_accounts")
+    workload.add_argument('--pages', type=int, default=20,
+                          help="Pages of recent plays to read")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    commit, dirty = git_revision()
+    server = FakeSpotify(latency=args.latency, rate_limit_every=args.rate_limit_every,
+                         playlist_count=args.playlists, playlist_size=args.playlist_size,
+                         recent_plays=args.new_plays)
+
+    results = {}
+    context = Context(args, server)
+    try:
+        with server:
+            for name in args.only or BENCHMARKS:
+                print(f"{name}...", end=' ', flush=True)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    results[name] = run_benchmark(context, BENCHMARKS[name], args.repeat)
+                print(f"{results[name]['median_seconds']:.3f} s")
+    finally:
+        context.cleanup()
+
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': vars(args),
+        'results': results,
+    }
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR,
+                              f"{datetime.now():%Y%m%d_%H%M%S}_{commit or 'unknown'}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,10 @@
 # Spotify credentials
 client_id = 'your_client_id'
 client_secret = 'your_client_secret'
-redirect_uri = 'http://localhost:8080/callback/'  # Or another redirect URI as per your Spotify app settings
\ No newline at end of file
+redirect_uri = 'http://localhost:8080/callback/'  # Or another redirect URI as per your Spotify app settings
+
+# Timezone used for daily listening statistics
+timezone = 'UTC'  # For example 'Europe/Helsinki'
+
+# Record API and database timings, shown with "Show Stats" in the menu
+metrics = True
@@ -1,3 +1,3 @@
 @echo off
 set PYTHONPATH=%PYTHONPATH%;your_path
-python -c "from scripts.backend import SpotifyManager; SpotifyManager().update_play_history()"
\ No newline at end of file
+python -m scripts.cli sync
\ No newline at end of file
@@ -1,240 +1,668 @@
-import config
-from scripts.database import DatabaseManager
+from scripts.database import (DEFAULT_USER, TOP_ITEM_TYPES, TOP_TIME_RANGES, DatabaseManager,
+                              normalize_search_query)
+from scripts.records import ArtistRecord, PlayRecord, TrackRecord, read_play_csv
+from scripts.track_index import MATCH_THRESHOLD, TrackIndex
 import _csv
-import spotipy
-from spotipy.oauth2 import SpotifyOAuth, CacheFileHandler
 import csv
+from bisect import bisect_left
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from itertools import islice
 import os
+import queue
+import re
+import threading
+import time
+
+SEARCH_WORKERS = 8  # Concurrent track searches during playlist imports
+PAGE_WORKERS = 4    # Concurrent page requests when paging through results
+IMPORT_CHUNK_SIZE = 10000  # Rows committed per transaction by CSV imports
+SYNC_MIN_INTERVAL = 120    # Seconds between syncs while music is playing
+SYNC_MAX_INTERVAL = 1800   # Longest idle wait; 50 plays never fit into it
+ACCOUNT_WORKERS = 16       # Accounts fetched at once by sync_accounts
+PLAYLIST_BATCH_SIZE = 100  # Most tracks one playlist request may add or remove
+PLAYLIST_WORKERS = 4       # Playlists downloaded at once by export_all_playlists
+TOP_ITEMS_PAGE_SIZE = 50   # Largest page the top items endpoints return
+TOP_ITEMS_WORKERS = 6      # Rankings fetched at once by collect_top_items
+
+# Only the playlist item fields stored by refresh_stored_playlist
+PLAYLIST_ITEM_FIELDS = ("total,items(track(id,uri,name,artists(id,name),"
+                        "album(id,name,release_date),duration_ms,explicit,popularity))")
+
+
+def _iter_pages(fetch_page, limit, max_workers=PAGE_WORKERS):
+    """
+    Yield every page of a paginated endpoint in order.
+
+    The first page tells the total; the remaining offsets are fetched
+    concurrently with at most max_workers requests in flight.
+
+    :param fetch_page: Callable taking an offset and returning a page dict
+        with 'items' and 'total'
+    :param limit: Page size used by fetch_page
+    """
+    first = fetch_page(0)
+    yield first
+
+    offsets = iter(range(limit, first['total'], limit))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque(executor.submit(fetch_page, offset)
+                        for offset in islice(offsets, max_workers))
+        while pending:
+            page = pending.popleft().result()
+            for offset in islice(offsets, 1):
+                pending.append(executor.submit(fetch_page, offset))
+            yield page
+
+
+def _file_name(name):
+    """Replace the characters file systems do not allow in a playlist name."""
+    return re.sub(r'[\\/:*?"<>|]', '_', name).strip() or "playlist"
+
+
+def _occurrence_keys(uris):
+    """Pair each URI with how often it occurred before, so duplicates differ."""
+    seen = Counter()
+    keys = []
+    for uri in uris:
+        keys.append((uri, seen[uri]))
+        seen[uri] += 1
+    return keys
+
+
+def _longest_increasing_run(values):
+    """Return the indexes of a longest strictly increasing subsequence of values."""
+    tails = []        # Index of the smallest tail of an increasing run of each length
+    tail_values = []
+    previous = [None] * len(values)
+    for index, value in enumerate(values):
+        length = bisect_left(tail_values, value)
+        if length:
+            previous[index] = tails[length - 1]
+        if length == len(tails):
+            tails.append(index)
+            tail_values.append(value)
+        else:
+            tails[length] = index
+            tail_values[length] = value
+
+    indexes = set()
+    index = tails[-1] if tails else None
+    while index is not None:
+        indexes.add(index)
+        index = previous[index]
+    return indexes
+
+
+def _missing_runs(desired_keys, present):
+    """Return (position, URIs) of each run of desired tracks not yet present."""
+    runs = []
+    for position, key in enumerate(desired_keys):
+        if key in present:
+            continue
+        if runs and runs[-1][0] + len(runs[-1][1]) == position:
+            runs[-1][1].append(key[0])
+        else:
+            runs.append((position, [key[0]]))
+    return runs
+
 
 class SpotifyManager:
-    def __init__(self, get_playlists=False):
-        self.database_manager = DatabaseManager()
-        self.database_manager.check_and_backup()
+    def __init__(self, get_playlists=False, database_manager=None, user_id=DEFAULT_USER):
+        """
+        :param database_manager: Database to use instead of the default one
+        :param user_id: Account to act for; each one has its own token cache
+            and play history
+        """
+        self.user_id = user_id
+        self.database_manager = database_manager or DatabaseManager()
+        # Backing up can take a while on a long history, so it runs
+        # alongside the menu instead of before it
+        self.backup_thread = self.database_manager.start_background_backup()
 
         self.sp = None
-        self.current_scope = None  # Track the current scope
         self.current_playlist = None
+        self.playlists = None  # Cached result of fetch_user_playlists
+        self.track_index = None  # Known tracks, built by get_track_index
+        self._track_index_version = None
 
         if get_playlists:
-            self.playlists = self.fetch_user_playlists()
-        else:
-            self.playlists = None
+            self.fetch_user_playlists()
 
     def authenticate_spotify(self, scope=None):
-        """Authenticate with Spotify and return a Spotipy client."""
-        if scope != self.current_scope:
-            cache_handler = CacheFileHandler(cache_path="../.cache")
-            self.sp = spotipy.Spotify(auth_manager=SpotifyOAuth(
-                client_id=config.client_id,
-                client_secret=config.client_secret,
-                redirect_uri=config.redirect_uri,
-                scope=scope,
-                cache_handler=cache_handler,
-            ))
-            self.current_scope = scope  # Update the current scope
+        """
+        Return the Spotify client, creating it on first use.
+
+        The client is authorized once for every scope in client.SCOPES, so
+        scope only states what the caller needs.
+        """
+        # spotipy is slow to import, so load it only once it is needed
+        from scripts.client import SCOPES, account_cache_path, create_client
+
+        missing = set(scope.split()) - set(SCOPES) if scope else set()
+        if missing:
+            raise ValueError(f"Scopes missing from client.SCOPES: {', '.join(sorted(missing))}")
+
+        if self.sp is None:
+            self.sp = create_client(cache_path=account_cache_path(self.user_id))
 
         return self.sp
 
-    def fetch_user_playlists(self):
+    def fetch_user_playlists(self, refresh=False):
+        """
+        Return the playlists owned by the user.
+
+        :param refresh: Refetch from Spotify instead of using the cached list
+        """
+        if self.playlists is not None and not refresh:
+            return self.playlists
+
         self.authenticate_spotify("user-library-read playlist-read-private")
         user_id = self.sp.current_user()['id']
 
         limit = 50
-        offset = 0
 
-        playlists = self.sp.user_playlists(user=user_id, limit=limit, offset=offset)
-        playlist_items = playlists['items']
+        def fetch_page(offset):
+            return self.sp.user_playlists(user=user_id, limit=limit, offset=offset)
+
         user_playlists = []
 
-        for playlist in playlist_items:
-            if playlist is None:
-                continue
+        for page in _iter_pages(fetch_page, limit):
+            for playlist in page['items']:
+                if playlist is None:
+                    continue
 
-            owner = playlist['owner']
-            if owner['id'] == user_id:
-                user_playlists.append(playlist)
+                owner = playlist['owner']
+                if owner['id'] == user_id:
+                    user_playlists.append(playlist)
 
+        self.playlists = user_playlists
         return user_playlists
 
     def select_playlist(self, playlist):
         self.current_playlist = playlist
 
-    def save_playlist_to_file(self, playlist):
-        """Download songs from a playlist and save them to a text file."""
+    def refresh_stored_playlist(self, playlist, snapshot_id=None):
+        """
+        Bring the local copy of a playlist up to date. Its tracks are only
+        downloaded when the playlist's snapshot_id differs from the stored one.
+
+        :param snapshot_id: Current snapshot_id of the playlist, asked from
+            Spotify when not given
+        :return: True if the tracks were downloaded
+        """
         self.authenticate_spotify("playlist-read-private")
         playlist_id = playlist['id']
+        if snapshot_id is None:
+            snapshot_id = self.sp.playlist(playlist_id, fields='snapshot_id')['snapshot_id']
+        if snapshot_id == self.database_manager.get_stored_playlist_snapshot(playlist_id):
+            return False
 
-        offset = 0
         limit = 100
-        all_tracks = []
 
-        while True:
-            results = self.sp.playlist_items(playlist_id, offset=offset, limit=limit, additional_types='track')
-            tracks = results['items']
+        def fetch_page(offset):
+            return self.sp.playlist_items(playlist_id, offset=offset, limit=limit,
+                                          fields=PLAYLIST_ITEM_FIELDS,
+                                          additional_types='track')
 
-            if not tracks:
-                break
-            all_tracks.extend(tracks)
-            offset += limit
-
-        track_data = [
-            ["track_id","track_name","artist","album","year",
-                      "duration_ms","explicit","popularity"]
-            ]
+        # Pages are stored as they arrive so memory use stays flat. Later
+        # imports can also match these tracks without searching.
+        pages = ([TrackRecord.from_api(item['track']) for item in page['items'] if item['track']]
+                 for page in _iter_pages(fetch_page, limit))
+        self.database_manager.store_playlist(playlist_id, playlist['name'], snapshot_id, pages)
+        return True
 
-        for item in all_tracks:
-            track = item['track']
-            line = [
-                track['id'],
-                track['name'],
-                track['artists'][0]['name'],
-                track['album']['name'],
-                track['album']['release_date'][:4],
-                track['duration_ms'],
-                track['explicit'],
-                track['popularity']
-            ]
-            track_data.append(line)
-
-        file_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        filename = f"{playlist['name']}.csv"
-        full_path = os.path.join(file_path, filename)
+    def save_playlist_to_file(self, playlist, directory=None, snapshot_id=None):
+        """
+        Save the songs of a playlist to a CSV file, downloading them only if
+        the playlist changed since they were last downloaded.
 
+        :param directory: Where to write the file; the project root by default
+        :param snapshot_id: Passed on to refresh_stored_playlist
+        :return: Number of songs written
+        """
+        self.refresh_stored_playlist(playlist, snapshot_id)
+        directory = directory or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return self._write_playlist_file(
+            playlist['id'], os.path.join(directory, f"{_file_name(playlist['name'])}.csv"))
+
+    def _write_playlist_file(self, playlist_id, full_path):
+        """Write the stored copy of a playlist to a CSV file and return its number of songs."""
+        track_count = 0
         with open(full_path, 'w', encoding='utf-8', errors='ignore', newline='') as f:
             writer = csv.writer(f, delimiter=';')
-            writer.writerows(track_data)
+            writer.writerow(["track_id","track_name","artist","album","year",
+                             "duration_ms","explicit","popularity"])
+            for tracks in self.database_manager.iter_playlist_tracks(playlist_id):
+                for track_id, name, artist, album, year, duration_ms, explicit, popularity in tracks:
+                    writer.writerow([track_id, name, artist, album, year, duration_ms,
+                                     bool(explicit) if explicit is not None else None,
+                                     popularity])
+                track_count += len(tracks)
+        return track_count
+
+    def export_all_playlists(self, directory, max_workers=PLAYLIST_WORKERS):
+        """
+        Save every playlist of the user to a CSV file in directory.
+
+        Only the playlists changed since their last download are fetched,
+        several at once. The files of the others are written from their
+        local copies, or left as they are if they already exist.
 
-        return len(all_tracks)
+        :param max_workers: Maximum number of playlists downloaded at once
+        :return: (playlists saved, playlists downloaded)
+        """
+        playlists = self.fetch_user_playlists(refresh=True)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            downloaded = list(executor.map(
+                lambda playlist: self.refresh_stored_playlist(playlist, playlist['snapshot_id']),
+                playlists))
+
+        os.makedirs(directory, exist_ok=True)
+        names = Counter()
+        for playlist, changed in zip(playlists, downloaded):
+            name = _file_name(playlist['name'])
+            names[name] += 1
+            if names[name] > 1:
+                name = f"{name} ({names[name]})"
+            full_path = os.path.join(directory, f"{name}.csv")
+            if changed or not os.path.exists(full_path):
+                self._write_playlist_file(playlist['id'], full_path)
+        return len(playlists), sum(downloaded)
+
+    def search_track_uri(self, song, artist):
+        """Return the URI of the best search match for a song, or None."""
+        query = f"track:{song} artist:{artist}"
+        result = self.sp.search(q=query, type='track', limit=1, offset=0)
+
+        if result['tracks']['items']:
+            return result['tracks']['items'][0]['uri']
+
+        return None
+
+    def get_track_index(self):
+        """Return the index of known tracks, rebuilt once new tracks are stored."""
+        version = self.database_manager.get_tracks_version()
+        if self.track_index is None or version != self._track_index_version:
+            self.track_index = TrackIndex(self.database_manager.get_known_tracks())
+            self._track_index_version = version
+        return self.track_index
+
+    def resolve_track_uris(self, songs, max_workers=SEARCH_WORKERS,
+                           progress_callback=None, match_threshold=MATCH_THRESHOLD):
+        """
+        Find the URIs of many (song, artist) pairs.
+
+        Lines are matched against the tracks in the database first, then
+        looked up in the search cache, and only the rest are searched,
+        concurrently.
+
+        :param songs: List of (song, artist) tuples
+        :param max_workers: Maximum number of searches in flight at once
+        :param progress_callback: Optional callable taking
+            (completed, total, song, artist, uri), called as each line is resolved
+        :param match_threshold: Lowest score from 0 to 1 a local match is used at
+        :return: List of URIs (None when not found) in the order of songs
+        """
+        # Identical lines only need to be searched once
+        originals = {}
+        for song, artist in songs:
+            originals.setdefault(normalize_search_query(song, artist),
+                                 (song, artist))
+
+        # Tracks played or downloaded before need no search at all
+        track_index = self.get_track_index()
+        found = {}
+        for key, (song, artist) in originals.items():
+            spotify_id, score = track_index.best_match(song, artist)
+            if score >= match_threshold:
+                found[key] = f"spotify:track:{spotify_id}"
+
+        # Earlier imports already answered most of the other lines
+        found.update(self.database_manager.get_cached_track_uris(
+            key for key in originals if key not in found))
+        completed = 0
+        for key, uri in found.items():
+            completed += 1
+            if progress_callback:
+                progress_callback(completed, len(originals),
+                                  *originals[key], uri)
+
+        searched = {}
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(self.search_track_uri, *originals[key]): key
+                    for key in originals if key not in found
+                }
+                for future in as_completed(futures):
+                    key = futures[future]
+                    searched[key] = future.result()
+                    completed += 1
+                    if progress_callback:
+                        progress_callback(completed, len(originals),
+                                          *originals[key], searched[key])
+        finally:
+            # Keep whatever was resolved even if a search failed
+            self.database_manager.cache_track_uris(searched)
+        found.update(searched)
+
+        return [found[normalize_search_query(song, artist)]
+                for song, artist in songs]
+
+    def read_song_file(self, input_file, separator):
+        """
+        Read the (song, artist) lines of a playlist file.
+
+        :param separator: Column separator, or "Auto" to detect it
+        :raises ValueError: If the separator cannot be detected
+        """
+        songs = []
+        with open(input_file, 'r', encoding='utf-8') as file:
+            if separator == "Auto":
+                try:
+                    sample = file.read(1024)
+                    sniffer = csv.Sniffer()
+                    separator = sniffer.sniff(sample).delimiter
+                    file.seek(0)
+
+                except _csv.Error:
+                    raise ValueError("Error detecting the separator. Enter separator manually.")
+
+            reader = csv.reader(file, delimiter=separator)
+            for row in reader:
+                if len(row) == 2:
+                    songs.append((row[0].strip(), row[1].strip()))
+        return songs
 
     def import_playlist_from_file(self, input_file, separator, playlist_name,
-                                  playlist_description):
-        """Create a Spotify playlist from a file containing song names and artists."""
+                                  playlist_description,
+                                  max_workers=SEARCH_WORKERS,
+                                  progress_callback=None):
+        """
+        Create a Spotify playlist from a file containing song names and artists.
+
+        :param max_workers: Maximum number of concurrent track searches
+        :param progress_callback: Passed on to resolve_track_uris
+        """
         try:
             self.authenticate_spotify("playlist-modify-public")
             user_id = self.sp.current_user()['id']
 
-            def get_track_uri(song, artist):
-                query = f"track:{song} artist:{artist}"
-                print(f"Searching for: {query}")
-                result = self.sp.search(q=query, type='track', limit=1,
-                                        offset=0)
-
-                if result['tracks']['items']:
-                    print(
-                        f"Found track: {result['tracks']['items'][0]['name']}")
-                    return result['tracks']['items'][0]['uri']
-
-                else:
-                    print(f"No match found for {song} by {artist}")
-
-                return None
-
-            song_uris = []
-            with open(input_file, 'r', encoding='utf-8') as file:
-                if separator == "Auto":
-                    try:
-                        sample = file.read(1024)
-                        sniffer = csv.Sniffer()
-                        separator = sniffer.sniff(sample).delimiter
-                        file.seek(0)
-
-                    except _csv.Error:
-                        return False, "Error detecting the separator. Enter separator manually."
-
-                reader = csv.reader(file, delimiter=separator)
-                for row in reader:
-                    if len(row) == 2:
-                        song_name = row[0].strip()
-                        artist_name = row[1].strip()
-                        track_uri = get_track_uri(song_name, artist_name)
-                        if track_uri:
-                            song_uris.append(track_uri)
+            songs = self.read_song_file(input_file, separator)
+            song_uris = [
+                uri for uri in self.resolve_track_uris(songs, max_workers,
+                                                       progress_callback)
+                if uri
+            ]
 
             if song_uris:
                 new_playlist = self.sp.user_playlist_create(user=user_id,
                                                             name=playlist_name,
                                                             public=True,
                                                             description=playlist_description)
-                self.sp.playlist_add_items(new_playlist['id'], song_uris)
+                snapshot_id = new_playlist['snapshot_id']
+                # Spotify takes at most PLAYLIST_BATCH_SIZE tracks per request
+                for start in range(0, len(song_uris), PLAYLIST_BATCH_SIZE):
+                    snapshot_id = self.sp.playlist_add_items(
+                        new_playlist['id'],
+                        song_uris[start:start + PLAYLIST_BATCH_SIZE])['snapshot_id']
+                # Syncing the same file into it later then costs nothing
+                self.database_manager.set_playlist_sync(new_playlist['id'], snapshot_id,
+                                                        song_uris)
+                self.playlists = None  # The cached list is now out of date
                 return True, f"Playlist '{playlist_name}' created successfully with {len(song_uris)} songs."
 
             else:
                 return False, "No songs found in the file."
 
+        except ValueError as e:
+            return False, str(e)
+
         except Exception as e:
             return False, f"An error occurred: {e}"
 
+    def fetch_playlist_uris(self, playlist_id):
+        """Return the track URIs of a playlist in order, None for unavailable items."""
+        limit = 100
+
+        def fetch_page(offset):
+            return self.sp.playlist_items(playlist_id, offset=offset, limit=limit,
+                                          fields="total,items(track(uri))",
+                                          additional_types='track')
+
+        return [item['track']['uri'] if item['track'] else None
+                for page in _iter_pages(fetch_page, limit)
+                for item in page['items']]
+
+    def sync_playlist_from_file(self, input_file, separator, playlist,
+                                max_workers=SEARCH_WORKERS, progress_callback=None):
+        """
+        Make an existing playlist hold the songs of a file, in file order.
+
+        Only the difference to the playlist's current tracks is sent. When
+        the playlist still has the snapshot_id recorded by the last sync,
+        its tracks are known without fetching them.
+
+        :param playlist: Playlist dictionary as returned by fetch_user_playlists
+        :param max_workers: Maximum number of concurrent track searches
+        :param progress_callback: Passed on to resolve_track_uris
+        :return: (success, message)
+        """
+        try:
+            self.authenticate_spotify("playlist-modify-public playlist-modify-private")
+            playlist_id = playlist['id']
+
+            songs = self.read_song_file(input_file, separator)
+            song_uris = [
+                uri for uri in self.resolve_track_uris(songs, max_workers,
+                                                       progress_callback)
+                if uri
+            ]
+
+            snapshot_id = self.sp.playlist(playlist_id, fields='snapshot_id')['snapshot_id']
+            synced = self.database_manager.get_playlist_sync(playlist_id)
+            if synced is not None and synced[0] == snapshot_id:
+                current = synced[1]
+            else:
+                current = self.fetch_playlist_uris(playlist_id)
+
+            requests = 0
+            if current != song_uris:
+                snapshot_id, requests = self._apply_playlist_diff(
+                    playlist_id, snapshot_id, current, song_uris)
+            self.database_manager.set_playlist_sync(playlist_id, snapshot_id, song_uris)
+
+            if not requests:
+                return True, f"Playlist '{playlist['name']}' is already up to date."
+            return True, (f"Playlist '{playlist['name']}' synced: {len(song_uris)} songs "
+                          f"in {requests} requests.")
+
+        except ValueError as e:
+            return False, str(e)
+
+        except Exception as e:
+            return False, f"An error occurred: {e}"
+
+    def _apply_playlist_diff(self, playlist_id, snapshot_id, current, desired):
+        """
+        Turn a playlist holding the URIs in current into one holding desired.
+
+        URIs not wanted (as often) any more are removed, tracks out of order
+        are moved and missing ones are added at their positions, all in
+        batches of PLAYLIST_BATCH_SIZE. If that takes more requests than
+        rewriting the playlist, it is rewritten instead.
+
+        :return: (snapshot_id after the changes, number of requests made)
+        """
+        current_keys = _occurrence_keys(current)
+        desired_keys = _occurrence_keys(desired)
+        rank = {key: index for index, key in enumerate(desired_keys)}
+
+        # Removing drops every occurrence of a URI; those still wanted are
+        # then added back like any other missing track
+        removed = sorted({uri for uri, number in current_keys if (uri, number) not in rank})
+        kept = [key for key in current_keys if key[0] not in removed]
+        in_order = _longest_increasing_run([rank[key] for key in kept])
+        moved = [key for index, key in enumerate(kept) if index not in in_order]
+        present = set(kept)
+        missing_runs = _missing_runs(desired_keys, present)
+
+        batches = -(-len(removed) // PLAYLIST_BATCH_SIZE) + len(moved) + sum(
+            -(-len(run) // PLAYLIST_BATCH_SIZE) for _, run in missing_runs)
+        rewrite = max(1, -(-len(desired) // PLAYLIST_BATCH_SIZE))
+        if None in current or batches > rewrite:
+            # Unavailable tracks cannot be addressed, and a rewrite also
+            # beats a long list of small changes
+            snapshot_id = self.sp.playlist_replace_items(
+                playlist_id, desired[:PLAYLIST_BATCH_SIZE])['snapshot_id']
+            for start in range(PLAYLIST_BATCH_SIZE, len(desired), PLAYLIST_BATCH_SIZE):
+                snapshot_id = self.sp.playlist_add_items(
+                    playlist_id, desired[start:start + PLAYLIST_BATCH_SIZE])['snapshot_id']
+            return snapshot_id, rewrite
+
+        for start in range(0, len(removed), PLAYLIST_BATCH_SIZE):
+            snapshot_id = self.sp.playlist_remove_all_occurrences_of_items(
+                playlist_id, removed[start:start + PLAYLIST_BATCH_SIZE],
+                snapshot_id=snapshot_id)['snapshot_id']
+
+        # Move each stray track behind the placed track that precedes it in
+        # desired, placing them in desired order
+        placed = {key for index, key in enumerate(kept) if index in in_order}
+        tracks = list(kept)
+        for key in sorted(moved, key=rank.get):
+            source = tracks.index(key)
+            before = [index for index, other in enumerate(tracks)
+                      if other in placed and rank[other] < rank[key]]
+            insert_before = before[-1] + 1 if before else 0
+            snapshot_id = self.sp.playlist_reorder_items(
+                playlist_id, range_start=source, insert_before=insert_before,
+                snapshot_id=snapshot_id)['snapshot_id']
+            tracks.pop(source)
+            tracks.insert(insert_before if insert_before <= source else insert_before - 1, key)
+            placed.add(key)
+
+        # Everything before a missing run is now in place, so each run goes
+        # straight to its position in desired
+        for position, run in missing_runs:
+            for start in range(0, len(run), PLAYLIST_BATCH_SIZE):
+                snapshot_id = self.sp.playlist_add_items(
+                    playlist_id, run[start:start + PLAYLIST_BATCH_SIZE],
+                    position=position + start)['snapshot_id']
+
+        return snapshot_id, batches
+
     def make_playlist_private(self, playlist):
         self.authenticate_spotify("playlist-modify-public playlist-modify-private")
+        from spotipy.exceptions import SpotifyException
 
         try:
             self.sp.playlist_change_details(playlist['id'], public=False)
             return True, f"Playlist {playlist['name']} has been made private."
 
-        except spotipy.exceptions.SpotifyException as e:
+        except SpotifyException as e:
             return False, f"Error making playlist private: {e}"
 
     def remove_playlist(self, playlist):
         self.authenticate_spotify("playlist-modify-public playlist-modify-private")
+        from spotipy.exceptions import SpotifyException
         success = self.make_playlist_private(playlist)
 
         try:
             self.sp.current_user_unfollow_playlist(playlist['id'])
+            if self.playlists is not None:
+                self.playlists = [cached for cached in self.playlists
+                                  if cached['id'] != playlist['id']]
             return success[0], True, f"{success[1]}\nPlaylist {playlist['name']} removed from your library."
 
-        except spotipy.exceptions.SpotifyException as e:
+        except SpotifyException as e:
             return success[0], False, f"{success[1]}\nError removing playlist: {e}"
 
+    def collect_top_items(self, max_workers=TOP_ITEMS_WORKERS):
+        """
+        Fetch the full top tracks and artists of every time range and store
+        them as a snapshot in the database.
+
+        Each ranking is paged to its end, and the rankings are fetched
+        concurrently. Rankings unchanged since the last run are not stored
+        again.
+
+        :return: (items fetched, rankings not stored before)
+        """
+        self.authenticate_spotify("user-top-read")
+
+        def fetch_ranking(item_type, time_range):
+            if item_type == 'tracks':
+                fetch, record = self.sp.current_user_top_tracks, TrackRecord.from_api
+            else:
+                fetch, record = self.sp.current_user_top_artists, ArtistRecord.from_api
+
+            def fetch_page(offset):
+                return fetch(limit=TOP_ITEMS_PAGE_SIZE, offset=offset, time_range=time_range)
+
+            return [record(item)
+                    for page in _iter_pages(fetch_page, TOP_ITEMS_PAGE_SIZE)
+                    for item in page['items']
+                    if item and item.get('id')]
+
+        keys = [(item_type, time_range)
+                for item_type in TOP_ITEM_TYPES for time_range in TOP_TIME_RANGES]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            rankings = dict(zip(keys, executor.map(lambda key: fetch_ranking(*key), keys)))
+
+        new_rankings = self.database_manager.store_top_items(rankings, user_id=self.user_id)
+        return sum(len(items) for items in rankings.values()), new_rankings
+
     def save_top_items_to_csv(self, item_type='tracks', limit=20,
                               time_range='medium_term',
-                              file_name="top_items.csv"):
+                              file_name="top_items.csv", refresh=True):
         """
         Save the user's top items (tracks or artists) to a CSV file.
 
+        The file is written from the latest snapshot in the database, so
+        any number of items can be saved, and without refresh it needs no
+        requests at all.
+
         :param item_type: 'tracks' or 'artists' (default is 'tracks')
-        :param limit: Number of top items to retrieve (default is 20)
+        :param limit: Number of top items to save (default is 20)
         :param time_range: Over what time frame ('short_term', 'medium_term', 'long_term')
         :param file_name: The name of the CSV file to save data to (default is 'top_items.csv')
+        :param refresh: Collect a new snapshot of all top items first
+        :return: Number of items saved
         """
-        self.authenticate_spotify("user-top-read")
+        if item_type not in TOP_ITEM_TYPES:
+            raise ValueError("item_type must be 'tracks' or 'artists'.")
+        if refresh:
+            self.collect_top_items()
 
-        # Fetch top items
+        top_items = self.database_manager.get_top_items(item_type, time_range, limit=limit,
+                                                        user_id=self.user_id)
         if item_type == 'tracks':
-            top_items = self.sp.current_user_top_tracks(limit=limit,
-                                                        time_range=time_range)[
-                'items']
             headers = ['Track Name', 'Artist', 'Album', 'Popularity']
-            rows = [[track['name'], track['artists'][0]['name'],
-                     track['album']['name'], track['popularity']]
-                    for track in top_items]
-
-        elif item_type == 'artists':
-            top_items = self.sp.current_user_top_artists(limit=limit,
-                                                         time_range=time_range)[
-                'items']
-            headers = ['Artist Name', 'Genres', 'Popularity']
-            rows = [[artist['name'], ", ".join(artist['genres']),
-                     artist['popularity']]
-                    for artist in top_items]
-
+            rows = [[name, artist, album, popularity]
+                    for _, _, name, artist, album, popularity, _ in top_items]
         else:
-            raise ValueError("item_type must be 'tracks' or 'artists'.")
+            headers = ['Artist Name', 'Genres', 'Popularity']
+            rows = [[name, genres, popularity]
+                    for _, _, name, genres, popularity, _ in top_items]
 
         # Save to CSV
         with open(file_name, mode='w', newline='', encoding='utf-8') as file:
             writer = csv.writer(file)
             writer.writerow(headers)
             writer.writerows(rows)
+        return len(rows)
 
     def fetch_last_played_tracks(self, limit=50):
         """
         Retrieve the user's recently played tracks, filtering out consecutive duplicate plays.
 
         :param limit: Number of recent tracks to retrieve (default is 50)
-        :return: List of dictionaries containing track name, artist, and played time, without consecutive duplicates
+        :return: List of PlayRecords, without consecutive duplicates
         """
         self.authenticate_spotify("user-read-recently-played")
+        from spotipy.exceptions import SpotifyException
 
         try:
             recent_tracks = \
@@ -242,103 +670,217 @@ class SpotifyManager:
             filtered_tracks = []
             last_track_id = None
 
-            for track_info in recent_tracks:
-                track = track_info['track']
-                played_at = track_info.get('played_at')
-                if not played_at:
+            for item in recent_tracks:
+                play = PlayRecord.from_api(item)
+                if play is None:
                     continue  # Skip tracks without 'played_at'
 
-                # Normalize the timestamp to always include fractional seconds
-                if played_at.endswith('Z') and '.' not in played_at:
-                    played_at = played_at.replace('Z', '.001Z')
-
-                # Parse the normalized timestamp
-                played_at = datetime.strptime(played_at,"%Y-%m-%dT%H:%M:%S.%fZ")
-
                 # Check for consecutive duplicates
-                if track['id'] != last_track_id:
-                    filtered_tracks.append({
-                        'track_id': track['id'],
-                        'track_name': track['name'],
-                        'artist': track['artists'][0]['name'],
-                        'album': track['album']['name'],
-                        'year': track['album']['release_date'][:4],
-                        'duration_ms': track['duration_ms'],
-                        'explicit': track['explicit'],
-                        'popularity': track['popularity'],
-                        'played_at': played_at,
-                    })
-                    last_track_id = track['id']
+                if play.track.spotify_id != last_track_id:
+                    filtered_tracks.append(play)
+                    last_track_id = play.track.spotify_id
 
                 if len(filtered_tracks) >= limit:  # Stop once we have enough tracks after filtering
                     break
 
             return filtered_tracks
 
-        except spotipy.exceptions.SpotifyException as e:
+        except SpotifyException as e:
             print(f"Error fetching recent tracks: {e}")
             return []
 
-    def save_recent_play_to_database(self, track_info):
-        # Assume track_info is a dictionary with details about the track
-        self.database_manager.insert_play(
-            track_id=track_info['track_id'],
-            track_name=track_info['track_name'],
-            artist=track_info['artist'],
-            album=track_info['album'],
-            year=track_info['year'],
-            duration_ms=track_info['duration_ms'],
-            explicit=track_info['explicit'],
-            popularity=track_info['popularity'],
-            played_at=track_info['played_at'],
-            session_id=track_info.get('session_id')  # Optional session_id
-        )
+    def save_recent_play_to_database(self, play):
+        # play is a PlayRecord, stored as it is
+        self.database_manager.insert_plays([play], user_id=self.user_id)
+
+    def save_recent_plays_to_database(self, tracks):
+        """Store many plays in one transaction and return the number stored."""
+        return self.database_manager.insert_plays(tracks, user_id=self.user_id)
 
     def update_play_history(self, file=None):
-        # Get the latest `played_at` timestamp from the database
-        latest_played_at = self.database_manager.get_most_recent_play_timestamp() or datetime.min
+        """
+        Store recent plays from Spotify, or import them from a CSV file.
 
-        if file is None:
-            # Fetch recent plays from Spotify
-            recent_tracks = self.fetch_last_played_tracks()
+        Plays that are already stored are skipped by the database, so the
+        same plays can safely be fetched or imported more than once.
+        """
+        if file is not None:
+            self.import_play_history(file)
+            return
 
-        else:
-            recent_tracks = []
-            try:
-                with open(file, mode='r', newline='', encoding='utf-8') as f:
-                    reader = csv.DictReader(f, delimiter=';')
-                    for row in reader:
-                        # Confirm `row` is a dictionary and `played_at` key exists
-                        if isinstance(row, dict) and 'played_at' in row:
-                            row['played_at'] = datetime.strptime(row['played_at'], "%Y-%m-%d %H:%M:%S.%f")
-                        recent_tracks.append(row)
+        # Fetch recent plays from Spotify
+        recent_tracks = self.fetch_last_played_tracks()
 
-            except FileNotFoundError:
-                print(f"Error: The file '{file}' was not found.")
+        # Sort by played_at to ensure chronological order
+        recent_tracks.sort(key=lambda play: play.played_at)
 
-            except csv.Error as e:
-                print(f"Error reading CSV file at line {reader.line_num}: {e}")
+        stored = self.save_recent_plays_to_database(recent_tracks)
 
-            except Exception as e:
-                print(f"An unexpected error occurred: {e}")
+        print(
+            f"Stored {stored} new tracks.")
 
+    def import_play_history(self, file, chunk_size=IMPORT_CHUNK_SIZE):
+        """
+        Stream plays from a semicolon-separated CSV file into the database.
 
-        # Filter out tracks that have already been stored
-        new_tracks = [
-            track for track in recent_tracks
-            if track['played_at'] > latest_played_at
-        ]
+        The file needs the columns of a plays.csv backup; an id column is
+        ignored. Rows are parsed and committed chunk_size at a time, so
+        memory use does not depend on the file size.
 
-        # Sort new_tracks by played_at to ensure chronological order
-        new_tracks.sort(key=lambda track: track['played_at'])
+        :return: Tuple of (rows read, new plays stored)
+        """
+        read = stored = 0
+        start = time.perf_counter()
+
+        try:
+            with open(file, mode='r', newline='', encoding='utf-8') as f:
+                reader = csv.reader(f, delimiter=';')
+                plays = read_play_csv(reader)
+                while chunk := list(islice(plays, chunk_size)):
+                    stored += self.database_manager.insert_plays(chunk, user_id=self.user_id)
+                    read += len(chunk)
 
-        for track_info in new_tracks:
-            self.save_recent_play_to_database(track_info)
+        except FileNotFoundError:
+            print(f"Error: The file '{file}' was not found.")
 
-        print(
-            f"Stored {len(new_tracks)} new tracks.")
+        except csv.Error as e:
+            print(f"Error reading CSV file at line {reader.line_num}: {e}")
+
+        except Exception as e:
+            print(f"An unexpected error occurred: {e}")
+
+        elapsed = time.perf_counter() - start
+        rate = read / elapsed if elapsed else 0
+        print(f"Stored {stored} new tracks from {read} rows "
+              f"({elapsed:.1f} s, {rate:,.0f} rows/s).")
+        return read, stored
+
+    def sync_recent_plays(self):
+        """
+        Store every play since the last sync.
+
+        Spotify is asked only for plays after the cursor saved by the
+        previous sync, and all pages are stored in one transaction.
+
+        :return: Number of new plays stored
+        """
+        return self.store_recent_plays(*self.fetch_recent_plays())
+
+    def fetch_recent_plays(self):
+        """
+        Fetch every play since the last sync without storing anything.
+
+        :return: Tuple of (plays, sync cursor to save with them)
+        """
+        self.authenticate_spotify("user-read-recently-played")
+        after = self.database_manager.get_metadata(self._sync_cursor_key())
+        plays = []
+
+        while True:
+            page = self.sp.current_user_recently_played(limit=50, after=after)
+            plays.extend(play for play in map(PlayRecord.from_api, page['items'])
+                         if play is not None)
+
+            cursors = page.get('cursors')
+            if not page['items'] or not page.get('next') or not cursors:
+                break
+            after = cursors['after']
+
+        if not plays:
+            return plays, None
+
+        # The cursor is epoch milliseconds, like stored play times
+        return plays, max(play.played_at for play in plays)
+
+    def store_recent_plays(self, plays, cursor):
+        """
+        Store plays from fetch_recent_plays and move the sync cursor past them.
+
+        :return: Number of new plays stored
+        """
+        if not plays:
+            return 0
+
+        stored = self.save_recent_plays_to_database(plays)
+        self.database_manager.set_metadata(self._sync_cursor_key(), cursor)
+        return stored
+
+    def _sync_cursor_key(self):
+        return f"recently_played_after:{self.user_id}"
+
+    def run_sync_daemon(self, stop_event=None):
+        """
+        Keep syncing recent plays until stop_event is set.
+
+        The wait between syncs drops to SYNC_MIN_INTERVAL while new plays
+        keep arriving and doubles up to SYNC_MAX_INTERVAL while idle.
+        """
+        stop_event = stop_event or threading.Event()
+        interval = SYNC_MIN_INTERVAL
+
+        while not stop_event.is_set():
+            try:
+                stored = self.sync_recent_plays()
+            except Exception as e:
+                print(f"Error syncing recent plays: {e}")
+                stored = 0
+
+            if stored:
+                interval = SYNC_MIN_INTERVAL
+            else:
+                interval = min(interval * 2, SYNC_MAX_INTERVAL)
+
+            print(f"{datetime.now():%Y-%m-%d %H:%M:%S} stored {stored} new plays, "
+                  f"next sync in {interval} s.")
+            stop_event.wait(interval)
+
+        print("Sync stopped.")
 
     def show_recent_plays(self):
-        recent_plays = self.database_manager.get_recent_plays(limit=20)
+        recent_plays = self.database_manager.get_recent_plays(limit=20, user_id=self.user_id)
         for play in recent_plays:
             print(f"{play[1]} by {play[2]}, played at {play[3]}")
+
+
+def sync_accounts(managers, max_workers=ACCOUNT_WORKERS):
+    """
+    Sync the recent plays of several accounts at once.
+
+    Accounts are fetched from Spotify concurrently, and their plays are
+    stored one account at a time by a single writer thread, so the
+    fetching threads never wait on the database. The managers are
+    expected to share one DatabaseManager.
+
+    :param managers: A SpotifyManager for each account
+    :param max_workers: Maximum number of accounts fetched at once
+    :return: Dictionary of user_id -> new plays stored, or the exception
+        that stopped the account's sync
+    """
+    results = {}
+    fetched = queue.Queue()
+
+    def write():
+        while (item := fetched.get()) is not None:
+            manager, plays, cursor = item
+            try:
+                results[manager.user_id] = manager.store_recent_plays(plays, cursor)
+            except Exception as e:
+                results[manager.user_id] = e
+
+    writer = threading.Thread(target=write, name="sync-writer")
+    writer.start()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(manager.fetch_recent_plays): manager
+                       for manager in managers}
+            for future in as_completed(futures):
+                manager = futures[future]
+                try:
+                    fetched.put((manager, *future.result()))
+                except Exception as e:
+                    results[manager.user_id] = e
+    finally:
+        fetched.put(None)
+        writer.join()
+
+    return results
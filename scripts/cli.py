@@ -1,15 +1,34 @@
-from scripts.backend import SpotifyManager
+from scripts.backend import SpotifyManager, sync_accounts
+from scripts.database import (DatabaseManager, DATABASE_PATH, BACKUP_DATABASE_PATH, DEFAULT_USER,
+                              ROLLUP_DIMENSIONS, TOP_ITEM_TYPES, TOP_TIME_RANGES)
+from scripts.export import EXPORT_FORMATS, export_plays
+from scripts.metrics import metrics
+from scripts.records import from_epoch_ms
+import argparse
 import os
+from datetime import datetime, timedelta
+from itertools import groupby, islice
+import signal
+import threading
 
 
 class SpotifyCLI:
-    def __init__(self):
+    def __init__(self, user_id=DEFAULT_USER):
         """Initialize the Spotify CLI with SpotifyManager."""
-        self.spotify_manager = SpotifyManager()
+        self.spotify_manager = SpotifyManager(user_id=user_id)
+        self.shown_backup_status = None
+
+    def show_backup_status(self):
+        """Print the startup backup's status when it has changed."""
+        status = self.spotify_manager.database_manager.backup_status
+        if status != self.shown_backup_status:
+            print(f"\nBackup {status}.")
+            self.shown_backup_status = status
 
     def show_main_menu(self):
         """Show the main menu and handle user choice."""
         while True:
+            self.show_backup_status()
 
             if self.spotify_manager.current_playlist:
                 print("\nSelected playlist: ",
@@ -24,7 +43,11 @@ class SpotifyCLI:
             print("5. Save Top Items to CSV")
             print("6. View Last Played Tracks")
             print("7. Fetch and Store Recent Tracks")
-            print("8. Exit")
+            print("8. Browse Play History")
+            print("9. Show Stats")
+            print("10. Sync File into Playlist")
+            print("11. Search Play History")
+            print("12. Exit")
 
             choice = input("Enter your choice: ")
             if choice == '1':
@@ -43,6 +66,16 @@ class SpotifyCLI:
                 file = choice.split(' ')[1] if ' ' in choice else None
                 self.fetch_and_store_recent_tracks(file)
             elif choice == '8':
+                self.browse_play_history()
+            elif choice == '9':
+                self.show_stats()
+            elif choice == '10':
+                self.sync_playlist()
+            elif choice == '11':
+                self.search_play_history()
+            elif choice == '12':
+                if self.spotify_manager.database_manager.backup_status == "in progress":
+                    print("Waiting for the backup to finish.")
                 print("Exiting the program.")
                 break
             else:
@@ -51,11 +84,11 @@ class SpotifyCLI:
     def clear_console(self):
         os.system('cls' if os.name == 'nt' else 'clear')
 
-    def list_playlists(self):
+    def list_playlists(self, refresh=False):
         """List all playlists and select one to view."""
         self.clear_console()
 
-        playlists = self.spotify_manager.fetch_user_playlists()
+        playlists = self.spotify_manager.fetch_user_playlists(refresh=refresh)
         if not playlists:
             print("No playlists found.")
             return
@@ -65,8 +98,12 @@ class SpotifyCLI:
             print(f"{i}. {playlist['name']}")
 
         try:
-            choice = int(
-                input("Select a playlist number to view (or 0 to go back): "))
+            choice = input(
+                "Select a playlist number to view (0 to go back, r to refresh): ")
+            if choice.strip().lower() == 'r':
+                self.list_playlists(refresh=True)
+                return
+            choice = int(choice)
             if choice == 0:
                 self.clear_console()
                 return
@@ -91,7 +128,8 @@ class SpotifyCLI:
         success = self.spotify_manager.import_playlist_from_file(file_path,
                                                                  separator,
                                                                  playlist_name,
-                                                                 playlist_desc)
+                                                                 playlist_desc,
+                                                                 progress_callback=show_search_progress)
 
         self.clear_console()
 
@@ -100,6 +138,33 @@ class SpotifyCLI:
         else:
             print("Error:", success[1])
 
+        self.show_search_cache_stats()
+
+    def sync_playlist(self):
+        """Make the selected playlist match a text file with song names."""
+        self.clear_console()
+
+        if not self.spotify_manager.current_playlist:
+            print("No playlist selected. Please select a playlist first.")
+            return
+
+        file_path = input("Enter the path to the text file with song names: ")
+        separator = input(
+            "Enter separator used in the file (leave empty for default): ") or "Auto"
+
+        success, message = self.spotify_manager.sync_playlist_from_file(
+            file_path, separator, self.spotify_manager.current_playlist,
+            progress_callback=show_search_progress)
+
+        self.clear_console()
+        print(message if success else f"Error: {message}")
+        self.show_search_cache_stats()
+
+    def show_search_cache_stats(self):
+        stats = self.spotify_manager.database_manager.search_cache_stats()
+        print(f"Search cache: {stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['hit_rate']:.0%} hit rate)")
+
     def download_playlist(self):
         """Download the selected playlist's songs to a file."""
         self.clear_console()
@@ -170,11 +235,11 @@ class SpotifyCLI:
         self.clear_console()
 
         try:
-            self.spotify_manager.save_top_items_to_csv(item_type=item_type,
-                                                       limit=limit,
-                                                       time_range=time_range,
-                                                       file_name=file_name)
-            print(f"Top {item_type} saved to {file_name}")
+            count = self.spotify_manager.save_top_items_to_csv(item_type=item_type,
+                                                               limit=limit,
+                                                               time_range=time_range,
+                                                               file_name=file_name)
+            print(f"Top {count} {item_type} saved to {file_name}")
 
         except Exception as e:
             print(f"An error occurred while saving top items: {e}")
@@ -201,18 +266,337 @@ class SpotifyCLI:
 
         if recent_tracks:
             print("\nRecently Played Tracks:")
-            for track in recent_tracks:
+            for play in recent_tracks:
                 print(
-                    f"{track['track_name']} by {track['artist']} (Played At: {track['played_at']})")
+                    f"{play.track.name} by {play.track.artist} (Played At: {from_epoch_ms(play.played_at)})")
 
         else:
             print("No recently played tracks found.")
 
+    def browse_play_history(self, page_size=20):
+        """Page backwards through the stored play history."""
+        before = None
+
+        while True:
+            self.clear_console()
+            plays = self.spotify_manager.database_manager.get_recent_plays(
+                limit=page_size, before=before, user_id=self.spotify_manager.user_id)
+
+            if not plays:
+                print("No more plays in the history.")
+                return
+
+            print("\nPlay History:")
+            for track_id, track_name, artist, played_at in plays:
+                print(f"{played_at}  {track_name} by {artist}")
+
+            if input("\nPress Enter for older plays or q to go back: ").strip().lower() == 'q':
+                self.clear_console()
+                return
+            before = plays[-1][3]
+
+    def search_play_history(self, page_size=20):
+        """Search the stored play history by track, artist or album name."""
+        self.clear_console()
+        query = input("Search for a track, artist or album: ").strip()
+        database_manager = self.spotify_manager.database_manager
+        user_id = self.spotify_manager.user_id
+
+        tracks = database_manager.search_tracks(query, user_id=user_id)
+        if not tracks:
+            print("No plays found.")
+            return
+
+        print("\nBest matches:")
+        for track_id, track_name, artist, album, plays, last_played_at in tracks:
+            print(f"{track_name} by {artist} ({album}): {plays} plays, last {last_played_at}")
+
+        before = None
+        while input("\nPress Enter for the plays, newest first, or q to go back: ").strip().lower() != 'q':
+            plays = database_manager.search_history(query, limit=page_size,
+                                                    before=before, user_id=user_id)
+            if not plays:
+                print("No more plays found.")
+                return
+
+            self.clear_console()
+            print(f"\nPlays matching '{query}':")
+            for track_id, track_name, artist, album, played_at in plays:
+                print(f"{played_at}  {track_name} by {artist}")
+            before = plays[-1][4]
+        self.clear_console()
+
+    def show_stats(self):
+        """Show API and database timings, and save them on request."""
+        self.clear_console()
+        if not metrics.enabled:
+            print("Stats are turned off in config.py.")
+            return
+
+        print_stats(metrics.snapshot())
+        choice = input("\nEnter a .json or .prom file to save the stats to, "
+                       "r to reset them, or press Enter to go back: ").strip()
+        if choice.lower() == 'r':
+            metrics.reset()
+            print("Stats reset.")
+        elif choice.endswith('.json') or choice.endswith('.prom'):
+            with open(choice, 'w', encoding='utf-8') as f:
+                f.write(metrics.to_json() if choice.endswith('.json')
+                        else metrics.to_prometheus())
+            print(f"Stats saved to {choice}")
+        elif choice:
+            print("Invalid file name, stats not saved.")
+
     def fetch_and_store_recent_tracks(self, file=None):
         self.clear_console()
         self.spotify_manager.update_play_history(file)
 
 
+def show_search_progress(completed, total, song, artist, uri):
+    """Progress callback of playlist imports, rewriting one console line."""
+    status = "found" if uri else "not found"
+    print(f"\rSearching songs {completed}/{total} "
+          f"({song} by {artist}: {status})\033[K", end="", flush=True)
+
+
+def print_stats(snapshot):
+    """Print per-endpoint and per-operation timings, slowest in total first."""
+    api_stats = snapshot.get('api', {})
+    print("\nSpotify API")
+    print(f"{'endpoint':<36}{'calls':>7}{'errors':>7}{'total s':>9}{'avg ms':>8}"
+          f"{'max ms':>8}{'KB':>8}{'retries':>8}{'429s':>6}")
+    for name, stat in api_stats.items():
+        print(f"{name:<36}{stat['count']:>7}{stat['errors']:>7}{stat['seconds']:>9.2f}"
+              f"{stat['seconds'] / stat['count'] * 1000:>8.1f}{stat['max_seconds'] * 1000:>8.1f}"
+              f"{stat['bytes'] / 1024:>8.0f}{stat['retries']:>8}{stat['rate_limited']:>6}")
+    if not api_stats:
+        print("No requests yet.")
+
+    db_stats = snapshot.get('db', {})
+    print("\nDatabase")
+    print(f"{'operation':<36}{'calls':>7}{'errors':>7}{'total s':>9}{'avg ms':>8}"
+          f"{'max ms':>8}{'rows':>10}")
+    for name, stat in db_stats.items():
+        print(f"{name:<36}{stat['count']:>7}{stat['errors']:>7}{stat['seconds']:>9.2f}"
+              f"{stat['seconds'] / stat['count'] * 1000:>8.1f}{stat['max_seconds'] * 1000:>8.1f}"
+              f"{stat['rows']:>10}")
+    if not db_stats:
+        print("No database operations yet.")
+
+
+def print_listening_report(database_manager, dimension, period, days, limit,
+                           user_id=DEFAULT_USER):
+    """Print the top entries of each day or week from the listening rollups."""
+    start = datetime.now(database_manager.timezone).date() - timedelta(days=days - 1)
+    rows = database_manager.get_listening_rollup(dimension, period, start=start,
+                                                 user_id=user_id)
+    if not rows:
+        print("No plays in this period.")
+        return
+
+    for period_start, group in groupby(rows, key=lambda row: row[0]):
+        print(f"\n{period.capitalize()} of {period_start}")
+        for _, key, name, plays, ms_played in islice(group, limit):
+            print(f"  {name or key}: {ms_played / 60000:.0f} min ({plays} plays)")
+
+
+def print_top_items(database_manager, item_type, time_range, limit, user_id=DEFAULT_USER):
+    """Print the latest top items snapshot with each item's move since the last change."""
+    rows = database_manager.get_top_items(item_type, time_range, limit=limit, user_id=user_id)
+    if not rows:
+        print("No top items stored yet.")
+        return
+
+    for rank, item_id, name, detail, *_, previous_rank in rows:
+        if previous_rank is None:
+            move = "new"
+        elif previous_rank == rank:
+            move = "="
+        else:
+            move = f"{previous_rank - rank:+d}"
+        print(f"{rank:>4}. {name} - {detail}  ({move})  [{item_id}]")
+
+
+def print_top_item_trend(database_manager, item_id, item_type, user_id=DEFAULT_USER):
+    """Print the rank of a track or artist in every stored top items snapshot."""
+    rows = database_manager.get_top_item_trend(item_id, item_type, user_id=user_id)
+    if not rows:
+        print("No top items stored yet.")
+        return
+
+    for time_range, group in groupby(rows, key=lambda row: row[1]):
+        print(f"\n{time_range}")
+        for taken_at, _, rank in group:
+            print(f"  {taken_at:%Y-%m-%d %H:%M}  {rank if rank is not None else '-'}")
+
+
+def sync_all_accounts(database_manager):
+    """Sync every registered account that has been authorized."""
+    from scripts.client import account_cache_path
+
+    managers = []
+    for user_id, _, _ in database_manager.get_accounts():
+        if os.path.isfile(account_cache_path(user_id)):
+            managers.append(SpotifyManager(database_manager=database_manager,
+                                           user_id=user_id))
+        else:
+            print(f"Skipping {user_id}: not authorized, run 'accounts add {user_id}' first.")
+
+    for user_id, result in sync_accounts(managers).items():
+        if isinstance(result, Exception):
+            print(f"{user_id}: error syncing recent plays: {result}")
+        else:
+            print(f"{user_id}: stored {result} new plays.")
+
+
+def add_account(user_id):
+    """Authorize a Spotify account and register it under user_id."""
+    spotify_manager = SpotifyManager(user_id=user_id)
+    spotify_id = spotify_manager.authenticate_spotify().current_user()['id']
+    spotify_manager.database_manager.add_account(user_id, spotify_id)
+    print(f"Account {user_id} (Spotify user {spotify_id}) registered.")
+
+
+def main(argv=None):
+    """Run a single command, or the interactive menu when none is given."""
+    parser = argparse.ArgumentParser(description="Spotify Manager")
+    parser.add_argument('--account', default=DEFAULT_USER,
+                        help="Registered account to act for")
+    subparsers = parser.add_subparsers(dest='command')
+
+    accounts_parser = subparsers.add_parser(
+        'accounts', help="List the registered accounts or add one")
+    accounts_subparsers = accounts_parser.add_subparsers(dest='accounts_command')
+    add_account_parser = accounts_subparsers.add_parser(
+        'add', help="Authorize a Spotify account and register it")
+    add_account_parser.add_argument('name', help="Name to register the account as")
+
+    backup_parser = subparsers.add_parser(
+        'backup', help="Back up the play history now")
+    backup_parser.add_argument('--full', action='store_true',
+                               help="Take a full snapshot instead of an incremental backup")
+
+    restore_parser = subparsers.add_parser(
+        'restore', help="Rebuild the database from the newest backups")
+    restore_parser.add_argument('--backups', default=BACKUP_DATABASE_PATH,
+                                help="Directory holding the backup files")
+    restore_parser.add_argument('--target', default=DATABASE_PATH,
+                                help="Path of the database to write")
+    restore_parser.add_argument('--overwrite', action='store_true',
+                                help="Replace the target database if it exists")
+
+    sync_parser = subparsers.add_parser(
+        'sync', help="Store the plays made since the last sync")
+    sync_group = sync_parser.add_mutually_exclusive_group()
+    sync_group.add_argument('--daemon', action='store_true',
+                            help="Keep running and sync as new plays arrive")
+    sync_group.add_argument('--all', action='store_true',
+                            help="Sync every registered account at once")
+
+    report_parser = subparsers.add_parser(
+        'report', help="Show listening time from the play history")
+    report_parser.add_argument('--by', choices=ROLLUP_DIMENSIONS, default='artist',
+                               help="What to group listening time by")
+    report_parser.add_argument('--period', choices=('day', 'week'), default='week')
+    report_parser.add_argument('--days', type=int, default=28,
+                               help="How many days back to report")
+    report_parser.add_argument('--limit', type=int, default=5,
+                               help="Entries shown per period")
+
+    export_parser = subparsers.add_parser(
+        'export', help="Export the play history to an XLSX or Parquet file")
+    export_parser.add_argument('file', help="File to write, e.g. plays_sheets.xlsx")
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS,
+                               help="Defaults to the file extension")
+
+    playlists_parser = subparsers.add_parser(
+        'export-playlists', help="Save every playlist to a CSV file")
+    playlists_parser.add_argument('directory', help="Directory to write the files to")
+
+    top_parser = subparsers.add_parser(
+        'top', help="Collect and show the top tracks or artists")
+    top_parser.add_argument('--type', choices=TOP_ITEM_TYPES, default='tracks')
+    top_parser.add_argument('--range', choices=TOP_TIME_RANGES, default='medium_term')
+    top_parser.add_argument('--limit', type=int, default=20,
+                            help="Items shown")
+    top_parser.add_argument('--offline', action='store_true',
+                            help="Show the latest stored snapshot without collecting a new one")
+    top_parser.add_argument('--trend', metavar='ID',
+                            help="Show the rank of this track or artist in every snapshot")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'accounts':
+        if args.accounts_command == 'add':
+            add_account(args.name)
+        else:
+            for user_id, spotify_id, added_at in DatabaseManager().get_accounts():
+                print(f"{user_id}  Spotify user: {spotify_id or 'unknown'}  added {added_at}")
+
+    elif args.command == 'sync' and args.all:
+        sync_all_accounts(DatabaseManager())
+
+    elif args.command == 'sync':
+        spotify_manager = SpotifyManager(user_id=args.account)
+        if args.daemon:
+            stop_event = threading.Event()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, lambda *_: stop_event.set())
+            spotify_manager.run_sync_daemon(stop_event)
+        else:
+            print(f"Stored {spotify_manager.sync_recent_plays()} new plays.")
+
+    elif args.command == 'report':
+        print_listening_report(DatabaseManager(), args.by, args.period,
+                               args.days, args.limit, args.account)
+
+    elif args.command == 'export':
+        try:
+            count = export_plays(DatabaseManager(), args.file, args.format)
+            print(f"Exported {count} plays to {args.file}")
+        except (ImportError, ValueError) as e:
+            print("Error:", e)
+
+    elif args.command == 'export-playlists':
+        written, downloaded = SpotifyManager(user_id=args.account).export_all_playlists(
+            args.directory)
+        print(f"Saved {written} playlists to {args.directory}, "
+              f"{downloaded} of them downloaded because they changed.")
+
+    elif args.command == 'top':
+        spotify_manager = SpotifyManager(user_id=args.account)
+        if not args.offline:
+            items, new_rankings = spotify_manager.collect_top_items()
+            print(f"Collected {items} top items, {new_rankings} rankings changed.")
+        if args.trend:
+            print_top_item_trend(spotify_manager.database_manager, args.trend, args.type,
+                                 args.account)
+        else:
+            print_top_items(spotify_manager.database_manager, args.type, args.range,
+                            args.limit, args.account)
+
+    elif args.command == 'backup':
+        database_manager = DatabaseManager()
+        if args.full:
+            print(f"Full backup written to {database_manager.backup_full()}")
+            removed = database_manager.prune_backups()
+            if removed:
+                print(f"Removed {len(removed)} old backup files.")
+        elif path := database_manager.backup_incremental():
+            print(f"Incremental backup written to {path}")
+        else:
+            print("No new plays since the last backup.")
+
+    elif args.command == 'restore':
+        try:
+            DatabaseManager.restore(args.backups, args.target, args.overwrite)
+        except (FileExistsError, FileNotFoundError) as e:
+            print("Error:", e)
+
+    else:
+        app = SpotifyCLI(args.account)
+        app.show_main_menu()
+
+
 if __name__ == "__main__":
-    app = SpotifyCLI()
-    app.show_main_menu()
+    main()
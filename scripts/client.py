@@ -0,0 +1,154 @@
+import re
+import threading
+import time
+
+import requests
+import spotipy
+from spotipy.oauth2 import CacheFileHandler, CacheHandler, SpotifyOAuth
+from urllib3.util.retry import Retry
+
+import config
+from scripts.database import DEFAULT_USER
+from scripts.metrics import metrics
+
+# Every scope SpotifyManager uses, so one authorization covers all menu actions
+SCOPES = (
+    "user-library-read",
+    "playlist-read-private",
+    "playlist-modify-public",
+    "playlist-modify-private",
+    "user-top-read",
+    "user-read-recently-played",
+)
+CACHE_PATH = "../.cache"
+POOL_SIZE = 16             # Kept-alive connections; covers the concurrent searches
+TOKEN_REFRESH_MARGIN = 300 # Refresh when the token has less than this many seconds left
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Path segments followed by an id, which endpoint names leave out
+ID_SEGMENT = re.compile(r"\b(albums|artists|playlists|tracks|users)/[^/]+")
+
+_last_response = threading.local()
+
+
+class WriteThroughCacheHandler(CacheHandler):
+    """Keeps the token in memory and writes changes through to the cache file."""
+
+    def __init__(self, cache_path=CACHE_PATH):
+        self.file_handler = CacheFileHandler(cache_path=cache_path)
+        self.token_info = None
+
+    def get_cached_token(self):
+        if self.token_info is None:
+            self.token_info = self.file_handler.get_cached_token()
+        return self.token_info
+
+    def save_token_to_cache(self, token_info):
+        self.token_info = token_info
+        self.file_handler.save_token_to_cache(token_info)
+
+
+class PooledSpotifyOAuth(SpotifyOAuth):
+    """
+    SpotifyOAuth that refreshes tokens ahead of expiry and only once when
+    several threads ask for a token at the same time.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._token_lock = threading.Lock()
+
+    def get_access_token(self, code=None, as_dict=True, check_cache=True):
+        with self._token_lock:
+            return super().get_access_token(code, as_dict, check_cache)
+
+    @staticmethod
+    def is_token_expired(token_info):
+        return token_info["expires_at"] - int(time.time()) < TOKEN_REFRESH_MARGIN
+
+
+def endpoint_name(method, url):
+    """Return e.g. 'GET playlists/{id}/tracks' for a request to the Web API."""
+    path = url.split('/v1/', 1)[-1].split('?', 1)[0].rstrip('/')
+    return f"{method} " + ID_SEGMENT.sub(r"\1/{id}", path)
+
+
+def _remember_response(response, *args, **kwargs):
+    """Session hook keeping the last response of each thread for metrics."""
+    _last_response.value = response
+
+
+class InstrumentedSpotify(spotipy.Spotify):
+    """
+    Spotify client that records each API call in metrics: its latency,
+    response size, and how many retries and 429 responses it took.
+    """
+
+    def _internal_call(self, method, url, payload, params):
+        if not metrics.enabled:
+            return super()._internal_call(method, url, payload, params)
+
+        _last_response.value = None
+        start = time.perf_counter()
+        error = True
+        try:
+            result = super()._internal_call(method, url, payload, params)
+            error = False
+            return result
+        finally:
+            response = _last_response.value
+            retries = getattr(getattr(response, 'raw', None), 'retries', None)
+            history = retries.history if retries is not None else ()
+            metrics.observe(
+                'api', endpoint_name(method, url), time.perf_counter() - start,
+                error=error,
+                response_bytes=len(response.content) if response is not None else 0,
+                retries=len(history),
+                rate_limited=sum(attempt.status == 429 for attempt in history))
+
+
+def account_cache_path(user_id):
+    """Token cache file of an account; the default account keeps CACHE_PATH."""
+    return CACHE_PATH if user_id == DEFAULT_USER else f"{CACHE_PATH}-{user_id}"
+
+
+def create_session(pool_size=POOL_SIZE):
+    """Return a requests session with a sized keep-alive pool and retries."""
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        connect=None,
+        read=False,
+        allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+        status=3,
+        backoff_factor=0.3,
+        status_forcelist=RETRY_STATUS_CODES)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size,
+                                            max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.hooks['response'].append(_remember_response)
+    return session
+
+
+def create_client(cache_path=CACHE_PATH, scopes=SCOPES, session=None):
+    """
+    Build the Spotify client used for every request of a SpotifyManager.
+
+    The API calls and the token requests share one pooled session, so
+    consecutive operations reuse warm connections.
+
+    :param cache_path: File the OAuth token is cached in
+    :param scopes: Scopes to authorize, all at once
+    :param session: requests session to use (optional)
+    """
+    session = session or create_session()
+    auth_manager = PooledSpotifyOAuth(
+        client_id=config.client_id,
+        client_secret=config.client_secret,
+        redirect_uri=config.redirect_uri,
+        scope=" ".join(scopes),
+        cache_handler=WriteThroughCacheHandler(cache_path),
+        requests_session=session,
+    )
+    return InstrumentedSpotify(auth_manager=auth_manager, requests_session=session)
@@ -1,17 +1,526 @@
 import sqlite3
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
 import csv
+import gzip
+import hashlib
+import re
+import shutil
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from itertools import islice
+from zoneinfo import ZoneInfo
+
+import config
+from scripts.metrics import instrument_methods
+from scripts.records import (LOCAL_TRACK_PREFIX, MILLISECOND, TRACK_ROW, PlayRecord,
+                             TrackRecord, from_epoch_ms, read_play_csv, to_epoch_ms)
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # Root directory
 DATABASE_PATH = os.path.join(BASE_DIR, 'database', 'spotify_plays.db')
 BACKUP_DATABASE_PATH = os.path.join(BASE_DIR, 'database', 'csv_backups')
 
+BACKUP_INTERVAL = timedelta(hours=24)        # Between incremental backups
+FULL_BACKUP_INTERVAL = timedelta(hours=168)  # Between full snapshots
+BACKUP_KEEP_FULL = 4                         # Full snapshots kept with their deltas
+BACKUP_CHUNK_SIZE = 10000                    # Rows read per round when streaming
+FULL_BACKUP_PATTERN = re.compile(r'^full_(\d{8}_\d{6})_(\d+)\.db\.gz$')
+DELTA_BACKUP_PATTERN = re.compile(r'^delta_(\d{8}_\d{6})_(\d+)_(\d+)\.csv\.gz$')
+
+# Denormalized play rows written to incremental backups, with the columns
+# read_play_csv reads
+DELTA_BACKUP_QUERY = '''
+SELECT p.id, t.spotify_id AS track_id, t.name AS track_name,
+       t.artist_id, ar.name AS artist, t.album_id, al.name AS album, al.year,
+       t.duration_ms, t.explicit, t.popularity,
+       strftime('%Y-%m-%d %H:%M:%f', p.played_at / 1000.0, 'unixepoch') AS played_at,
+       p.session_id, p.user_id
+FROM play_events p
+JOIN tracks t ON t.id = p.track_id
+JOIN artists ar ON ar.id = t.artist_id
+LEFT JOIN albums al ON al.id = t.album_id
+WHERE p.id > ? AND p.id <= ?
+ORDER BY p.id
+'''
+
+# Timezone that days and times of day in the listening rollups are counted in
+ROLLUP_TIMEZONE = getattr(config, 'timezone', 'UTC')
+ROLLUP_DIMENSIONS = ('track', 'artist', 'time_of_day')
+# Needs no time zone database, which Windows only has with tzdata installed
+UTC = timezone.utc
+
+# A new listening session starts when this much time passes between the end
+# of one play (played_at + duration) and the start of the next
+SESSION_GAP = timedelta(minutes=30)
+
+# Account the play history belonged to before there could be several;
+# migration 9 uses the same name
+DEFAULT_USER = 'default'
+
+SEARCH_CACHE_TTL = 30 * 24 * 3600           # Seconds a found URI stays valid
+SEARCH_CACHE_NEGATIVE_TTL = 7 * 24 * 3600   # Seconds a "not found" stays valid
+SEARCH_CACHE_MAX_ENTRIES = 100000           # Least recently used rows go first
+SEARCH_MAX_TRACKS = 1000   # Best matching tracks a play history search looks at
+SEARCH_TRACK_BY_TRACK = 100  # Most matching tracks whose plays are read one by one
+
+TOP_ITEM_TYPES = ('tracks', 'artists')
+TOP_TIME_RANGES = ('short_term', 'medium_term', 'long_term')
+
+# Schema migrations, applied in order. The database's PRAGMA user_version
+# records how many of them have been run.
+MIGRATIONS = [
+    # 1: original denormalized plays table
+    '''
+    CREATE TABLE IF NOT EXISTS plays (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        track_id TEXT NOT NULL,
+        track_name TEXT NOT NULL,
+        artist TEXT NOT NULL,
+        album TEXT,
+        year INTEGER,
+        duration_ms INTEGER,
+        explicit BOOLEAN,
+        popularity INTEGER,
+        played_at TIMESTAMP NOT NULL,
+        session_id TEXT
+    );
+    ''',
+    # 2: tracks/artists/albums dimension tables keyed by Spotify id, a slim
+    # play_events fact table and a plays view with the original columns.
+    # Tracks also get an integer key so each play stores a few bytes instead
+    # of the 22-character id. Artists and albums imported without Spotify ids
+    # get 'local:' keys built from their names.
+    '''
+    CREATE TABLE artists (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL
+    );
+    CREATE TABLE albums (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        year INTEGER
+    );
+    CREATE TABLE tracks (
+        id INTEGER PRIMARY KEY,
+        spotify_id TEXT NOT NULL UNIQUE,
+        name TEXT NOT NULL,
+        artist_id TEXT NOT NULL REFERENCES artists(id),
+        album_id TEXT REFERENCES albums(id),
+        duration_ms INTEGER,
+        explicit BOOLEAN,
+        popularity INTEGER
+    );
+    CREATE TABLE play_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        track_id INTEGER NOT NULL REFERENCES tracks(id),
+        played_at TIMESTAMP NOT NULL,
+        session_id TEXT
+    );
+
+    INSERT INTO artists (id, name)
+    SELECT DISTINCT 'local:' || artist, artist FROM plays;
+
+    INSERT INTO albums (id, name, year)
+    SELECT 'local:' || artist || ':' || album, album, MAX(year)
+    FROM plays WHERE album IS NOT NULL
+    GROUP BY artist, album;
+
+    INSERT INTO tracks (spotify_id, name, artist_id, album_id, duration_ms, explicit, popularity)
+    SELECT track_id, track_name, 'local:' || artist,
+           CASE WHEN album IS NULL THEN NULL ELSE 'local:' || artist || ':' || album END,
+           duration_ms, explicit, popularity
+    FROM plays
+    WHERE id IN (SELECT MAX(id) FROM plays GROUP BY track_id);
+
+    INSERT INTO play_events (id, track_id, played_at, session_id)
+    SELECT p.id, t.id, p.played_at, p.session_id
+    FROM plays p JOIN tracks t ON t.spotify_id = p.track_id;
+
+    DROP TABLE plays;
+
+    CREATE INDEX idx_play_events_played_at ON play_events(played_at);
+    CREATE INDEX idx_play_events_track_id ON play_events(track_id);
+
+    CREATE VIEW plays AS
+    SELECT p.id, t.spotify_id AS track_id, t.name AS track_name, ar.name AS artist,
+           al.name AS album, al.year, t.duration_ms, t.explicit,
+           t.popularity, p.played_at, p.session_id
+    FROM play_events p
+    JOIN tracks t ON t.id = p.track_id
+    JOIN artists ar ON ar.id = t.artist_id
+    LEFT JOIN albums al ON al.id = t.album_id;
+    ''',
+    # 3: cache of track searches made while importing playlists
+    '''
+    CREATE TABLE search_cache (
+        query TEXT PRIMARY KEY,
+        uri TEXT,
+        created_at INTEGER NOT NULL,
+        last_used INTEGER NOT NULL
+    );
+    CREATE INDEX idx_search_cache_last_used ON search_cache(last_used);
+    ''',
+    # 4: log of full and incremental backups with their play id high-water mark
+    '''
+    CREATE TABLE backups (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        file TEXT NOT NULL,
+        created_at TIMESTAMP NOT NULL,
+        high_water_mark INTEGER NOT NULL
+    );
+    ''',
+    # 5: a track can only be played once at a given time, which lets
+    # inserts skip plays that are already stored
+    '''
+    DELETE FROM play_events WHERE id NOT IN (
+        SELECT MIN(id) FROM play_events GROUP BY track_id, played_at
+    );
+    DROP INDEX idx_play_events_track_id;
+    CREATE UNIQUE INDEX idx_play_events_track_played ON play_events(track_id, played_at);
+    ''',
+    # 6: small key/value store for state such as sync cursors
+    '''
+    CREATE TABLE metadata (
+        key TEXT PRIMARY KEY,
+        value
+    );
+    ''',
+    # 7: plays and listening time per day for each track, artist and time
+    # of day, kept up to date by insert_plays
+    '''
+    CREATE TABLE listening_rollup (
+        dimension TEXT NOT NULL,
+        day TEXT NOT NULL,
+        key TEXT NOT NULL,
+        plays INTEGER NOT NULL,
+        ms_played INTEGER NOT NULL,
+        PRIMARY KEY (dimension, day, key)
+    ) WITHOUT ROWID;
+    ''',
+    # 8: listening sessions; a session's id is the played_at of its first play
+    '''
+    CREATE INDEX idx_play_events_session_id ON play_events(session_id);
+    CREATE TABLE sessions (
+        id TEXT PRIMARY KEY,
+        started_at TIMESTAMP NOT NULL,
+        last_played_at TIMESTAMP NOT NULL,
+        plays INTEGER NOT NULL,
+        ms_played INTEGER NOT NULL
+    );
+    CREATE INDEX idx_sessions_started_at ON sessions(started_at);
+    ''',
+    # 9: several accounts in one database. Plays, rollups and sessions get
+    # the account's user_id, and existing rows belong to the 'default' account.
+    '''
+    CREATE TABLE accounts (
+        user_id TEXT PRIMARY KEY,
+        spotify_id TEXT,
+        added_at TIMESTAMP NOT NULL
+    );
+    INSERT INTO accounts (user_id, added_at) VALUES ('default', CURRENT_TIMESTAMP);
+
+    ALTER TABLE play_events ADD COLUMN user_id TEXT NOT NULL DEFAULT 'default';
+    DROP INDEX idx_play_events_track_played;
+    DROP INDEX idx_play_events_played_at;
+    CREATE UNIQUE INDEX idx_play_events_user_track_played
+        ON play_events(user_id, track_id, played_at);
+    CREATE INDEX idx_play_events_user_played_at ON play_events(user_id, played_at);
+
+    CREATE TABLE listening_rollup_new (
+        user_id TEXT NOT NULL,
+        dimension TEXT NOT NULL,
+        day TEXT NOT NULL,
+        key TEXT NOT NULL,
+        plays INTEGER NOT NULL,
+        ms_played INTEGER NOT NULL,
+        PRIMARY KEY (user_id, dimension, day, key)
+    ) WITHOUT ROWID;
+    INSERT INTO listening_rollup_new
+    SELECT 'default', dimension, day, key, plays, ms_played FROM listening_rollup;
+    DROP TABLE listening_rollup;
+    ALTER TABLE listening_rollup_new RENAME TO listening_rollup;
+
+    CREATE TABLE sessions_new (
+        user_id TEXT NOT NULL,
+        id TEXT NOT NULL,
+        started_at TIMESTAMP NOT NULL,
+        last_played_at TIMESTAMP NOT NULL,
+        plays INTEGER NOT NULL,
+        ms_played INTEGER NOT NULL,
+        PRIMARY KEY (user_id, id)
+    );
+    INSERT INTO sessions_new
+    SELECT 'default', id, started_at, last_played_at, plays, ms_played FROM sessions;
+    DROP TABLE sessions;
+    ALTER TABLE sessions_new RENAME TO sessions;
+    CREATE INDEX idx_sessions_user_started_at ON sessions(user_id, started_at);
+
+    DROP VIEW plays;
+    CREATE VIEW plays AS
+    SELECT p.id, t.spotify_id AS track_id, t.name AS track_name, ar.name AS artist,
+           al.name AS album, al.year, t.duration_ms, t.explicit,
+           t.popularity, p.played_at, p.session_id, p.user_id
+    FROM play_events p
+    JOIN tracks t ON t.id = p.track_id
+    JOIN artists ar ON ar.id = t.artist_id
+    LEFT JOIN albums al ON al.id = t.album_id;
+
+    UPDATE metadata SET key = 'recently_played_after:default'
+    WHERE key = 'recently_played_after';
+    ''',
+    # 10: track URIs of playlists as left by the last file sync, valid while
+    # the playlist still has the snapshot_id recorded with them
+    '''
+    CREATE TABLE playlist_syncs (
+        playlist_id TEXT PRIMARY KEY,
+        snapshot_id TEXT NOT NULL,
+        track_uris TEXT NOT NULL,
+        synced_at TIMESTAMP NOT NULL
+    );
+    ''',
+    # 11: local copies of downloaded playlists. Their tracks live in the
+    # tracks table and each playlist only keeps membership rows, valid while
+    # the playlist has the stored snapshot_id.
+    '''
+    CREATE TABLE playlists (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        snapshot_id TEXT NOT NULL,
+        fetched_at TIMESTAMP NOT NULL
+    );
+    CREATE TABLE playlist_tracks (
+        playlist_id TEXT NOT NULL REFERENCES playlists(id),
+        position INTEGER NOT NULL,
+        track_id INTEGER NOT NULL REFERENCES tracks(id),
+        PRIMARY KEY (playlist_id, position)
+    ) WITHOUT ROWID;
+    ''',
+    # 12: full-text index of track, artist and album names for searching
+    # the play history. Rows share their rowid with tracks, and new tracks
+    # are indexed by a trigger.
+    '''
+    CREATE VIRTUAL TABLE track_search USING fts5(
+        name, artist, album,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    );
+    INSERT INTO track_search (rowid, name, artist, album)
+    SELECT t.id, t.name, ar.name, al.name
+    FROM tracks t
+    JOIN artists ar ON ar.id = t.artist_id
+    LEFT JOIN albums al ON al.id = t.album_id;
+
+    CREATE TRIGGER track_search_insert AFTER INSERT ON tracks BEGIN
+        INSERT INTO track_search (rowid, name, artist, album)
+        VALUES (new.id, new.name,
+                (SELECT name FROM artists WHERE id = new.artist_id),
+                (SELECT name FROM albums WHERE id = new.album_id));
+    END;
+    ''',
+    # 13: play times as integer epoch milliseconds UTC instead of text, which
+    # halves their size and turns range scans into integer comparisons.
+    # Sessions, whose ids are the played_at of their first play, follow. The
+    # plays view keeps showing ISO text for CSV backups and spreadsheets.
+    # A play time julianday() cannot read fails the migration rather than
+    # being dropped.
+    '''
+    DROP VIEW plays;
+
+    CREATE TABLE play_events_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        track_id INTEGER NOT NULL REFERENCES tracks(id),
+        played_at INTEGER NOT NULL,
+        session_id INTEGER,
+        user_id TEXT NOT NULL DEFAULT 'default'
+    );
+    INSERT INTO play_events_new (id, track_id, played_at, session_id, user_id)
+    SELECT id, track_id,
+           CAST((julianday(played_at) - 2440587.5) * 86400000 + 0.5 AS INTEGER),
+           CAST((julianday(session_id) - 2440587.5) * 86400000 + 0.5 AS INTEGER),
+           user_id
+    FROM play_events ORDER BY id;
+    DROP TABLE play_events;
+    ALTER TABLE play_events_new RENAME TO play_events;
+    CREATE UNIQUE INDEX idx_play_events_user_track_played
+        ON play_events(user_id, track_id, played_at);
+    CREATE INDEX idx_play_events_user_played_at ON play_events(user_id, played_at);
+    CREATE INDEX idx_play_events_session_id ON play_events(session_id);
+
+    CREATE TABLE sessions_new (
+        user_id TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        started_at INTEGER NOT NULL,
+        last_played_at INTEGER NOT NULL,
+        plays INTEGER NOT NULL,
+        ms_played INTEGER NOT NULL,
+        PRIMARY KEY (user_id, id)
+    );
+    INSERT INTO sessions_new
+    SELECT user_id,
+           CAST((julianday(id) - 2440587.5) * 86400000 + 0.5 AS INTEGER),
+           CAST((julianday(started_at) - 2440587.5) * 86400000 + 0.5 AS INTEGER),
+           CAST((julianday(last_played_at) - 2440587.5) * 86400000 + 0.5 AS INTEGER),
+           plays, ms_played
+    FROM sessions;
+    DROP TABLE sessions;
+    ALTER TABLE sessions_new RENAME TO sessions;
+    CREATE INDEX idx_sessions_user_started_at ON sessions(user_id, started_at);
+
+    CREATE VIEW plays AS
+    SELECT p.id, t.spotify_id AS track_id, t.name AS track_name, ar.name AS artist,
+           al.name AS album, al.year, t.duration_ms, t.explicit, t.popularity,
+           strftime('%Y-%m-%d %H:%M:%f', p.played_at / 1000.0, 'unixepoch') AS played_at,
+           p.session_id, p.user_id
+    FROM play_events p
+    JOIN tracks t ON t.id = p.track_id
+    JOIN artists ar ON ar.id = t.artist_id
+    LEFT JOIN albums al ON al.id = t.album_id;
+    ''',
+    # 14: snapshots of the top tracks and artists of each time range, one per
+    # collection run. A ranking is stored once and shared by every snapshot
+    # that saw it unchanged; latest_top_items shows the newest snapshots.
+    '''
+    ALTER TABLE artists ADD COLUMN genres TEXT;
+    ALTER TABLE artists ADD COLUMN popularity INTEGER;
+
+    CREATE TABLE top_rankings (
+        id INTEGER PRIMARY KEY,
+        signature TEXT NOT NULL UNIQUE
+    );
+    CREATE TABLE top_ranking_items (
+        ranking_id INTEGER NOT NULL REFERENCES top_rankings(id),
+        rank INTEGER NOT NULL,
+        item_id TEXT NOT NULL,
+        PRIMARY KEY (ranking_id, rank)
+    ) WITHOUT ROWID;
+    CREATE TABLE top_snapshots (
+        user_id TEXT NOT NULL,
+        item_type TEXT NOT NULL,
+        time_range TEXT NOT NULL,
+        taken_at INTEGER NOT NULL,
+        ranking_id INTEGER NOT NULL REFERENCES top_rankings(id),
+        PRIMARY KEY (user_id, item_type, time_range, taken_at)
+    ) WITHOUT ROWID;
+
+    CREATE VIEW latest_top_items AS
+    SELECT s.user_id, s.item_type, s.time_range, s.taken_at, s.ranking_id,
+           i.rank, i.item_id
+    FROM top_snapshots s
+    JOIN top_ranking_items i ON i.ranking_id = s.ranking_id
+    WHERE s.taken_at = (SELECT MAX(taken_at) FROM top_snapshots
+                        WHERE user_id = s.user_id AND item_type = s.item_type
+                        AND time_range = s.time_range);
+    ''',
+]
+
+
+def _fts_query(text):
+    """
+    Turn words typed by the user into an FTS5 query matching tracks that
+    contain all of them, the last one as a prefix. Returns None without words.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+def normalize_search_query(song, artist):
+    """Cache key for a (song, artist) search, ignoring case and spacing."""
+    song, artist = (
+        ' '.join(unicodedata.normalize('NFKC', text).casefold().split())
+        for text in (song, artist)
+    )
+    return f"{song}\t{artist}"
+
+
+def time_of_day(hour):
+    """Name of the part of the day an hour falls in."""
+    if 5 <= hour < 12:
+        return 'Morning'
+    if 12 <= hour < 17:
+        return 'Afternoon'
+    if 17 <= hour < 21:
+        return 'Evening'
+    return 'Night'
+
+
+class Sessionizer:
+    """Groups plays, fed in played_at order, into listening sessions in one pass."""
+
+    def __init__(self, gap=SESSION_GAP):
+        self.gap = gap // MILLISECOND
+        self.session_id = None
+        self.session_end = None
+
+    def assign(self, played_at, duration_ms):
+        """
+        Return the session id for the next play.
+
+        :param played_at: Play start as stored in play_events, in epoch milliseconds
+        :param duration_ms: Track length in milliseconds (None counts as 0)
+        """
+        if self.session_id is None or played_at - self.session_end > self.gap:
+            self.session_id = played_at
+            self.session_end = played_at
+
+        self.session_end = max(self.session_end, played_at + (duration_ms or 0))
+        return self.session_id
+
+
+def _backup_timestamp(text):
+    """Creation time of a backup file from the timestamp in its name."""
+    return datetime.strptime(text, '%Y%m%d_%H%M%S')
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+@instrument_methods('db', row_counts=('insert_plays', '_insert_play_chunk'))
 class DatabaseManager:
-    def __init__(self, database_path = DATABASE_PATH, backup_path = BACKUP_DATABASE_PATH):
+    def __init__(self, database_path = DATABASE_PATH, backup_path = BACKUP_DATABASE_PATH,
+                 timezone = ROLLUP_TIMEZONE):
         self.database_path = database_path
         self.backup_path = backup_path
-        self.check_database()
+        self.timezone = ZoneInfo(timezone)
+        self._conn = None
+        self._lock = threading.RLock()
+        self.search_cache_hits = 0
+        self.search_cache_misses = 0
+        self.backup_status = None
+        self._backup_thread = None
+
+    @property
+    def conn(self):
+        """Shared long-lived connection, opened and checked on first use."""
+        if self._conn is None:
+            with self._lock:
+                if self._conn is None:
+                    self.check_database()
+        return self._conn
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database_path, check_same_thread=False)
+        # WAL lets readers run alongside the writer and, with
+        # synchronous=NORMAL, only fsyncs on checkpoints instead of
+        # on every commit.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-64000")  # ~64 MB
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
 
     def backup_to_csv(self):
         # Create a timestamped folder for this backup
@@ -19,19 +528,19 @@ class DatabaseManager:
         backup_folder = os.path.join(self.backup_path, f"backup_{timestamp}")
         os.makedirs(backup_folder, exist_ok=True)
 
-        # Connect to the database
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+        with self._lock:
+            cursor = self.conn.cursor()
 
-        # Retrieve all table names in the database
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        tables = cursor.fetchall()
+            # Retrieve all table names in the database, plus the plays view
+            # so the backup keeps the familiar denormalized plays.csv
+            cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view');")
+            tables = cursor.fetchall()
 
-        for (table_name,) in tables:
-            # Export each table to a CSV file
-            self._export_table_to_csv(cursor, table_name, backup_folder)
+            for (table_name,) in tables:
+                # Export each table to a CSV file
+                self._export_table_to_csv(cursor, table_name, backup_folder)
 
-        conn.close()
+            cursor.close()
         print(f"Database successfully backed up to CSV in folder: {backup_folder}")
 
     def _export_table_to_csv(self, cursor, table_name, backup_folder):
@@ -54,133 +563,1037 @@ class DatabaseManager:
         print(f"Table {table_name} exported to {csv_file_path}")
 
     def check_and_backup(self):
+        """
+        Take a full or incremental backup when one is due.
+
+        :return: Path of the backup written, or None if none was needed
+        """
         # Ensure the backup directory exists
         if not os.path.exists(self.backup_path):
             os.makedirs(self.backup_path)
 
         if self.is_database_empty():
-            print("Database is empty. No backup needed.")
-            return
-
-        # Retrieve backup files in the backup directory
-        backup_files = [
-            f for f in os.listdir(self.backup_path)
-            if f.startswith("backup_")
-        ]
-
-        # Determine the timestamp of the latest backup
-        if backup_files:
-            latest_backup_file = max(
-                backup_files,
-                key=lambda f: datetime.strptime(f[7:-3], "%Y%m%d_%H%M%S")
-            )
-            last_backup_time = datetime.strptime(latest_backup_file[7:-3],
-                                                 "%Y%m%d_%H%M%S")
-        else:
-            last_backup_time = None  # No backups found
+            return None
+
+        with self._lock:
+            last_full = self.conn.execute(
+                "SELECT MAX(created_at) FROM backups WHERE kind = 'full'"
+            ).fetchone()[0]
+            last_backup = self.conn.execute(
+                "SELECT created_at, high_water_mark FROM backups ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+            max_id = self.conn.execute(
+                "SELECT MAX(id) FROM play_events").fetchone()[0]
+
+        now = datetime.now()
+        if last_full is None or now - datetime.fromisoformat(last_full) > FULL_BACKUP_INTERVAL:
+            path = self.backup_full()
+            self.prune_backups()
+            return path
+
+        if (now - datetime.fromisoformat(last_backup[0]) > BACKUP_INTERVAL
+                and max_id > last_backup[1]):
+            return self.backup_incremental()
+
+        return None
+
+    def start_background_backup(self):
+        """
+        Run check_and_backup on a separate thread, once per DatabaseManager.
+
+        backup_status describes the progress and outcome. The thread is not
+        a daemon, so the program waits for a running backup before exiting.
+        """
+        if self._backup_thread is not None:
+            return self._backup_thread
+
+        def run():
+            try:
+                path = self.check_and_backup()
+                self.backup_status = f"written to {path}" if path else "not needed"
+            except Exception as e:
+                self.backup_status = f"failed: {e}"
+
+        self.backup_status = "in progress"
+        # Assigned before starting, so the thread can tell it is the backup thread
+        self._backup_thread = threading.Thread(target=run, name="backup")
+        self._backup_thread.start()
+        return self._backup_thread
+
+    def backup_full(self):
+        """
+        Snapshot the whole database with SQLite's online backup API.
+
+        :return: Path of the gzip-compressed snapshot
+        """
+        os.makedirs(self.backup_path, exist_ok=True)
+        timestamp = datetime.now()
+        snapshot_path = os.path.join(
+            self.backup_path, f"snapshot_{timestamp:%Y%m%d_%H%M%S}.db")
+
+        # A separate connection reads a consistent copy while this one
+        # stays free for writers
+        source = sqlite3.connect(self.database_path)
+        snapshot = sqlite3.connect(snapshot_path)
+        try:
+            source.backup(snapshot)
+            high_water_mark = snapshot.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM play_events").fetchone()[0]
+        finally:
+            snapshot.close()
+            source.close()
+
+        file_name = f"full_{timestamp:%Y%m%d_%H%M%S}_{high_water_mark}.db.gz"
+        full_path = os.path.join(self.backup_path, file_name)
+        with open(snapshot_path, 'rb') as src, gzip.open(full_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(snapshot_path)
+
+        self._record_backup('full', file_name, timestamp, high_water_mark)
+        return full_path
+
+    def backup_incremental(self):
+        """
+        Write the plays added since the last backup as a gzip-compressed CSV.
+
+        :return: Path of the delta file, or None if there was nothing new
+        """
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT high_water_mark FROM backups ORDER BY id DESC LIMIT 1"
+            ).fetchone()
+            if row is None:
+                # Deltas only make sense on top of a full snapshot
+                return self.backup_full()
+
+            start = row[0]
+            end = self.conn.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM play_events").fetchone()[0]
+        if end <= start:
+            return None
+
+        os.makedirs(self.backup_path, exist_ok=True)
+        timestamp = datetime.now()
+        file_name = f"delta_{timestamp:%Y%m%d_%H%M%S}_{start}_{end}.csv.gz"
+        full_path = os.path.join(self.backup_path, file_name)
+
+        source = sqlite3.connect(self.database_path)
+        try:
+            cursor = source.execute(DELTA_BACKUP_QUERY, (start, end))
+            with gzip.open(full_path, 'wt', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f, delimiter=';')
+                writer.writerow(column[0] for column in cursor.description)
+                while rows := cursor.fetchmany(BACKUP_CHUNK_SIZE):
+                    writer.writerows(rows)
+        finally:
+            source.close()
+
+        self._record_backup('delta', file_name, timestamp, end)
+        return full_path
+
+    def _record_backup(self, kind, file_name, timestamp, high_water_mark):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO backups (kind, file, created_at, high_water_mark) VALUES (?, ?, ?, ?)",
+                (kind, file_name, timestamp.isoformat(), high_water_mark))
+
+    def prune_backups(self, keep_full=BACKUP_KEEP_FULL):
+        """
+        Delete snapshots beyond the newest keep_full and deltas older than them.
+
+        :return: Names of the deleted files
+        """
+        full_backups = sorted(
+            f for f in os.listdir(self.backup_path) if FULL_BACKUP_PATTERN.match(f))
+        if len(full_backups) <= keep_full:
+            return []
+
+        oldest_kept = FULL_BACKUP_PATTERN.match(full_backups[-keep_full]).group(1)
+        removed = []
+        for file_name in os.listdir(self.backup_path):
+            match = FULL_BACKUP_PATTERN.match(file_name) or DELTA_BACKUP_PATTERN.match(file_name)
+            if match and match.group(1) < oldest_kept:
+                os.remove(os.path.join(self.backup_path, file_name))
+                removed.append(file_name)
+
+        with self._lock, self.conn:
+            self.conn.executemany("DELETE FROM backups WHERE file = ?",
+                                  ((file_name,) for file_name in removed))
+        return removed
+
+    @classmethod
+    def restore(cls, backup_path=BACKUP_DATABASE_PATH, database_path=DATABASE_PATH,
+                overwrite=False):
+        """
+        Rebuild a database from the newest full snapshot and the deltas after it.
+
+        The snapshot and the deltas applied are logged in the restored
+        database's backups table, so its next incremental backup starts
+        where they end. A delta may overlap the plays already restored;
+        plays already stored are skipped.
+
+        :param backup_path: Directory holding full_*.db.gz and delta_*.csv.gz files
+        :param database_path: Where to write the restored database
+        :param overwrite: Replace database_path if it already exists
+        :return: Number of plays in the restored database
+        """
+        if os.path.exists(database_path) and not overwrite:
+            raise FileExistsError(f"{database_path} already exists.")
+
+        full_backups = sorted(
+            (match.group(1), int(match.group(2)), match.group(0))
+            for match in map(FULL_BACKUP_PATTERN.match, os.listdir(backup_path))
+            if match)
+        if not full_backups:
+            raise FileNotFoundError(f"No full backup found in {backup_path}.")
+        full_timestamp, high_water_mark, full_name = full_backups[-1]
+
+        deltas = sorted(
+            (int(match.group(2)), int(match.group(3)), match.group(1), match.group(0))
+            for match in map(DELTA_BACKUP_PATTERN.match, os.listdir(backup_path))
+            if match)
+
+        # Restore into a temporary file so a failure leaves nothing half-written
+        temp_path = f"{database_path}.restoring"
+        with gzip.open(os.path.join(backup_path, full_name), 'rb') as src, \
+                open(temp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+
+        manager = cls(temp_path, backup_path)
+        try:
+            manager._record_backup('full', full_name, _backup_timestamp(full_timestamp),
+                                   high_water_mark)
+            for start, end, timestamp, delta_name in deltas:
+                if end <= high_water_mark:
+                    continue
+                if start > high_water_mark:
+                    print(f"Backup chain broken before {delta_name}; "
+                          f"restored plays up to id {high_water_mark}.")
+                    break
 
-        # Check if a new backup is needed
-        if last_backup_time is None or datetime.now() - last_backup_time > timedelta(
-                hours=168):
-            print("Performing a backup on application startup.")
-            self.backup_to_csv()
+                with gzip.open(os.path.join(backup_path, delta_name), 'rt',
+                               newline='', encoding='utf-8') as f:
+                    manager.insert_plays(
+                        read_play_csv(csv.reader(f, delimiter=';'), keep_ids=True))
+                high_water_mark = end
+                manager._record_backup('delta', delta_name, _backup_timestamp(timestamp),
+                                       high_water_mark)
+
+            play_count = manager.conn.execute(
+                "SELECT COUNT(*) FROM play_events").fetchone()[0]
+        finally:
+            manager.close()
+
+        os.replace(temp_path, database_path)
+        print(f"Restored {play_count} plays to {database_path}")
+        return play_count
 
     def is_database_empty(self):
         """Check if the database contains any records."""
         try:
-            conn = sqlite3.connect(self.database_path)
-            cursor = conn.cursor()
-            cursor.execute("SELECT COUNT(*) FROM plays")
-            count = cursor.fetchone()[0]
-            conn.close()
-            return count == 0  # True if the table is empty
+            with self._lock:
+                has_plays = self.conn.execute(
+                    "SELECT EXISTS (SELECT 1 FROM play_events)").fetchone()[0]
+            return not has_plays
 
         except sqlite3.Error as e:
             print(f"Error checking if database is empty: {e}")
             return True  # Assume empty if there's an error
 
-    def insert_play(self, track_id, track_name, artist, album, year, duration_ms, explicit, popularity, played_at, session_id=None):
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+    def insert_play(self, track_id, track_name, artist, album, year, duration_ms, explicit, popularity, played_at, session_id=None, user_id=DEFAULT_USER):
+        track = TrackRecord.create(track_id, track_name, artist, album, year,
+                                   duration_ms, explicit, popularity)
+        self.insert_plays([PlayRecord(track, to_epoch_ms(played_at), session_id)],
+                          user_id=user_id)
+
+    def insert_plays(self, plays, chunk_size=5000, user_id=DEFAULT_USER):
+        """
+        Insert many plays in a single transaction, skipping plays of the
+        same track at the same time that are already stored.
+
+        :param plays: Iterable of PlayRecords
+        :param chunk_size: Number of plays buffered per executemany round
+        :param user_id: Account of the plays that do not name one
+        :return: Number of new plays inserted
+        """
+        inserted = 0
+        with self._lock, self.conn:
+            for chunk in _chunked(plays, chunk_size):
+                last_id = self.conn.execute(
+                    "SELECT COALESCE(MAX(id), 0) FROM play_events").fetchone()[0]
+                inserted += self._insert_play_chunk(chunk, user_id)
+                self._update_rollups(last_id)
+                self._update_sessions(last_id)
+        return inserted
+
+    def _store_tracks(self, cursor, tracks):
+        """Upsert TrackRecords with their artists and albums."""
+        artists = {}
+        albums = {}
+        rows = {}
+
+        for track in tracks:
+            artists[track.artist_id] = (track.artist_id, track.artist)
+            if track.album_id:
+                albums[track.album_id] = (track.album_id, track.album, track.year)
+            rows[track.spotify_id] = track[:TRACK_ROW]
+
+        cursor.executemany(
+            "INSERT OR IGNORE INTO artists (id, name) VALUES (?, ?)",
+            artists.values())
+        cursor.executemany(
+            "INSERT OR IGNORE INTO albums (id, name, year) VALUES (?, ?, ?)",
+            albums.values())
+        cursor.executemany('''
+        INSERT INTO tracks (spotify_id, name, artist_id, album_id, duration_ms, explicit, popularity)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(spotify_id) DO UPDATE SET popularity = excluded.popularity
+        ''', rows.values())
+
+    def _insert_play_chunk(self, chunk, user_id=DEFAULT_USER):
+        cursor = self.conn.cursor()
+        self._store_tracks(cursor, (play.track for play in chunk))
+        cursor.executemany('''
+        INSERT OR IGNORE INTO play_events (id, track_id, played_at, session_id, user_id)
+        SELECT ?, id, ?, ?, ? FROM tracks WHERE spotify_id = ?
+        ''', ((play.id, play.played_at, play.session_id, play.user_id or user_id,
+               play.track.spotify_id) for play in chunk))
+        return cursor.rowcount
+
+    def _update_rollups(self, after_id, until_id=None):
+        """Add plays with ids in (after_id, until_id] to listening_rollup."""
+        totals = defaultdict(lambda: [0, 0])
+        cursor = self.conn.execute('''
+        SELECT p.user_id, p.played_at, t.spotify_id, t.artist_id, t.duration_ms
+        FROM play_events p JOIN tracks t ON t.id = p.track_id
+        WHERE p.id > ? AND (? IS NULL OR p.id <= ?)
+        ''', (after_id, until_id, until_id))
+
+        while rows := cursor.fetchmany(BACKUP_CHUNK_SIZE):
+            for user_id, played_at, track_id, artist_id, duration_ms in rows:
+                local = datetime.fromtimestamp(played_at / 1000, self.timezone)
+                day = local.date().isoformat()
+                duration_ms = duration_ms or 0
+
+                for key in ((user_id, 'track', day, track_id),
+                            (user_id, 'artist', day, artist_id),
+                            (user_id, 'time_of_day', day, time_of_day(local.hour))):
+                    totals[key][0] += 1
+                    totals[key][1] += duration_ms
+
+        self.conn.executemany('''
+        INSERT INTO listening_rollup (user_id, dimension, day, key, plays, ms_played)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, dimension, day, key) DO UPDATE SET
+            plays = plays + excluded.plays,
+            ms_played = ms_played + excluded.ms_played
+        ''', ((*key, plays, ms_played) for key, (plays, ms_played) in totals.items()))
+
+    def rebuild_rollups(self):
+        """Recount listening_rollup from the whole play history."""
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM listening_rollup")
+            max_id = self.conn.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM play_events").fetchone()[0]
+            for start in range(0, max_id, BACKUP_CHUNK_SIZE * 10):
+                self._update_rollups(start, start + BACKUP_CHUNK_SIZE * 10)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO metadata (key, value) VALUES ('rollup_timezone', ?)",
+                (self.timezone.key,))
+
+    def _update_sessions(self, after_id):
+        """Assign sessions to plays with ids above after_id and to plays they affect."""
+        new_plays = self.conn.execute('''
+        SELECT user_id, MIN(played_at), MAX(played_at) FROM play_events
+        WHERE id > ? GROUP BY user_id
+        ''', (after_id,)).fetchall()
+
+        for user_id, first, last in new_plays:
+            # Start over from the beginning of the session before the new
+            # plays, which they may extend or merge with
+            previous = self.conn.execute('''
+            SELECT s.started_at FROM play_events p
+            JOIN sessions s ON s.user_id = p.user_id AND s.id = p.session_id
+            WHERE p.user_id = ? AND p.played_at < ? ORDER BY p.played_at DESC LIMIT 1
+            ''', (user_id, first)).fetchone()
+            self._sessionize(user_id, previous[0] if previous else first, last)
+
+    def _sessionize(self, user_id, start=None, last_new=None):
+        """
+        Recompute session ids for an account's plays from start onwards, in
+        played_at order.
+
+        After last_new, the walk stops at the first play whose stored session
+        id is already correct, since every later play is then correct too.
+        """
+        sessionizer = Sessionizer()
+        cursor = self.conn.execute('''
+        SELECT p.id, p.played_at, t.duration_ms, p.session_id
+        FROM play_events p JOIN tracks t ON t.id = p.track_id
+        WHERE p.user_id = ? AND (? IS NULL OR p.played_at >= ?)
+        ORDER BY p.played_at
+        ''', (user_id, start, start))
+
+        updates = []
+        stale = set()
+        summary = None  # [user_id, id, started_at, last_played_at, plays, ms_played]
+        converged = False
+
+        def flush():
+            self.conn.executemany(
+                "UPDATE play_events SET session_id = ? WHERE id = ?", updates)
+            updates.clear()
+
+        for play_id, played_at, duration_ms, stored_id in cursor:
+            session_id = sessionizer.assign(played_at, duration_ms)
+
+            if session_id == stored_id and last_new is not None and played_at > last_new:
+                converged = True
+                break
+
+            if session_id != stored_id:
+                updates.append((session_id, play_id))
+                if stored_id is not None:
+                    stale.add(stored_id)
+                if len(updates) >= BACKUP_CHUNK_SIZE:
+                    flush()
+
+            if summary is None or summary[1] != session_id:
+                if summary is not None:
+                    self._store_session(summary)
+                summary = [user_id, session_id, played_at, played_at, 0, 0]
+            summary[3] = played_at
+            summary[4] += 1
+            summary[5] += duration_ms or 0
+
+        cursor.close()
+        flush()
 
-        cursor.execute('''
-        INSERT INTO plays (track_id, track_name, artist, album, year, duration_ms, explicit, popularity, played_at, session_id)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (track_id, track_name, artist, album, year, duration_ms, explicit, popularity, played_at, session_id))
+        if summary is not None:
+            if converged:
+                # The session goes on past where the walk stopped
+                self._store_session_from_plays(user_id, summary[1])
+            else:
+                self._store_session(summary)
+
+        stale.discard(summary and summary[1])
+        self.conn.executemany('''
+        DELETE FROM sessions WHERE user_id = ? AND id = ?
+        AND NOT EXISTS (SELECT 1 FROM play_events
+                        WHERE session_id = sessions.id AND user_id = sessions.user_id)
+        ''', ((user_id, session_id) for session_id in stale))
+
+    def _store_session(self, summary):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sessions (user_id, id, started_at, last_played_at, plays, ms_played) VALUES (?, ?, ?, ?, ?, ?)",
+            summary)
+
+    def _store_session_from_plays(self, user_id, session_id):
+        self.conn.execute('''
+        INSERT OR REPLACE INTO sessions (user_id, id, started_at, last_played_at, plays, ms_played)
+        SELECT p.user_id, p.session_id, MIN(p.played_at), MAX(p.played_at), COUNT(*),
+               COALESCE(SUM(t.duration_ms), 0)
+        FROM play_events p JOIN tracks t ON t.id = p.track_id
+        WHERE p.session_id = ? AND p.user_id = ?
+        ''', (session_id, user_id))
+
+    def rebuild_sessions(self):
+        """Recompute every session in one pass over each account's play history."""
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM sessions")
+            user_ids = [row[0] for row in self.conn.execute(
+                "SELECT DISTINCT user_id FROM play_events")]
+            for user_id in user_ids:
+                self._sessionize(user_id)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO metadata (key, value) VALUES ('session_gap', ?)",
+                (SESSION_GAP.total_seconds(),))
+
+    def get_sessions(self, limit=20, user_id=DEFAULT_USER):
+        """Return the latest sessions as (id, started_at, last_played_at, plays, ms_played)."""
+        with self._lock:
+            rows = self.conn.execute('''
+            SELECT id, started_at, last_played_at, plays, ms_played FROM sessions
+            WHERE user_id = ? ORDER BY started_at DESC LIMIT ?
+            ''', (user_id, limit)).fetchall()
+        return [(session_id, from_epoch_ms(started_at), from_epoch_ms(last_played_at),
+                 plays, ms_played)
+                for session_id, started_at, last_played_at, plays, ms_played in rows]
+
+    def get_listening_rollup(self, dimension='artist', period='day', start=None,
+                             end=None, user_id=DEFAULT_USER):
+        """
+        Read listening totals from the rollup table.
+
+        :param dimension: 'track', 'artist' or 'time_of_day'
+        :param period: 'day', or 'week' for weeks starting on Monday
+        :param start: First day to include as a date or ISO string (optional)
+        :param end: Last day to include as a date or ISO string (optional)
+        :param user_id: Account whose listening to read
+        :return: List of (period start, key, name, plays, ms_played) tuples,
+            ordered by period and then by listening time
+        """
+        if dimension not in ROLLUP_DIMENSIONS:
+            raise ValueError(f"dimension must be one of {', '.join(ROLLUP_DIMENSIONS)}.")
+        if period not in ('day', 'week'):
+            raise ValueError("period must be 'day' or 'week'.")
+
+        period_expression = "r.day" if period == 'day' else "date(r.day, '-6 days', 'weekday 1')"
+        name_expression = {
+            'track': "(SELECT name FROM tracks WHERE spotify_id = r.key)",
+            'artist': "(SELECT name FROM artists WHERE id = r.key)",
+            'time_of_day': "r.key",
+        }[dimension]
+
+        with self._lock:
+            return self.conn.execute(f'''
+            SELECT {period_expression} AS period, r.key, {name_expression} AS name,
+                   SUM(r.plays), SUM(r.ms_played)
+            FROM listening_rollup r
+            WHERE r.user_id = ? AND r.dimension = ?
+            AND (? IS NULL OR r.day >= ?) AND (? IS NULL OR r.day <= ?)
+            GROUP BY period, r.key
+            ORDER BY period, SUM(r.ms_played) DESC
+            ''', (user_id, dimension, start and str(start), start and str(start),
+                  end and str(end), end and str(end))).fetchall()
+
+    def get_recent_plays(self, limit=50, before=None, user_id=DEFAULT_USER):
+        """
+        Return the latest plays, skipping repeats of the play just after them.
+
+        Consecutive duplicates are dropped in SQL, so exactly limit rows come
+        back whenever the history is long enough. Pages are read from the
+        played_at index, so each one costs the same however far back it is.
+
+        :param limit: Number of plays to return
+        :param before: Only return plays older than this played_at, e.g. the
+            last played_at of the previous page
+        :param user_id: Account whose plays to return
+        :return: List of (track_id, track_name, artist, played_at) tuples,
+            newest first
+        """
+        # The play at `before` itself is read so the first play of the page
+        # can be compared with it, then left out
+        if before is None:
+            where, parameters = "WHERE user_id = ?", (user_id, None, None, limit)
+        else:
+            before = to_epoch_ms(before)
+            where, parameters = ("WHERE user_id = ? AND played_at <= ?",
+                                 (user_id, before, before, before, limit))
+
+        with self._lock:
+            rows = self.conn.execute(f'''
+            WITH recent AS (
+                SELECT track_id, played_at FROM (
+                    SELECT track_id, played_at,
+                           LAG(track_id) OVER (ORDER BY played_at DESC) AS previous_track_id
+                    FROM play_events
+                    {where}
+                )
+                WHERE (previous_track_id IS NULL OR previous_track_id != track_id)
+                AND (? IS NULL OR played_at < ?)
+                LIMIT ?
+            )
+            SELECT t.spotify_id, t.name, ar.name, r.played_at
+            FROM recent r
+            JOIN tracks t ON t.id = r.track_id
+            JOIN artists ar ON ar.id = t.artist_id
+            ORDER BY r.played_at DESC
+            ''', parameters).fetchall()
+        return [(track_id, track_name, artist, from_epoch_ms(played_at))
+                for track_id, track_name, artist, played_at in rows]
+
+    def search_tracks(self, query, limit=10, user_id=DEFAULT_USER):
+        """
+        Find the played tracks whose name, artist or album match a query,
+        best matches first.
+
+        :param query: Words to look for; the last one may be incomplete
+        :param user_id: Account whose plays to count
+        :return: List of (track_id, track_name, artist, album, plays,
+            last played_at) tuples
+        """
+        match = _fts_query(query)
+        if match is None:
+            return []
+
+        with self._lock:
+            rows = self.conn.execute('''
+            WITH matches AS (
+                SELECT rowid AS track_id, rank FROM track_search
+                WHERE track_search MATCH :match ORDER BY rank LIMIT :tracks
+            ), played AS (
+                SELECT track_id, rank FROM matches m
+                WHERE EXISTS (SELECT 1 FROM play_events
+                              WHERE user_id = :user_id AND track_id = m.track_id)
+                ORDER BY rank LIMIT :limit
+            )
+            SELECT t.spotify_id, t.name, ar.name, al.name,
+                   (SELECT COUNT(*) FROM play_events
+                    WHERE user_id = :user_id AND track_id = m.track_id),
+                   (SELECT MAX(played_at) FROM play_events
+                    WHERE user_id = :user_id AND track_id = m.track_id)
+            FROM played m
+            JOIN tracks t ON t.id = m.track_id
+            JOIN artists ar ON ar.id = t.artist_id
+            LEFT JOIN albums al ON al.id = t.album_id
+            ORDER BY m.rank
+            ''', {'match': match, 'tracks': SEARCH_MAX_TRACKS, 'user_id': user_id,
+                  'limit': limit}).fetchall()
+        return [(*row[:5], from_epoch_ms(row[5])) for row in rows]
+
+    def search_history(self, query, limit=50, before=None, user_id=DEFAULT_USER):
+        """
+        Return the plays of the tracks whose name, artist or album match a
+        query, newest first.
+
+        When a few tracks match, the newest plays of each are read from the
+        track index. When many do, the history is read backwards until
+        enough of their plays turn up. Either way a page costs about the same
+        however long the history is.
+
+        :param query: Words to look for; the last one may be incomplete
+        :param limit: Number of plays to return
+        :param before: Only return plays older than this played_at, e.g. the
+            last played_at of the previous page
+        :param user_id: Account whose plays to return
+        :return: List of (track_id, track_name, artist, album, played_at)
+            tuples
+        """
+        match = _fts_query(query)
+        if match is None:
+            return []
+
+        if before is None:
+            older, parameters = "", ()
+        else:
+            older, parameters = "AND played_at < ?", (to_epoch_ms(before),)
 
-        conn.commit()
-        conn.close()
+        with self._lock:
+            track_ids = [row[0] for row in self.conn.execute(
+                "SELECT rowid FROM track_search WHERE track_search MATCH ?", (match,))]
+            if not track_ids:
+                return []
 
-    def get_recent_plays(self, limit=50):
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+            if len(track_ids) > SEARCH_TRACK_BY_TRACK:
+                plays = self.conn.execute(f'''
+                SELECT track_id, played_at FROM play_events
+                WHERE user_id = ? {older}
+                AND track_id IN (SELECT rowid FROM track_search WHERE track_search MATCH ?)
+                ORDER BY played_at DESC LIMIT ?
+                ''', (user_id, *parameters, match, limit)).fetchall()
+            else:
+                plays = []
+                for track_id in track_ids:
+                    plays.extend(self.conn.execute(f'''
+                    SELECT track_id, played_at FROM play_events
+                    WHERE user_id = ? AND track_id = ? {older}
+                    ORDER BY played_at DESC LIMIT ?
+                    ''', (user_id, track_id, *parameters, limit)))
+                plays = sorted(plays, key=lambda play: play[1], reverse=True)[:limit]
 
-        # Query to select the most recent plays, excluding consecutive duplicates
-        cursor.execute('''
-        SELECT track_id, track_name, artist, played_at
-        FROM plays
-        ORDER BY played_at DESC
-        LIMIT ?
-        ''', (limit,))
+            placeholders = ', '.join('?' * len({track_id for track_id, _ in plays}))
+            tracks = {row[0]: row[1:] for row in self.conn.execute(f'''
+            SELECT t.id, t.spotify_id, t.name, ar.name, al.name
+            FROM tracks t
+            JOIN artists ar ON ar.id = t.artist_id
+            LEFT JOIN albums al ON al.id = t.album_id
+            WHERE t.id IN ({placeholders})
+            ''', tuple({track_id for track_id, _ in plays}))}
 
-        plays = cursor.fetchall()
-        conn.close()
+        return [(*tracks[track_id], from_epoch_ms(played_at)) for track_id, played_at in plays]
 
-        # Filter out consecutive duplicates
-        filtered_plays = []
-        last_track_id = None
+    def get_most_recent_play_timestamp(self, user_id=DEFAULT_USER):
+        with self._lock:
+            latest_played_at = self.conn.execute(
+                "SELECT MAX(played_at) FROM play_events WHERE user_id = ?",
+                (user_id,)).fetchone()[0]
+        return from_epoch_ms(latest_played_at)
 
-        for play in plays:
-            if play[0] != last_track_id:
-                filtered_plays.append(play)
-                last_track_id = play[0]
+    def get_known_tracks(self):
+        """
+        Return (spotify_id, name, artist) of every stored track, most popular
+        first. Local files are left out, as no playlist can add them.
+        """
+        with self._lock:
+            return self.conn.execute('''
+            SELECT t.spotify_id, t.name, ar.name
+            FROM tracks t JOIN artists ar ON ar.id = t.artist_id
+            WHERE t.spotify_id NOT LIKE ? || '%'
+            ORDER BY t.popularity DESC
+            ''', (LOCAL_TRACK_PREFIX,)).fetchall()
 
-        return filtered_plays
+    def get_tracks_version(self):
+        """Return a number that grows whenever a new track is stored."""
+        with self._lock:
+            return self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM tracks").fetchone()[0]
 
-    def get_most_recent_play_timestamp(self):
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+    def get_cached_track_uris(self, queries):
+        """
+        Look up normalized search queries in the search cache.
 
-        cursor.execute("SELECT MAX(played_at) FROM plays")
-        latest_played_at = cursor.fetchone()[0]
-        conn.close()
+        :param queries: Iterable of keys from normalize_search_query
+        :return: Dictionary of query -> URI for every cache hit. A value of
+            None means the search is known to find nothing.
+        """
+        queries = list(queries)
+        now = int(time.time())
+        found = {}
 
-        # Convert to datetime if it exists and is not None
-        if latest_played_at:
-            latest_played_at = datetime.strptime(latest_played_at,
-                                                 "%Y-%m-%d %H:%M:%S.%f")
-        return latest_played_at
+        with self._lock, self.conn:
+            for chunk in _chunked(queries, 500):
+                placeholders = ', '.join('?' * len(chunk))
+                rows = self.conn.execute(f'''
+                SELECT query, uri FROM search_cache
+                WHERE query IN ({placeholders})
+                AND created_at > CASE WHEN uri IS NULL THEN ? ELSE ? END
+                ''', (*chunk, now - SEARCH_CACHE_NEGATIVE_TTL,
+                      now - SEARCH_CACHE_TTL)).fetchall()
+                found.update(rows)
+
+            self.conn.executemany(
+                "UPDATE search_cache SET last_used = ? WHERE query = ?",
+                ((now, query) for query in found))
+
+        self.search_cache_hits += len(found)
+        self.search_cache_misses += len(queries) - len(found)
+        return found
+
+    def cache_track_uris(self, results):
+        """
+        Store search results, evicting expired and least recently used rows.
+
+        :param results: Dictionary of normalized query -> URI or None
+        """
+        now = int(time.time())
+
+        with self._lock, self.conn:
+            self.conn.executemany('''
+            INSERT OR REPLACE INTO search_cache (query, uri, created_at, last_used)
+            VALUES (?, ?, ?, ?)
+            ''', ((query, uri, now, now) for query, uri in results.items()))
+
+            self.conn.execute('''
+            DELETE FROM search_cache
+            WHERE created_at <= CASE WHEN uri IS NULL THEN ? ELSE ? END
+            ''', (now - SEARCH_CACHE_NEGATIVE_TTL, now - SEARCH_CACHE_TTL))
+
+            count = self.conn.execute(
+                "SELECT COUNT(*) FROM search_cache").fetchone()[0]
+            if count > SEARCH_CACHE_MAX_ENTRIES:
+                self.conn.execute('''
+                DELETE FROM search_cache WHERE query IN (
+                    SELECT query FROM search_cache ORDER BY last_used LIMIT ?
+                )
+                ''', (count - SEARCH_CACHE_MAX_ENTRIES,))
+
+    def search_cache_stats(self):
+        """Return hit/miss counters of the search cache for this session."""
+        lookups = self.search_cache_hits + self.search_cache_misses
+        return {
+            'hits': self.search_cache_hits,
+            'misses': self.search_cache_misses,
+            'hit_rate': self.search_cache_hits / lookups if lookups else 0.0,
+        }
+
+    def add_account(self, user_id, spotify_id=None):
+        """Register an account, or update the Spotify id of a registered one."""
+        with self._lock, self.conn:
+            self.conn.execute('''
+            INSERT INTO accounts (user_id, spotify_id, added_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (user_id) DO UPDATE SET spotify_id = excluded.spotify_id
+            ''', (user_id, spotify_id))
+
+    def get_accounts(self):
+        """Return the registered accounts as (user_id, spotify_id, added_at) tuples."""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT user_id, spotify_id, added_at FROM accounts ORDER BY added_at").fetchall()
+
+    def get_stored_playlist_snapshot(self, playlist_id):
+        """Return the snapshot_id of the stored copy of a playlist, or None."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT snapshot_id FROM playlists WHERE id = ?", (playlist_id,)).fetchone()
+        return row[0] if row else None
+
+    def store_playlist(self, playlist_id, name, snapshot_id, pages):
+        """
+        Replace the stored copy of a playlist, one page of tracks at a time.
+
+        Each page is committed as it arrives, so memory use stays flat and
+        writers on other threads are not held up by the download. The
+        snapshot_id is only stored once every page is, so an interrupted
+        download is fetched again next time.
+
+        :param pages: Iterable of lists of the playlist's TrackRecords, in order
+        :return: Number of tracks stored
+        """
+        with self._lock, self.conn:
+            self.conn.execute('''
+            INSERT OR REPLACE INTO playlists (id, name, snapshot_id, fetched_at)
+            VALUES (?, ?, '', ?)
+            ''', (playlist_id, name, datetime.now().isoformat()))
+            self.conn.execute("DELETE FROM playlist_tracks WHERE playlist_id = ?", (playlist_id,))
+
+        position = 0
+        for tracks in pages:
+            with self._lock, self.conn:
+                cursor = self.conn.cursor()
+                self._store_tracks(cursor, tracks)
+                cursor.executemany('''
+                INSERT INTO playlist_tracks (playlist_id, position, track_id)
+                SELECT ?, ?, id FROM tracks WHERE spotify_id = ?
+                ''', ((playlist_id, position, track.spotify_id)
+                      for position, track in enumerate(tracks, position)))
+            position += len(tracks)
+
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE playlists SET snapshot_id = ? WHERE id = ?",
+                              (snapshot_id, playlist_id))
+        return position
+
+    def iter_playlist_tracks(self, playlist_id, chunk_size=BACKUP_CHUNK_SIZE):
+        """
+        Yield the tracks of the stored copy of a playlist in order, in lists
+        of up to chunk_size (track_id, track_name, artist, album, year,
+        duration_ms, explicit, popularity) tuples. track_id is None for
+        local files.
+        """
+        position = -1
+        while True:
+            with self._lock:
+                rows = self.conn.execute('''
+                SELECT pt.position,
+                       CASE WHEN t.spotify_id LIKE :local || '%' THEN NULL ELSE t.spotify_id END,
+                       t.name, ar.name, al.name, al.year,
+                       t.duration_ms, t.explicit, t.popularity
+                FROM playlist_tracks pt
+                JOIN tracks t ON t.id = pt.track_id
+                JOIN artists ar ON ar.id = t.artist_id
+                LEFT JOIN albums al ON al.id = t.album_id
+                WHERE pt.playlist_id = :playlist_id AND pt.position > :position
+                ORDER BY pt.position LIMIT :limit
+                ''', {'local': LOCAL_TRACK_PREFIX, 'playlist_id': playlist_id,
+                      'position': position, 'limit': chunk_size}).fetchall()
+            if not rows:
+                return
+            position = rows[-1][0]
+            yield [row[1:] for row in rows]
+
+    def get_playlist_sync(self, playlist_id):
+        """
+        Return (snapshot_id, track URIs) recorded by the last sync of a
+        playlist, or None if it was never synced.
+        """
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT snapshot_id, track_uris FROM playlist_syncs WHERE playlist_id = ?",
+                (playlist_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1].split('\n') if row[1] else []
+
+    def set_playlist_sync(self, playlist_id, snapshot_id, track_uris):
+        """Record the track URIs a playlist has at snapshot_id after a sync."""
+        with self._lock, self.conn:
+            self.conn.execute('''
+            INSERT OR REPLACE INTO playlist_syncs (playlist_id, snapshot_id, track_uris, synced_at)
+            VALUES (?, ?, ?, ?)
+            ''', (playlist_id, snapshot_id, '\n'.join(track_uris), datetime.now().isoformat()))
+
+    def store_top_items(self, rankings, taken_at=None, user_id=DEFAULT_USER):
+        """
+        Store one collection run of top items as a snapshot of each ranking.
+
+        A ranking already stored, e.g. unchanged since the previous run, is
+        not stored again; the new snapshot refers to the stored one.
+
+        :param rankings: Dictionary of (item type, time range) -> the
+            ranking's TrackRecords or ArtistRecords in rank order
+        :param taken_at: Epoch milliseconds of the run; now by default
+        :return: Number of rankings not stored before
+        """
+        taken_at = int(time.time() * 1000) if taken_at is None else taken_at
+        new_rankings = 0
+        with self._lock, self.conn:
+            cursor = self.conn.cursor()
+            for (item_type, time_range), items in rankings.items():
+                if item_type not in TOP_ITEM_TYPES:
+                    raise ValueError(f"item_type must be one of {', '.join(TOP_ITEM_TYPES)}.")
+                if item_type == 'tracks':
+                    self._store_tracks(cursor, items)
+                else:
+                    cursor.executemany('''
+                    INSERT INTO artists (id, name, genres, popularity) VALUES (?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET genres = excluded.genres,
+                        popularity = excluded.popularity
+                    ''', items)
+
+                item_ids = [item[0] for item in items]
+                signature = hashlib.sha1(
+                    "\n".join([item_type, *item_ids]).encode('utf-8')).hexdigest()
+                cursor.execute("INSERT OR IGNORE INTO top_rankings (signature) VALUES (?)",
+                               (signature,))
+                if cursor.rowcount:
+                    ranking_id = cursor.lastrowid
+                    cursor.executemany(
+                        "INSERT INTO top_ranking_items (ranking_id, rank, item_id) VALUES (?, ?, ?)",
+                        ((ranking_id, rank, item_id) for rank, item_id in enumerate(item_ids, 1)))
+                    new_rankings += 1
+                else:
+                    ranking_id = cursor.execute(
+                        "SELECT id FROM top_rankings WHERE signature = ?", (signature,)).fetchone()[0]
+
+                cursor.execute('''
+                INSERT OR REPLACE INTO top_snapshots (user_id, item_type, time_range, taken_at, ranking_id)
+                VALUES (?, ?, ?, ?, ?)
+                ''', (user_id, item_type, time_range, taken_at, ranking_id))
+        return new_rankings
+
+    def get_top_items(self, item_type='tracks', time_range='medium_term', limit=None,
+                      user_id=DEFAULT_USER):
+        """
+        Read the ranking of the latest top items snapshot.
+
+        :param limit: Number of items to return; all by default
+        :return: List of (rank, track_id, track_name, artist, album,
+            popularity, previous rank) tuples for tracks and of (rank,
+            artist_id, artist, genres, popularity, previous rank) tuples for
+            artists. The previous rank is the item's rank in the last
+            different ranking, or None if it was not in it.
+        """
+        if item_type not in TOP_ITEM_TYPES:
+            raise ValueError(f"item_type must be one of {', '.join(TOP_ITEM_TYPES)}.")
+
+        if item_type == 'tracks':
+            columns = "t.spotify_id, t.name, ar.name, al.name, t.popularity"
+            joins = '''
+            JOIN tracks t ON t.spotify_id = l.item_id
+            JOIN artists ar ON ar.id = t.artist_id
+            LEFT JOIN albums al ON al.id = t.album_id
+            '''
+        else:
+            columns = "ar.id, ar.name, ar.genres, ar.popularity"
+            joins = "JOIN artists ar ON ar.id = l.item_id"
+
+        with self._lock:
+            return self.conn.execute(f'''
+            WITH latest AS (
+                SELECT ranking_id, rank, item_id FROM latest_top_items
+                WHERE user_id = :user_id AND item_type = :item_type AND time_range = :time_range
+            ), previous AS (
+                SELECT item_id, MIN(rank) AS rank FROM top_ranking_items
+                WHERE ranking_id = (
+                    SELECT ranking_id FROM top_snapshots
+                    WHERE user_id = :user_id AND item_type = :item_type
+                    AND time_range = :time_range
+                    AND ranking_id != (SELECT ranking_id FROM latest LIMIT 1)
+                    ORDER BY taken_at DESC LIMIT 1)
+                GROUP BY item_id
+            )
+            SELECT l.rank, {columns}, p.rank
+            FROM latest l
+            {joins}
+            LEFT JOIN previous p ON p.item_id = l.item_id
+            ORDER BY l.rank LIMIT :limit
+            ''', {'user_id': user_id, 'item_type': item_type, 'time_range': time_range,
+                  'limit': -1 if limit is None else limit}).fetchall()
+
+    def get_top_item_trend(self, item_id, item_type='tracks', time_range=None,
+                           user_id=DEFAULT_USER):
+        """
+        Follow the rank of a track or artist through the stored top items snapshots.
+
+        :param item_id: Spotify id of the track or artist
+        :param time_range: Only this time range; all of them by default
+        :return: List of (taken_at, time_range, rank) tuples, ordered by time
+            range and then oldest first. rank is None in snapshots the item
+            was not in.
+        """
+        with self._lock:
+            rows = self.conn.execute('''
+            SELECT s.taken_at, s.time_range,
+                   (SELECT MIN(rank) FROM top_ranking_items
+                    WHERE ranking_id = s.ranking_id AND item_id = :item_id)
+            FROM top_snapshots s
+            WHERE s.user_id = :user_id AND s.item_type = :item_type
+            AND (:time_range IS NULL OR s.time_range = :time_range)
+            ORDER BY s.time_range, s.taken_at
+            ''', {'item_id': item_id, 'user_id': user_id, 'item_type': item_type,
+                  'time_range': time_range}).fetchall()
+        return [(from_epoch_ms(taken_at), time_range, rank)
+                for taken_at, time_range, rank in rows]
+
+    def get_metadata(self, key, default=None):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_metadata(self, key, value):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)",
+                (key, value))
 
     def check_database(self):
+        """
+        Open the connection, then migrate the schema and derived tables if needed.
+
+        If migrating fails, the connection is closed again, so the next use
+        of conn checks the database again instead of using a half-migrated
+        schema.
+        """
         # Check if the database dir exists
         database_dir = os.path.dirname(self.database_path)
-        if not os.path.exists(database_dir):
+        if database_dir and not os.path.exists(database_dir):
             os.makedirs(database_dir)
-            print(f"Created directory for database at {database_dir}")
+            self._notify(f"Created directory for database at {database_dir}")
 
-        # Creates a new table if one does not exist
-        self._create_table()
-        print("Database check complete.")
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._connect()
 
-    def _create_table(self):
-        conn = sqlite3.connect(self.database_path)
-        cursor = conn.cursor()
+            try:
+                # Creates the tables or migrates an older database
+                self._migrate_schema()
 
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS plays (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        track_id TEXT NOT NULL,
-        track_name TEXT NOT NULL,
-        artist TEXT NOT NULL,
-        album TEXT,               
-        year INTEGER,             
-        duration_ms INTEGER,      
-        explicit BOOLEAN,         
-        popularity INTEGER,       
-        played_at TIMESTAMP NOT NULL,
-        session_id TEXT
-    )
-    ''')
+                # Rollups are counted in local days, so a new timezone means recounting
+                if self.get_metadata('rollup_timezone') != self.timezone.key:
+                    self._notify(f"Building listening statistics for timezone {self.timezone.key}")
+                    self.rebuild_rollups()
+
+                if self.get_metadata('session_gap') != SESSION_GAP.total_seconds():
+                    self._notify("Detecting listening sessions in the play history")
+                    self.rebuild_sessions()
+            except Exception:
+                self.close()
+                raise
+
+    def _notify(self, message):
+        """
+        Print a message about database maintenance. On the background backup
+        thread it goes into backup_status instead, so it is not printed over
+        the menu.
+        """
+        if threading.current_thread() is self._backup_thread:
+            self.backup_status = f"in progress ({message[:1].lower()}{message[1:]})"
+        else:
+            print(f"{message}.")
+
+    def _migrate_schema(self):
+        """Bring the database up to the latest schema version."""
+        with self._lock:
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+            for number, script in enumerate(MIGRATIONS[version:], version + 1):
+                try:
+                    self.conn.executescript(
+                        f"BEGIN; {script} PRAGMA user_version = {number}; COMMIT;")
+                except sqlite3.Error:
+                    self.conn.rollback()
+                    raise
 
-        conn.commit()
-        conn.close()
+            if version < len(MIGRATIONS):
+                self._notify(f"Database schema updated to version {len(MIGRATIONS)}")
@@ -0,0 +1,172 @@
+import os
+import sqlite3
+import warnings
+from datetime import datetime
+
+from scripts.database import BACKUP_CHUNK_SIZE, UTC, time_of_day
+
+# Columns of the plays view, the local date/time columns the Excel dashboard
+# used to compute itself and the account the play belongs to
+EXPORT_COLUMNS = ['id', 'track_id', 'track_name', 'artist', 'album', 'year',
+                  'duration_ms', 'explicit', 'popularity', 'played_at',
+                  'session_id', 'date', 'time', 'time_of_day', 'user_id']
+EXPORT_FORMATS = ('xlsx', 'parquet')
+TABLE_NAME = "PlaysTable"
+EXCEL_MAX_ROWS = 1048576  # Rows Excel opens per sheet, header included
+
+
+def iter_play_rows(database_manager, chunk_size=BACKUP_CHUNK_SIZE):
+    """
+    Yield lists of export rows, reading the plays view chunk_size rows at a time.
+
+    played_at is converted to the database manager's timezone.
+    """
+    # Opening the shared connection brings the schema up to date first
+    database_manager.conn
+    # A connection of its own so a long export never blocks writers
+    conn = sqlite3.connect(database_manager.database_path)
+    try:
+        cursor = conn.execute(f'''
+        SELECT {', '.join(EXPORT_COLUMNS[:11])}, user_id FROM plays ORDER BY id
+        ''')
+        while rows := cursor.fetchmany(chunk_size):
+            chunk = []
+            for row in rows:
+                played_at = datetime.fromisoformat(row[9]).replace(tzinfo=UTC)
+                local = played_at.astimezone(database_manager.timezone)
+                chunk.append([
+                    *row[:9],
+                    local.replace(tzinfo=None),
+                    row[10],
+                    local.date(),
+                    local.strftime('%H.%M.%S'),
+                    time_of_day(local.hour),
+                    row[11],
+                ])
+            yield chunk
+    finally:
+        conn.close()
+
+
+def export_plays_xlsx(database_manager, file_path, chunk_size=BACKUP_CHUNK_SIZE,
+                      sheet_rows=EXCEL_MAX_ROWS):
+    """
+    Write the play history to an Excel workbook as a table on sheet 'data'.
+
+    Rows are streamed through openpyxl's write-only mode, so memory use
+    stays the same however long the history is. A history longer than a
+    sheet can hold continues on sheets 'data2', 'data3' and so on, each
+    with a table of its own.
+
+    :param sheet_rows: Most rows per sheet, header included
+    :return: Number of plays written
+    """
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheets = []
+    sheet_count = sheet_rows  # Rows on the current sheet; full before the first
+
+    row_count = 0
+    for chunk in iter_play_rows(database_manager, chunk_size):
+        for row in chunk:
+            if sheet_count == sheet_rows:
+                sheet = workbook.create_sheet('data' if not sheets else f"data{len(sheets) + 1}")
+                sheet.append(EXPORT_COLUMNS)
+                sheets.append(sheet)
+                sheet_count = 1
+            sheet.append(row)
+            sheet_count += 1
+        row_count += len(chunk)
+
+    # A table needs at least one data row below its header
+    if not sheets:
+        workbook.create_sheet('data').append(EXPORT_COLUMNS)
+    for number, sheet in enumerate(sheets, 1):
+        data_rows = sheet_rows - 1 if number < len(sheets) else sheet_count - 1
+        _add_table(sheet, TABLE_NAME if number == 1 else f"{TABLE_NAME}{number}", data_rows)
+
+    workbook.save(file_path)
+    return row_count
+
+
+def _add_table(sheet, name, data_rows):
+    """Format the header and data_rows rows of a write-only sheet as a table."""
+    from openpyxl.utils import get_column_letter
+    from openpyxl.worksheet.table import Table, TableStyleInfo
+
+    table = Table(displayName=name,
+                  ref=f"A1:{get_column_letter(len(EXPORT_COLUMNS))}{data_rows + 1}")
+    table.tableStyleInfo = TableStyleInfo(name="TableStyleMedium9",
+                                          showRowStripes=True)
+    # Write-only sheets cannot read the header back, so name columns here
+    table._initialise_columns()
+    for column, column_name in zip(table.tableColumns, EXPORT_COLUMNS):
+        column.name = column_name
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', "In write-only mode")
+        sheet.add_table(table)
+
+
+def export_plays_parquet(database_manager, file_path, chunk_size=BACKUP_CHUNK_SIZE):
+    """
+    Write the play history to a Parquet file, one row group per chunk.
+
+    Requires pyarrow.
+
+    :return: Number of plays written
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Parquet export requires pyarrow (pip install pyarrow).")
+
+    schema = pa.schema([
+        ('id', pa.int64()),
+        ('track_id', pa.string()),
+        ('track_name', pa.string()),
+        ('artist', pa.string()),
+        ('album', pa.string()),
+        ('year', pa.int32()),
+        ('duration_ms', pa.int64()),
+        ('explicit', pa.bool_()),
+        ('popularity', pa.int32()),
+        ('played_at', pa.timestamp('us')),
+        ('session_id', pa.int64()),
+        ('date', pa.date32()),
+        ('time', pa.string()),
+        ('time_of_day', pa.string()),
+        ('user_id', pa.string()),
+    ])
+
+    row_count = 0
+    with pq.ParquetWriter(file_path, schema) as writer:
+        for chunk in iter_play_rows(database_manager, chunk_size):
+            columns = [list(column) for column in zip(*chunk)]
+            # explicit may be stored as 0/1 or, from old CSV imports, as text
+            columns[7] = [None if value is None else value in (1, '1', 'True', 'true')
+                          for value in columns[7]]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+            row_count += len(chunk)
+
+    return row_count
+
+
+def export_plays(database_manager, file_path, file_format=None,
+                 chunk_size=BACKUP_CHUNK_SIZE):
+    """
+    Export the play history to XLSX or Parquet.
+
+    :param file_format: 'xlsx' or 'parquet'; taken from the file extension
+        when not given
+    :return: Number of plays written
+    """
+    file_format = file_format or os.path.splitext(file_path)[1].lstrip('.').lower()
+
+    if file_format == 'xlsx':
+        return export_plays_xlsx(database_manager, file_path, chunk_size)
+    if file_format == 'parquet':
+        return export_plays_parquet(database_manager, file_path, chunk_size)
+
+    raise ValueError(f"Export format must be one of {', '.join(EXPORT_FORMATS)}.")
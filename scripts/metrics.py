@@ -0,0 +1,232 @@
+import functools
+import inspect
+import json
+import threading
+import time
+from collections import defaultdict
+
+import config
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Prometheus label that names what was measured, per kind of measurement
+KIND_LABELS = {'api': 'endpoint', 'db': 'operation'}
+PROMETHEUS_PREFIX = "spotify_manager"
+
+
+class Stat:
+    """Counts and a latency histogram for one endpoint or database operation."""
+
+    __slots__ = ('count', 'errors', 'seconds', 'max_seconds', 'buckets',
+                 'rows', 'bytes', 'retries', 'rate_limited')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # The last one is +Inf
+        self.rows = 0
+        self.bytes = 0
+        self.retries = 0
+        self.rate_limited = 0
+
+    def as_dict(self):
+        cumulative = 0
+        histogram = {}
+        for bound, count in zip((*LATENCY_BUCKETS, '+Inf'), self.buckets):
+            cumulative += count
+            histogram[str(bound)] = cumulative
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'seconds': self.seconds,
+            'max_seconds': self.max_seconds,
+            'histogram': histogram,
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'rate_limited': self.rate_limited,
+        }
+
+
+class Metrics:
+    """
+    Thread-safe timings of Spotify API calls and database operations.
+
+    Nothing is recorded while enabled is False; instrumented code then only
+    pays for checking the flag.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.started_at = time.time()
+        self._stats = defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def observe(self, kind, name, seconds, error=False, rows=0, response_bytes=0,
+                retries=0, rate_limited=0):
+        """
+        Record one call.
+
+        :param kind: 'api' or 'db'
+        :param name: Endpoint or operation called
+        :param rows: Rows returned or stored
+        :param response_bytes: Size of the response body
+        :param retries: Requests repeated before the final response
+        :param rate_limited: How many of those were answered with 429
+        """
+        bucket = next((index for index, bound in enumerate(LATENCY_BUCKETS)
+                       if seconds <= bound), len(LATENCY_BUCKETS))
+        with self._lock:
+            stat = self._stats[kind].get(name)
+            if stat is None:
+                stat = self._stats[kind][name] = Stat()
+            stat.count += 1
+            stat.errors += error
+            stat.seconds += seconds
+            stat.max_seconds = max(stat.max_seconds, seconds)
+            stat.buckets[bucket] += 1
+            stat.rows += rows
+            stat.bytes += response_bytes
+            stat.retries += retries
+            stat.rate_limited += rate_limited
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.started_at = time.time()
+
+    def snapshot(self):
+        """Return {kind: {name: stat dictionary}}, busiest names first."""
+        with self._lock:
+            return {
+                kind: {name: stat.as_dict() for name, stat in
+                       sorted(stats.items(), key=lambda item: -item[1].seconds)}
+                for kind, stats in self._stats.items()
+            }
+
+    def to_json(self):
+        return json.dumps({'started_at': self.started_at, **self.snapshot()}, indent=2)
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        for kind, stats in self.snapshot().items():
+            label = KIND_LABELS.get(kind, 'name')
+            metric = f"{PROMETHEUS_PREFIX}_{kind}"
+            lines.append(f"# TYPE {metric}_seconds histogram")
+            for name, stat in stats.items():
+                name = name.replace('\\', '\\\\').replace('"', '\\"')
+                for bound, count in stat['histogram'].items():
+                    lines.append(f'{metric}_seconds_bucket{{{label}="{name}",le="{bound}"}} {count}')
+                lines.append(f'{metric}_seconds_sum{{{label}="{name}"}} {stat["seconds"]}')
+                lines.append(f'{metric}_seconds_count{{{label}="{name}"}} {stat["count"]}')
+
+            for field in ('errors', 'rows', 'bytes', 'retries', 'rate_limited'):
+                if not any(stat[field] for stat in stats.values()):
+                    continue
+                lines.append(f"# TYPE {metric}_{field}_total counter")
+                for name, stat in stats.items():
+                    name = name.replace('\\', '\\\\').replace('"', '\\"')
+                    lines.append(f'{metric}_{field}_total{{{label}="{name}"}} {stat[field]}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(enabled=getattr(config, 'metrics', True))
+
+
+def _row_count(result, counts_rows):
+    """Rows a database method returned, or stored if it returns a count."""
+    if isinstance(result, (list, dict)):
+        return len(result)
+    if counts_rows and isinstance(result, int):
+        return result
+    return 0
+
+
+def timed(kind, name, counts_rows=False):
+    """
+    Decorate a function so each call is recorded under kind and name.
+
+    :param counts_rows: The function returns the number of rows it stored
+    """
+    def decorator(function):
+        if inspect.isgeneratorfunction(function):
+            return _timed_generator(kind, name, function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return function(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except Exception:
+                metrics.observe(kind, name, time.perf_counter() - start, error=True)
+                raise
+            metrics.observe(kind, name, time.perf_counter() - start,
+                            rows=_row_count(result, counts_rows) if kind == 'db' else 0)
+            return result
+        return wrapper
+    return decorator
+
+
+def _timed_generator(kind, name, function):
+    """
+    Wrap a generator function so each run is recorded as one call.
+
+    Only the time spent producing items counts, not the time the caller
+    spends between them. Rows are the items yielded, or the rows in each
+    yielded list. A run the caller stops early is recorded when it is
+    closed.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not metrics.enabled:
+            return (yield from function(*args, **kwargs))
+
+        generator = function(*args, **kwargs)
+        seconds = 0.0
+        rows = 0
+        error = False
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(generator)
+                except StopIteration as stop:
+                    seconds += time.perf_counter() - start
+                    return stop.value
+                except Exception:
+                    seconds += time.perf_counter() - start
+                    error = True
+                    raise
+                seconds += time.perf_counter() - start
+                rows += len(item) if isinstance(item, list) else 1
+                yield item
+        finally:
+            generator.close()
+            metrics.observe(kind, name, seconds, error=error,
+                            rows=rows if kind == 'db' else 0)
+    return wrapper
+
+
+def instrument_methods(kind, row_counts=()):
+    """
+    Class decorator timing every method of the class under kind.
+
+    Properties, class and static methods and dunder methods are left as
+    they are.
+
+    :param row_counts: Names of the methods that return the number of rows
+        they stored
+    """
+    def decorator(cls):
+        for name, attribute in list(vars(cls).items()):
+            if callable(attribute) and not name.startswith('__') \
+                    and not isinstance(attribute, (classmethod, staticmethod, type)):
+                setattr(cls, name, timed(kind, name, name in row_counts)(attribute))
+        return cls
+    return decorator
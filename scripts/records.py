@@ -0,0 +1,183 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+from operator import itemgetter
+
+# Play times are stored as milliseconds since EPOCH, in UTC
+EPOCH = datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+MILLISECOND = timedelta(milliseconds=1)
+
+# The first TRACK_ROW fields of a TrackRecord are the columns of the tracks
+# table in order
+TRACK_FIELDS = ('spotify_id', 'name', 'artist_id', 'album_id', 'duration_ms',
+                'explicit', 'popularity', 'artist', 'album', 'year')
+TRACK_ROW = 7
+LOCAL_TRACK_PREFIX = 'spotify:local:'  # URIs local files are stored under
+PLAY_FIELDS = ('track', 'played_at', 'session_id', 'user_id', 'id')
+ARTIST_FIELDS = ('id', 'name', 'genres', 'popularity')
+# Columns read from plays.csv files and delta backups; only track_id,
+# track_name, artist and played_at are required
+PLAY_CSV_COLUMNS = ('track_id', 'track_name', 'artist', 'album', 'year', 'duration_ms',
+                    'explicit', 'popularity', 'played_at', 'session_id',
+                    'artist_id', 'album_id', 'user_id', 'id')
+PLAY_CSV_REQUIRED = ('track_id', 'track_name', 'artist', 'played_at')
+CSV_TRACK_CACHE_SIZE = 10000  # Distinct tracks read_play_csv shares records of at once
+
+
+def to_epoch_ms(value):
+    """
+    Convert a play time to epoch milliseconds UTC, the form play_events
+    stores it in.
+
+    Parsing costs one call to the C-implemented datetime.fromisoformat and
+    a little integer arithmetic, so whole CSV columns convert many times
+    faster than with strptime.
+
+    :param value: Naive UTC or timezone-aware datetime, ISO 8601 text such
+        as Spotify's '2025-01-31T18:04:05.123Z', or epoch milliseconds
+    """
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value[:-1] if value.endswith('Z') else value)
+    offset = value.utcoffset()
+    if offset:
+        value -= offset
+    seconds = (value.toordinal() - EPOCH_ORDINAL) * 86400 \
+        + value.hour * 3600 + value.minute * 60 + value.second
+    # Round microseconds like SQLite does, so migrated and newly imported
+    # plays of the same time match
+    return seconds * 1000 + (value.microsecond + 500) // 1000
+
+
+def from_epoch_ms(milliseconds):
+    """Naive UTC datetime of a stored play time; None stays None."""
+    if milliseconds is None:
+        return None
+    return EPOCH + timedelta(milliseconds=milliseconds)
+
+
+def _local_id(*names):
+    """Stand-in dimension key for rows that carry no Spotify id."""
+    return 'local:' + ':'.join(names)
+
+
+class TrackRecord(namedtuple('TrackRecord', TRACK_FIELDS)):
+    """
+    A track with its artist and album, as stored in the tracks, artists and
+    albums tables.
+
+    Being a tuple without a __dict__, a record costs a fraction of the
+    dictionary it replaces, and track[:TRACK_ROW] is its tracks row as is.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, spotify_id, name, artist, album=None, year=None, duration_ms=None,
+               explicit=None, popularity=None, artist_id=None, album_id=None):
+        """Build a track, giving an artist or album without a Spotify id a local one."""
+        artist_id = artist_id or _local_id(artist)
+        if not album_id and album:
+            album_id = _local_id(artist, album)
+        return cls(spotify_id, name, artist_id, album_id or None, duration_ms, explicit,
+                   popularity, artist, album, year)
+
+    @classmethod
+    def from_api(cls, track):
+        """
+        Build a track from a Web API track object.
+
+        Local files, which have no id, are kept under their
+        'spotify:local:...' URI.
+        """
+        artist = track['artists'][0]
+        album = track['album']
+        return cls.create(track['id'] or track['uri'], track['name'], artist['name'],
+                          album['name'], (album.get('release_date') or '')[:4] or None,
+                          track['duration_ms'], track['explicit'], track['popularity'],
+                          artist['id'], album['id'])
+
+
+class ArtistRecord(namedtuple('ArtistRecord', ARTIST_FIELDS)):
+    """An artist as stored in the artists table, genres joined with ', '."""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_api(cls, artist):
+        """Build an artist from a Web API artist object."""
+        return cls(artist['id'], artist['name'], ", ".join(artist.get('genres') or ()),
+                   artist.get('popularity'))
+
+
+class PlayRecord(namedtuple('PlayRecord', PLAY_FIELDS, defaults=(None, None, None))):
+    """
+    One play of a track, with played_at in epoch milliseconds UTC.
+
+    session_id, user_id and id are only known for plays read back from
+    backups; insert_plays fills in or works out the rest.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_api(cls, item):
+        """Build a play from a recently played item, or return None without played_at."""
+        played_at = item.get('played_at')
+        if not played_at:
+            return None
+        return cls(TrackRecord.from_api(item['track']), to_epoch_ms(played_at))
+
+
+def read_play_csv(rows, keep_ids=False):
+    """
+    Yield a PlayRecord for each row of a plays.csv file or delta backup.
+
+    Columns are looked up once in the header, and each row goes straight
+    from its csv.reader list into a record. The plays of a track share one
+    TrackRecord, so a play only holds its own few fields. Empty values
+    count as missing.
+
+    :param rows: csv.reader over the file, header first
+    :param keep_ids: Keep the play ids of the file, as restores do; imports
+        leave numbering the plays to the database
+    """
+    header = next(rows, None)
+    if header is None:
+        return
+    missing = [column for column in PLAY_CSV_REQUIRED if column not in header]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}.")
+
+    # Columns the file does not have read the empty value appended to each row
+    width = len(header)
+    positions = [header.index(column) if column in header else width
+                 for column in PLAY_CSV_COLUMNS]
+    if not keep_ids:
+        positions[-1] = width
+    get_values = itemgetter(*positions)
+    padding = [''] * width
+
+    # Storing a known track again only updates its popularity, so plays with
+    # the same track id and popularity can share a record
+    tracks = {}
+    for row in rows:
+        if not row:
+            continue
+        if len(row) == width:
+            row.append('')
+        else:
+            row = (row + padding)[:width] + ['']
+        (track_id, name, artist, album, year, duration_ms, explicit, popularity,
+         played_at, session_id, artist_id, album_id, user_id, play_id) = get_values(row)
+
+        track = tracks.get((track_id, popularity))
+        if track is None:
+            if len(tracks) >= CSV_TRACK_CACHE_SIZE:
+                tracks.clear()
+            track = tracks[track_id, popularity] = TrackRecord.create(
+                track_id, name, artist, album or None, year or None, duration_ms or None,
+                explicit or None, popularity or None, artist_id, album_id)
+        yield PlayRecord(track, to_epoch_ms(played_at), session_id or None,
+                         user_id or None, play_id or None)
@@ -0,0 +1,141 @@
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+MATCH_THRESHOLD = 0.85  # Lowest score a local match is used at instead of a search
+TITLE_WEIGHT = 0.7      # Share of the score the title has; the artist has the rest
+MIN_ARTIST_SCORE = 0.8  # Lowest artist similarity a track given with an artist matches at
+CANDIDATES = 20         # Tracks fully scored per lookup
+MAX_POSTINGS = 2000     # Trigrams on more tracks than this are too common to help
+MIN_QUERY_GRAMS = 3     # Rarest trigrams always used, however common they are
+
+# "(feat. X)", "[with X]", "(2011 Remaster)" and " - Remastered 2009" name the
+# same recording and are left out of or added to titles freely
+FEATURING = re.compile(r"[(\[]\s*(?:feat|ft|featuring|with)\b[^)\]]*[)\]]")
+REMASTER = re.compile(r"[(\[][^)\]]*remaster[^)\]]*[)\]]|\s-\s.*remaster.*$")
+# Separators between the artists of a collaboration
+ARTIST_SEPARATOR = re.compile(r"\s*(?:,|&|\band\b|\bfeat\b\.?|\bft\b\.?|\bfeaturing\b|\bx\b)\s*")
+NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize_text(text):
+    """Lowercase text without accents, punctuation or extra spaces."""
+    text = unicodedata.normalize('NFKD', text or '').casefold()
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(NON_WORD.sub(' ', text.replace('&', ' and ')).split())
+
+
+def normalize_title(title):
+    """normalize_text for track titles, leaving out featured artists and remaster notes."""
+    title = (title or '').casefold()
+    return normalize_text(REMASTER.sub(' ', FEATURING.sub(' ', title)))
+
+
+def trigrams(text):
+    """Return the set of three-character substrings of text, padded at the ends."""
+    padded = f"  {text} "
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+
+def similarity(grams, other_grams):
+    """Dice coefficient of two trigram sets, from 0 to 1."""
+    if not grams or not other_grams:
+        return 0.0
+    return 2 * len(grams & other_grams) / (len(grams) + len(other_grams))
+
+
+class TrackIndex:
+    """
+    In-memory index of known tracks for matching (song, artist) lines
+    without searching Spotify.
+
+    Titles are indexed by trigram, so small spelling differences still
+    find the track. Candidates sharing the query's rarest trigrams are
+    scored by the trigram similarity of title and artist.
+    """
+
+    def __init__(self, tracks=()):
+        """:param tracks: Iterable of (spotify_id, title, artist), most popular first"""
+        self.spotify_ids = []
+        self.titles = []
+        self.artists = []
+        self.exact = {}
+        self.postings = defaultdict(list)
+        for spotify_id, title, artist in tracks:
+            self.add(spotify_id, title, artist)
+
+    def __len__(self):
+        return len(self.spotify_ids)
+
+    def add(self, spotify_id, title, artist):
+        title = normalize_title(title)
+        artist = normalize_text(artist)
+        if not spotify_id or not title:
+            return
+
+        index = len(self.spotify_ids)
+        self.spotify_ids.append(spotify_id)
+        self.titles.append(title)
+        self.artists.append(artist)
+        # The first, i.e. most popular, of several identical tracks wins
+        self.exact.setdefault((title, artist), index)
+        for gram in trigrams(title):
+            self.postings[gram].append(index)
+
+    def best_match(self, song, artist):
+        """
+        Find the known track most like a (song, artist) line.
+
+        Tracks of another artist never match, however alike the titles:
+        common titles such as "Intro" or "Home" are shared by many artists,
+        and artists alike only in e.g. a leading "The" score about 0.5.
+
+        :return: (spotify_id, score from 0 to 1), or (None, 0.0) when no
+            track shares enough of the title and artist
+        """
+        title = normalize_title(song)
+        artist = normalize_text(artist)
+        if not title:
+            return None, 0.0
+
+        index = self.exact.get((title, artist))
+        if index is not None:
+            return self.spotify_ids[index], 1.0
+
+        title_grams = trigrams(title)
+        artist_grams = self._artist_trigrams(artist)
+        best_index, best_score = None, 0.0
+        for index in self._candidates(title_grams):
+            title_score = similarity(title_grams, trigrams(self.titles[index]))
+            if artist_grams:
+                stored_grams = trigrams(self.artists[index])
+                artist_score = max(similarity(grams, stored_grams) for grams in artist_grams)
+                if artist_score < MIN_ARTIST_SCORE:
+                    continue
+                score = TITLE_WEIGHT * title_score + (1 - TITLE_WEIGHT) * artist_score
+            else:
+                score = title_score
+            if score > best_score:
+                best_index, best_score = index, score
+
+        if best_index is None:
+            return None, 0.0
+        return self.spotify_ids[best_index], best_score
+
+    def _candidates(self, title_grams):
+        """Indexes of the tracks sharing the most rare trigrams with a title."""
+        postings = sorted((self.postings[gram] for gram in title_grams if gram in self.postings),
+                          key=len)
+        selective = [tracks for tracks in postings if len(tracks) <= MAX_POSTINGS]
+        counts = Counter()
+        for tracks in selective if len(selective) >= MIN_QUERY_GRAMS else postings[:MIN_QUERY_GRAMS]:
+            counts.update(tracks)
+        return [index for index, _ in counts.most_common(CANDIDATES)]
+
+    @staticmethod
+    def _artist_trigrams(artist):
+        """Trigram sets of the artist line as a whole and of each artist it names."""
+        if not artist:
+            return []
+        names = {artist, *(name for name in ARTIST_SEPARATOR.split(artist) if name)}
+        return [trigrams(name) for name in names]
@@ -0,0 +1,10 @@
+import pytest
+
+from scripts.database import DatabaseManager
+
+
+@pytest.fixture
+def database_manager(tmp_path):
+    manager = DatabaseManager(str(tmp_path / "plays.db"), str(tmp_path / "backups"), "UTC")
+    yield manager
+    manager.close()
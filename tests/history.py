@@ -0,0 +1,12 @@
+from scripts.records import PlayRecord, TrackRecord
+
+FIRST_PLAY = 1735689600000  # 2025-01-01 00:00 UTC in epoch milliseconds
+
+
+def make_plays(count, start=0):
+    """Plays of ten tracks, one every four minutes, numbered from start."""
+    tracks = [TrackRecord.create(f"track{number}", f"Song {number}", f"Artist {number % 3}",
+                                 f"Album {number % 3}", "2020", 180000, False, 50)
+              for number in range(10)]
+    return [PlayRecord(tracks[number % 10], FIRST_PLAY + number * 240000)
+            for number in range(start, start + count)]
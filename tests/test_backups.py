@@ -0,0 +1,63 @@
+from scripts.database import DatabaseManager
+
+from tests.history import make_plays
+
+
+def play_count(database_path, backup_path):
+    manager = DatabaseManager(database_path, backup_path)
+    try:
+        return manager.conn.execute("SELECT COUNT(*) FROM play_events").fetchone()[0]
+    finally:
+        manager.close()
+
+
+def test_restore_applies_the_newest_snapshot_and_its_deltas(database_manager, tmp_path):
+    database_manager.insert_plays(make_plays(100))
+    database_manager.backup_full()
+    database_manager.insert_plays(make_plays(50, start=100))
+    database_manager.backup_incremental()
+
+    target = str(tmp_path / "restored.db")
+    assert DatabaseManager.restore(database_manager.backup_path, target) == 150
+
+
+def test_backups_continue_after_a_restore(database_manager, tmp_path):
+    backup_path = database_manager.backup_path
+    database_manager.insert_plays(make_plays(100))
+    database_manager.backup_full()
+    database_manager.insert_plays(make_plays(50, start=100))
+    database_manager.backup_incremental()
+    database_manager.backup_full()
+    database_manager.insert_plays(make_plays(50, start=150))
+    database_manager.backup_incremental()
+
+    restored = str(tmp_path / "restored.db")
+    assert DatabaseManager.restore(backup_path, restored) == 200
+
+    manager = DatabaseManager(restored, backup_path)
+    try:
+        manager.insert_plays(make_plays(100, start=200))
+        delta = manager.backup_incremental()
+    finally:
+        manager.close()
+    assert delta.endswith("_200_300.csv.gz")
+
+    restored_again = str(tmp_path / "restored_again.db")
+    assert DatabaseManager.restore(backup_path, restored_again) == 300
+    assert play_count(restored_again, backup_path) == 300
+
+
+def test_restore_accepts_a_delta_overlapping_the_restored_plays(database_manager, tmp_path):
+    backup_path = database_manager.backup_path
+    database_manager.insert_plays(make_plays(100))
+    database_manager.backup_full()
+    database_manager.insert_plays(make_plays(50, start=100))
+    database_manager.backup_incremental()
+    # A delta written from an older high-water mark than the last backup's
+    database_manager.insert_plays(make_plays(50, start=150))
+    database_manager.conn.execute("DELETE FROM backups WHERE kind = 'delta'")
+    database_manager.conn.commit()
+    assert database_manager.backup_incremental().endswith("_100_200.csv.gz")
+
+    restored = str(tmp_path / "restored.db")
+    assert DatabaseManager.restore(backup_path, restored) == 200
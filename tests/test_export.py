@@ -0,0 +1,50 @@
+import pytest
+
+from scripts.export import EXPORT_COLUMNS, export_plays, export_plays_xlsx
+
+from tests.history import make_plays
+
+
+def test_parquet_export_writes_every_play(database_manager, tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    database_manager.insert_plays(make_plays(25))
+    file_path = str(tmp_path / "plays.parquet")
+
+    assert export_plays(database_manager, file_path, chunk_size=10) == 25
+
+    table = pq.read_table(file_path)
+    assert table.column_names == EXPORT_COLUMNS
+    assert table.num_rows == 25
+    first = table.slice(0, 1).to_pylist()[0]
+    assert first['track_id'] == 'track0'
+    assert first['year'] == 2020
+    assert first['explicit'] is False
+    assert first['session_id'] == 1735689600000
+    assert str(first['played_at']) == '2025-01-01 00:00:00'
+
+
+@pytest.mark.parametrize('plays, sheet_rows, expected_rows', [
+    (0, 10, [0]),
+    (9, 10, [9]),
+    (25, 10, [9, 9, 7]),
+])
+def test_xlsx_export_continues_on_new_sheets(database_manager, tmp_path, plays, sheet_rows,
+                                             expected_rows):
+    openpyxl = pytest.importorskip('openpyxl')
+
+    database_manager.insert_plays(make_plays(plays))
+    file_path = str(tmp_path / "plays.xlsx")
+    assert export_plays_xlsx(database_manager, file_path, chunk_size=4,
+                             sheet_rows=sheet_rows) == plays
+
+    workbook = openpyxl.load_workbook(file_path)
+    assert workbook.sheetnames == ['data', 'data2', 'data3'][:len(expected_rows)]
+    ids = []
+    for sheet, data_rows in zip(workbook.worksheets, expected_rows):
+        rows = list(sheet.iter_rows(values_only=True))
+        assert list(rows[0]) == EXPORT_COLUMNS
+        assert len(rows) == data_rows + 1
+        ids.extend(row[0] for row in rows[1:])
+        assert [table.ref for table in sheet.tables.values()] == \
+            ([f"A1:O{data_rows + 1}"] if data_rows else [])
+    assert ids == list(range(1, plays + 1))
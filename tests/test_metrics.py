@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+from scripts.metrics import metrics, timed
+
+from tests.history import make_plays
+
+
+@pytest.fixture
+def recorded_metrics():
+    enabled = metrics.enabled
+    metrics.enabled = True
+    metrics.reset()
+    yield metrics
+    metrics.reset()
+    metrics.enabled = enabled
+
+
+def db_stat(name):
+    return metrics.snapshot()['db'][name]
+
+
+def test_generator_methods_are_timed_over_every_chunk(recorded_metrics, database_manager):
+    database_manager.store_playlist('playlist', "Road Trip", 'snapshot1',
+                                    [[play.track for play in make_plays(10)]] * 3)
+    recorded_metrics.reset()
+
+    chunks = list(database_manager.iter_playlist_tracks('playlist', chunk_size=4))
+
+    assert [len(chunk) for chunk in chunks] == [4, 4, 4, 4, 4, 4, 4, 2]
+    stat = db_stat('iter_playlist_tracks')
+    assert stat['count'] == 1
+    assert stat['rows'] == 30
+    assert stat['errors'] == 0
+
+
+def test_generator_stopped_early_is_recorded_when_closed(recorded_metrics):
+    @timed('db', 'numbers')
+    def numbers():
+        yield from range(100)
+
+    for number in numbers():
+        if number == 4:
+            break
+
+    assert db_stat('numbers')['count'] == 1
+    assert db_stat('numbers')['rows'] == 5
+
+
+def test_generator_errors_are_counted(recorded_metrics):
+    @timed('db', 'failing')
+    def failing():
+        yield [1, 2]
+        raise ValueError("broken chunk")
+
+    with pytest.raises(ValueError):
+        list(failing())
+
+    assert db_stat('failing')['errors'] == 1
+    assert db_stat('failing')['rows'] == 2
+
+
+def test_generator_time_leaves_out_the_caller(recorded_metrics):
+    @timed('db', 'chunks')
+    def chunks():
+        yield [1]
+        yield [2]
+
+    for _ in chunks():
+        time.sleep(0.05)
+
+    assert db_stat('chunks')['seconds'] < 0.05
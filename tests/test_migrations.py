@@ -0,0 +1,85 @@
+import sqlite3
+
+import pytest
+
+from scripts.database import MIGRATIONS, DatabaseManager
+
+
+def version_12_database(path, played_at_values):
+    """A database at schema version 12, before play times became integers."""
+    conn = sqlite3.connect(path)
+    for script in MIGRATIONS[:12]:
+        conn.executescript(script)
+    conn.executescript('''
+    PRAGMA user_version = 12;
+    INSERT INTO artists (id, name) VALUES ('artist', 'Artist');
+    INSERT INTO tracks (id, spotify_id, name, artist_id, duration_ms)
+    VALUES (1, 'track', 'Song', 'artist', 180000);
+    ''')
+    conn.executemany("INSERT INTO play_events (track_id, played_at) VALUES (1, ?)",
+                     ((value,) for value in played_at_values))
+    conn.commit()
+    conn.close()
+
+
+def test_play_times_migrate_to_epoch_milliseconds(tmp_path):
+    path = str(tmp_path / "plays.db")
+    version_12_database(path, ['2025-01-01 00:00:00', '2025-01-01T00:04:00.1234'])
+
+    manager = DatabaseManager(path, str(tmp_path / "backups"), "UTC")
+    try:
+        played_at = [row[0] for row in manager.conn.execute(
+            "SELECT played_at FROM play_events ORDER BY id")]
+    finally:
+        manager.close()
+    assert played_at == [1735689600000, 1735689840123]
+
+
+def test_unreadable_play_time_fails_the_migration(tmp_path):
+    path = str(tmp_path / "plays.db")
+    version_12_database(path, ['2025-01-01 00:00:00', 'yesterday'])
+
+    manager = DatabaseManager(path, str(tmp_path / "backups"), "UTC")
+    with pytest.raises(sqlite3.IntegrityError):
+        manager.conn
+    manager.close()
+
+    conn = sqlite3.connect(path)
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == 12
+        assert conn.execute("SELECT COUNT(*) FROM play_events").fetchone()[0] == 2
+    finally:
+        conn.close()
+
+
+def test_failed_migration_is_retried_on_next_use(tmp_path):
+    path = str(tmp_path / "plays.db")
+    version_12_database(path, ['yesterday'])
+
+    manager = DatabaseManager(path, str(tmp_path / "backups"), "UTC")
+    for _ in range(2):
+        with pytest.raises(sqlite3.IntegrityError):
+            manager.conn
+        assert manager._conn is None
+    manager.close()
+
+
+def test_background_backup_reports_migrations_in_its_status(tmp_path, capsys):
+    path = str(tmp_path / "plays.db")
+    version_12_database(path, ['2025-01-01 00:00:00'])
+
+    manager = DatabaseManager(path, str(tmp_path / "backups"), "UTC")
+    statuses = []
+    notify = manager._notify
+
+    def record_status(message):
+        notify(message)
+        statuses.append(manager.backup_status)
+
+    manager._notify = record_status
+    manager.start_background_backup().join()
+    manager.close()
+
+    assert capsys.readouterr().out == ""
+    assert f"in progress (database schema updated to version {len(MIGRATIONS)})" in statuses
+    assert manager.backup_status.startswith("written to ")
@@ -0,0 +1,94 @@
+import csv
+
+import pytest
+
+from scripts.backend import SpotifyManager
+
+PLAYLIST = {'id': 'playlist', 'name': "Road Trip", 'snapshot_id': 'snapshot1'}
+
+
+def api_track(number):
+    return {
+        'id': f"track{number}", 'uri': f"spotify:track:track{number}",
+        'name': f"Song {number}", 'artists': [{'id': f"artist{number}", 'name': f"Artist {number}"}],
+        'album': {'id': f"album{number}", 'name': f"Album {number}", 'release_date': '2020-05-01'},
+        'duration_ms': 180000, 'explicit': False, 'popularity': 50,
+    }
+
+
+LOCAL_FILE = {
+    'id': None, 'uri': "spotify:local:Garage+Band:Demos:First+Take:201",
+    'name': "First Take", 'artists': [{'id': None, 'name': "Garage Band"}],
+    'album': {'id': None, 'name': "Demos", 'release_date': None},
+    'duration_ms': 201000, 'explicit': False, 'popularity': 0,
+}
+
+
+class PlaylistClient:
+    """Serves the items of one playlist like spotipy's playlist_items."""
+
+    def __init__(self, tracks, fail_at_offset=None):
+        self.tracks = tracks
+        self.fail_at_offset = fail_at_offset
+
+    def playlist(self, playlist_id, fields=None):
+        return {'snapshot_id': PLAYLIST['snapshot_id']}
+
+    def playlist_items(self, playlist_id, offset=0, limit=100, fields=None, additional_types=None):
+        if offset == self.fail_at_offset:
+            raise ConnectionError("Connection reset")
+        return {'total': len(self.tracks),
+                'items': [{'track': track} for track in self.tracks[offset:offset + limit]]}
+
+
+@pytest.fixture
+def spotify_manager(database_manager):
+    manager = SpotifyManager(database_manager=database_manager)
+    manager.backup_thread.join()
+    return manager
+
+
+def test_playlist_file_keeps_every_song_in_order(spotify_manager, tmp_path):
+    tracks = [api_track(number) for number in range(250)]
+    tracks[120:120] = [LOCAL_FILE, None]  # A local file and a removed track
+    spotify_manager.sp = PlaylistClient(tracks)
+
+    assert spotify_manager.save_playlist_to_file(PLAYLIST, str(tmp_path)) == 251
+
+    with open(tmp_path / "Road Trip.csv", encoding='utf-8', newline='') as f:
+        rows = list(csv.reader(f, delimiter=';'))
+    assert rows[0][:3] == ["track_id", "track_name", "artist"]
+    assert [row[0] for row in rows[1:4]] == ["track0", "track1", "track2"]
+    assert rows[121] == ["", "First Take", "Garage Band", "Demos", "", "201000", "False", "0"]
+    assert rows[-1][0] == "track249"
+
+
+def test_local_files_are_not_matched_by_imports(spotify_manager, tmp_path):
+    spotify_manager.sp = PlaylistClient([api_track(1), LOCAL_FILE])
+    spotify_manager.refresh_stored_playlist(PLAYLIST, 'snapshot1')
+
+    known = [spotify_id for spotify_id, _, _ in spotify_manager.database_manager.get_known_tracks()]
+    assert known == ["track1"]
+
+
+def test_stored_playlist_is_read_back_in_chunks(spotify_manager):
+    spotify_manager.sp = PlaylistClient([api_track(number) for number in range(25)])
+    spotify_manager.refresh_stored_playlist(PLAYLIST, 'snapshot1')
+
+    chunks = list(spotify_manager.database_manager.iter_playlist_tracks('playlist', chunk_size=10))
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    assert [track[0] for chunk in chunks for track in chunk] == [f"track{n}" for n in range(25)]
+
+
+def test_interrupted_download_is_fetched_again(spotify_manager):
+    database_manager = spotify_manager.database_manager
+    tracks = [api_track(number) for number in range(250)]
+    spotify_manager.sp = PlaylistClient(tracks, fail_at_offset=200)
+    with pytest.raises(ConnectionError):
+        spotify_manager.refresh_stored_playlist(PLAYLIST, 'snapshot1')
+    assert database_manager.get_stored_playlist_snapshot('playlist') != 'snapshot1'
+
+    spotify_manager.sp = PlaylistClient(tracks)
+    assert spotify_manager.refresh_stored_playlist(PLAYLIST, 'snapshot1')
+    assert database_manager.get_stored_playlist_snapshot('playlist') == 'snapshot1'
+    assert sum(map(len, database_manager.iter_playlist_tracks('playlist'))) == 250
@@ -0,0 +1,47 @@
+import pytest
+
+from scripts.track_index import MATCH_THRESHOLD, TrackIndex
+
+# Titles that several artists have a track of
+SHARED_TITLES = [
+    ('1975-intro', "Intro", "The 1975"),
+    ('killers-intro', "Intro", "The Killers"),
+    ('phillips-home', "Home", "Phillip Phillips"),
+    ('buble-home', "Home", "Michael Bublé"),
+    ('collins-air', "In the Air Tonight", "Phil Collins"),
+]
+
+
+@pytest.fixture
+def track_index():
+    return TrackIndex(SHARED_TITLES)
+
+
+@pytest.mark.parametrize('song, artist', [
+    ("Intro", "The xx"),
+    ("Intro", "The Strokes"),
+    ("Home", "Phil Collins"),
+    ("Home", "Daughtry"),
+    ("In the Air Tonight", "Phillip Phillips"),
+])
+def test_shared_title_of_another_artist_does_not_match(track_index, song, artist):
+    spotify_id, score = track_index.best_match(song, artist)
+    assert spotify_id is None or score < MATCH_THRESHOLD
+
+
+@pytest.mark.parametrize('song, artist, expected', [
+    ("Intro", "The 1975", '1975-intro'),
+    ("intro", "the killers", 'killers-intro'),
+    ("Home", "Michael Buble", 'buble-home'),
+    ("Home", "Phillip Philips", 'phillips-home'),
+    ("In The Air Tonight (2015 Remaster)", "Phil Colins", 'collins-air'),
+    ("In the Air Tonight (feat. Nobody)", "Phil Collins", 'collins-air'),
+])
+def test_same_artist_matches_despite_small_differences(track_index, song, artist, expected):
+    spotify_id, score = track_index.best_match(song, artist)
+    assert spotify_id == expected
+    assert score >= MATCH_THRESHOLD
+
+
+def test_title_alone_matches_without_an_artist(track_index):
+    assert track_index.best_match("In the Air Tonite", "")[0] == 'collins-air'